@@ -141,7 +141,7 @@ def annotate_page():
                 print('WARNING: the style of suggested labels is not defined, please check your configuration file.')
 
     if "keyword_highlights_file" in config and len(schema_labels_to_highlight) == 0:
-        updated_text, schema_labels_to_highlight = post_process(config, text)
+        updated_text, schema_labels_to_highlight = post_process(config, text, instance_id)
 
     # Fill in the kwargs that the user wanted us to include when rendering the page
     kwargs = {}
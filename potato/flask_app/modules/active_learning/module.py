@@ -84,7 +84,7 @@ def actively_learn():
     # Collect all the current labels
     instance_to_labels = defaultdict(list)
 
-    for uas in user_to_annotation_state.values():
+    for uas in list(user_to_annotation_state.values()):
         for iid, annotation in uas.instance_id_to_labeling.items():
             instance_to_labels[iid].append(annotation)
 
@@ -214,7 +214,7 @@ def actively_learn():
     # any annotation so that it stays in the front of the users' queues even if
     # they haven't gotten to it yet (but others have)
     already_annotated = list(instance_to_labels.keys())
-    for annotation_state in user_to_annotation_state.values():
+    for annotation_state in list(user_to_annotation_state.values()):
         annotation_state.reorder_remaining_instances(new_id_order, already_annotated)
 
     _logger.info("Finished reording instances")
@@ -0,0 +1,60 @@
+"""
+module: annotation
+filename: agreement.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for annotation which keeps the comparable label of every
+  annotator of every instance, so that deciding whether the annotators of
+  an instance agree never has to look at (or load) their states. The
+  labels are updated as annotators submit and when their states are loaded
+"""
+
+from collections import Counter
+from threading import Lock
+from typing import Hashable, Iterable, Optional
+
+
+class LabelTally:
+    """
+    instance id -> username -> the comparable label the user gave it
+    """
+
+    def __init__(self):
+        self._labels = {}
+        self._lock = Lock()
+
+    def set_label(self, instance_id: str, username: str, label: Optional[Hashable]):
+        """
+        Records the label of a user on an instance, replacing their previous
+        one. A label of None removes it
+        """
+        with self._lock:
+            labels = self._labels.get(instance_id)
+            if label is None:
+                if labels is not None:
+                    labels.pop(username, None)
+                    if len(labels) == 0:
+                        del self._labels[instance_id]
+                return
+            if labels is None:
+                labels = self._labels[instance_id] = {}
+            labels[username] = label
+
+    def count(self, instance_id: str, usernames: Iterable[str]) -> Counter:
+        """
+        :return: how many of the given users gave each label to the instance
+        """
+        with self._lock:
+            labels = self._labels.get(instance_id, {})
+            return Counter(labels[username] for username in usernames if username in labels)
+
+    def clear(self):
+        with self._lock:
+            self._labels.clear()
+
+
+_label_tally = LabelTally()
+
+
+def get_label_tally() -> LabelTally:
+    return _label_tally
@@ -0,0 +1,338 @@
+"""
+module: annotation
+filename: highlight.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for annotation which finds the keywords of the
+  keyword_highlights_file in the text of an instance. All keywords are
+  compiled once into a trie so that a page is scanned in a single pass
+  instead of once per keyword
+"""
+
+from array import array
+import logging
+import re
+from typing import List, Tuple
+
+import pandas as pd
+
+_logger = logging.getLogger("Highlight")
+
+WILDCARD = "*"
+# what a wildcard in a keyword may stand for, the old regexes used [a-z]*?
+_WILDCARD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz")
+DEFAULT_HIGHLIGHT_CACHE_SIZE = 10000
+# the words that may get a random highlight, and where each of them occurs
+_FALSE_LABEL_WORD_REGEX = re.compile(r"\b[a-z]{4,}\b", re.I)
+
+
+class _Node:
+    __slots__ = ["children", "star", "is_star", "keywords"]
+
+    def __init__(self, is_star: bool = False):
+        self.children = {}
+        # the node reached through a wildcard, it loops on _WILDCARD_CHARS
+        self.star = None
+        self.is_star = is_star
+        self.keywords = []
+
+
+def _is_word_char(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+def _lower(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # a few characters lower case to more than one character, keep those as
+    # they were so that offsets into the lowered text stay valid
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+class KeywordMatcher:
+    """
+    Matches many keywords against a text at once. A keyword matches case
+    insensitively on word boundaries and each "*" in it stands for the
+    shortest run of letters that completes the match, the same as the
+    `\\bkeyword\\b` regexes potato used to build for every keyword
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._keyword_to_index = {}
+        # the (schema, label) pairs of every keyword
+        self._labels = []
+        # the first (schema, label) of every keyword
+        self._schema_labels = []
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def add(self, keyword: str, schema: str, label: str):
+        keyword = _lower(keyword)
+        index = self._keyword_to_index.get(keyword)
+        if index is not None:
+            self._labels[index].append((schema, label))
+            return
+
+        index = len(self._labels)
+        self._keyword_to_index[keyword] = index
+        self._labels.append([(schema, label)])
+        self._schema_labels.append((schema, label))
+
+        node = self._root
+        for c in keyword:
+            if c == WILDCARD:
+                # consecutive wildcards match the same as a single one
+                if not node.is_star:
+                    if node.star is None:
+                        node.star = _Node(is_star=True)
+                    node = node.star
+                continue
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = _Node()
+            node = child
+        node.keywords.append(index)
+
+    def get_labels(self, index: int) -> List[Tuple[str, str]]:
+        return self._labels[index]
+
+    def get_schema_labels(self) -> List[Tuple[str, str]]:
+        """
+        :return: the first (schema, label) of every keyword, which must not
+          be changed
+        """
+        return self._schema_labels
+
+    @staticmethod
+    def _closure(node: _Node, active: list):
+        # a wildcard may match nothing, so entering a node also enters the
+        # wildcard nodes behind it
+        while node is not None:
+            active.append(node)
+            node = node.star
+
+    def find_keywords(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        Finds the keywords in text in one pass. Matches of the same keyword
+        never overlap, matches of different keywords may
+        :return: (start, end, keyword index) sorted by start
+        """
+        if len(self._labels) == 0 or len(text) == 0:
+            return []
+
+        lowered = _lower(text)
+        length = len(text)
+        is_word = [_is_word_char(c) for c in text]
+
+        def is_boundary(i):
+            before = i > 0 and is_word[i - 1]
+            after = i < length and is_word[i]
+            return before != after
+
+        hits = []
+        # the end of the last match of each keyword, so that matches of a
+        # keyword do not overlap
+        keyword_end = {}
+
+        for start in range(length + 1):
+            if not is_boundary(start):
+                continue
+
+            active = []
+            self._closure(self._root, active)
+            found = set()
+            i = start
+            while active:
+                if is_boundary(i):
+                    for node in active:
+                        for index in node.keywords:
+                            # the shortest match wins for every keyword
+                            if index in found or keyword_end.get(index, 0) > start:
+                                continue
+                            if i == start:
+                                # keywords made only of wildcards never match
+                                continue
+                            found.add(index)
+                            keyword_end[index] = i
+                            hits.append((start, i, index))
+                if i == length:
+                    break
+
+                c = lowered[i]
+                following = []
+                seen = set()
+                for node in active:
+                    child = node.children.get(c)
+                    if child is not None and id(child) not in seen:
+                        seen.add(id(child))
+                        self._closure(child, following)
+                    if node.is_star and c in _WILDCARD_CHARS and id(node) not in seen:
+                        seen.add(id(node))
+                        following.append(node)
+                active = following
+                i += 1
+
+        return hits
+
+    def find(self, text: str) -> List[Tuple[int, int, str, str]]:
+        """
+        :return: (start, end, schema, label) of every keyword found in text
+        """
+        return [
+            (start, end, schema, label)
+            for start, end, index in self.find_keywords(text)
+            for schema, label in self._labels[index]
+        ]
+
+
+def load_keyword_matcher(filename: str) -> KeywordMatcher:
+    """
+    Reads a keyword_highlights_file, a tsv with the columns Word, Schema and
+    Label, into a matcher
+    """
+    matcher = KeywordMatcher()
+    df = pd.read_csv(filename, sep="\t", dtype=str, keep_default_na=False)
+    for word, schema, label in df[["Word", "Schema", "Label"]].itertuples(index=False):
+        matcher.add(word, schema, label)
+
+    _logger.debug(
+        "Loaded %d keywords to map to %d labels for dynamic highlighting" % (len(matcher), len(df))
+    )
+    return matcher
+
+
+class HighlightedText:
+    """
+    The keyword highlights of one text. The markup is assembled once from
+    segments so that extra highlights can still be laid over it in a single
+    pass when a page is rendered
+    """
+
+    __slots__ = ["text", "segments", "html", "schema_labels", "words", "word_starts", "word_offsets"]
+
+    def __init__(
+        self, text: str, segments: list, schema_labels: set, words: list, word_starts: array, word_offsets: array
+    ):
+        self.text = text
+        # (start, end, opening tag, fixed markup) of each highlighted keyword,
+        # keywords split between two labels have fixed markup
+        self.segments = segments
+        self.schema_labels = schema_labels
+        # the words that may get a random highlight. The starts of the
+        # occurrences of words[i] are word_starts[word_offsets[i]:word_offsets[i + 1]]
+        self.words = words
+        self.word_starts = word_starts
+        self.word_offsets = word_offsets
+        self.html = self.render()
+
+    def get_word_spans(self, index: int) -> List[Tuple[int, int]]:
+        """
+        :return: the (start, end) of every occurrence of words[index], in
+          any case, in order
+        """
+        length = len(self.words[index])
+        starts = self.word_starts[self.word_offsets[index] : self.word_offsets[index + 1]]
+        return [(start, start + length) for start in starts]
+
+    def _render_plain(
+        self, parts: list, start: int, end: int, spans: list, span_index: int, tag: str
+    ) -> int:
+        text = self.text
+        while span_index < len(spans) and spans[span_index][0] < end:
+            span_start, span_end = spans[span_index]
+            # highlights which would cross the edge of a keyword are dropped
+            if span_start < start or span_end > end:
+                span_index += 1
+                continue
+            parts.append(text[start:span_start])
+            parts.append(tag)
+            parts.append(text[span_start:span_end])
+            parts.append("</span>")
+            start = span_end
+            span_index += 1
+        parts.append(text[start:end])
+        return span_index
+
+    def render(self, spans: list = (), color: str = None) -> str:
+        """
+        :return: the text with the keyword highlights and, nested inside
+          them, a highlight in color for each (start, end) in spans
+        """
+        tag = '<span style="background-color: %s">' % color
+        parts = []
+        last_end = 0
+        span_index = 0
+        for start, end, opening, fixed in self.segments:
+            span_index = self._render_plain(parts, last_end, start, spans, span_index, tag)
+            if fixed is not None:
+                parts.append(fixed)
+                while span_index < len(spans) and spans[span_index][0] < end:
+                    span_index += 1
+            else:
+                parts.append(opening)
+                span_index = self._render_plain(parts, start, end, spans, span_index, tag)
+                parts.append("</span>")
+            last_end = end
+        self._render_plain(parts, last_end, len(self.text), spans, span_index, tag)
+        return "".join(parts)
+
+
+def highlight_keywords(matcher: KeywordMatcher, text: str, get_color) -> HighlightedText:
+    """
+    Finds the keywords of matcher in text and prepares their markup, each
+    keyword is colored by get_color(schema, label)
+    """
+    segments = []
+    schema_labels = set()
+    last_end = 0
+    hits = sorted(matcher.find_keywords(text), key=lambda hit: (hit[0], -hit[1]))
+    for start, end, index in hits:
+        # keep the first and then longest of overlapping keywords
+        if start < last_end:
+            continue
+
+        labels = matcher.get_labels(index)
+        # Gotta make this hard somehow...
+        if len(labels) > 2:
+            continue
+
+        # we're going to replace this instance with a color coded one
+        if len(labels) == 1:
+            schema, label = labels[0]
+            schema_labels.add((schema, label))
+            opening = '<span style="background-color: %s">' % get_color(schema, label)
+            segments.append((start, end, opening, None))
+
+        # slightly harder, but just to get the MVP out
+        else:
+            matched_word = text[start:end]
+            half = int(len(matched_word) / 2)
+            fixed = []
+            for (schema, label), piece in zip(labels, [matched_word[:half], matched_word[half:]]):
+                schema_labels.add((schema, label))
+                fixed.append(
+                    '<span style="background-color: %s;">%s</span>' % (get_color(schema, label), piece)
+                )
+            segments.append((start, end, None, "".join(fixed)))
+
+        last_end = end
+
+    # a word may get a random highlight if it occurs in lower case, which
+    # then covers all of its occurrences
+    occurrences = {}
+    lower_case = set()
+    for match in _FALSE_LABEL_WORD_REGEX.finditer(text):
+        word = match.group()
+        lowered = word.lower()
+        occurrences.setdefault(lowered, []).append(match.start())
+        if word == lowered:
+            lower_case.add(lowered)
+    words = sorted(w for w in lower_case if not w.startswith("http"))
+    word_starts, word_offsets = array("I"), array("I", [0])
+    for word in words:
+        word_starts.extend(occurrences[word])
+        word_offsets.append(len(word_starts))
+    return HighlightedText(text, segments, schema_labels, words, word_starts, word_offsets)
@@ -0,0 +1,24 @@
+"""
+module: annotation
+filename: labels.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for annotation which turns the saved annotation of a
+  schema into its value. It has no dependencies on other modules, so the
+  prescreen module can use it without importing the annotation module
+"""
+
+
+def convert_labels(annotation, schema_type):
+    if schema_type == "likert":
+        return int(list(annotation.keys())[0][6:])
+    if schema_type == "radio":
+        return list(annotation.keys())[0]
+    if schema_type == "multiselect":
+        return list(annotation.keys())
+    if schema_type == 'number':
+        return float(annotation['text_box'])
+    if schema_type == 'textbox':
+        return annotation['text_box']
+    print("Unrecognized schema_type %s" % schema_type)
+    return None
@@ -11,12 +11,33 @@ from collections import defaultdict
 import logging
 from random import Random
 import re
+from threading import Lock
 import simpledorff
 import pandas as pd
+from cachetools import LRUCache
 
+from potato.flask_app.modules.annotation.agreement import get_label_tally
 from potato.flask_app.modules.annotation.color import get_color_for_schema_label
+from potato.flask_app.modules.annotation.highlight import (
+    DEFAULT_HIGHLIGHT_CACHE_SIZE,
+    KeywordMatcher,
+    highlight_keywords,
+)
+from potato.flask_app.modules.annotation.labels import convert_labels
 from potato.flask_app.modules.prescreen.module import check_prestudy_status
-from potato.flask_app.modules.project.task import assign_instances_to_user
+from potato.flask_app.modules.project.leases import renew_lease
+from potato.flask_app.modules.project.locks import user_lock
+from potato.flask_app.modules.project.statistics import (
+    checked,
+    get_user_statistics,
+    update_user_statistics,
+)
+from potato.flask_app.modules.project.task import (
+    assign_instances_to_user,
+    get_assigned_users,
+    request_extra_label,
+    stop_labeling,
+)
 from potato.server_utils.config_utils import config
 from potato.server_utils.module_utils import Module, module_getter
 
@@ -25,7 +46,14 @@ _random = Random()
 _init_tag_regex = re.compile(r"(<span.+?>)")
 _end_tag_regex = re.compile(r"(</span>)")
 _anno_regex = re.compile(r'<div class="span_label".+?>(.+)</div>')
-_re_to_highlights = defaultdict(list)
+_keyword_matcher = KeywordMatcher()
+_keyword_matcher_version = 0
+_highlight_cache = LRUCache(maxsize=DEFAULT_HIGHLIGHT_CACHE_SIZE)
+_highlight_cache_lock = Lock()
+
+DEFAULT_MIN_AGREEING_LABELS = 2
+# the schema types whose labels can be compared between annotators
+AGREEMENT_SCHEMA_TYPES = ["radio", "likert", "multiselect", "number"]
 
 @module_getter
 def _get_module():
@@ -40,12 +68,16 @@ class AnnotationConfiguration:
     output_annotation_dir: str = ""
     output_annotation_format: str = ""
     annotation_schemes: list[str] = ""
+    highlight_cache_size: int = DEFAULT_HIGHLIGHT_CACHE_SIZE
 
 def start():
+    global _highlight_cache
+
     if AnnotationConfiguration.debug:
         _random.seed(0)
     else:
         _random.seed()
+    _highlight_cache = LRUCache(maxsize=AnnotationConfiguration.highlight_cache_size)
 
 def map_user_id_to_digit(user_id_str):
     # Convert the user_id_str to an integer using a hash function
@@ -150,88 +182,40 @@ def parse_html_span_annotation(html_span_annotation):
     return no_html_s, annotations
 
 
-def post_process(config, text):
-    global schema_label_to_color
-
-    schema_labels_to_highlight = set()
-
-    all_words = list(set(re.findall(r"\b[a-z]{4,}\b", text)))
-    all_words = [w for w in all_words if not w.startswith("http")]
-    _random.shuffle(all_words)
-
-    all_schemas = list([x[0] for x in _re_to_highlights.values()])
-
-    # Grab the highlights
-    for regex, labels in _re_to_highlights.items():
-
-        search_from = 0
-
-        regex = re.compile(regex, re.I)
-
-        while True:
-            try:
-                match = regex.search(text, search_from)
-            except BaseException as e:
-                print(repr(e))
-                break
-
-            if match is None:
-                break
-
-            start = match.start()
-            end = match.end()
-
-            # we're going to replace this instance with a color coded one
-            if len(labels) == 1:
-                schema, label = labels[0]
-
-                schema_labels_to_highlight.add((schema, label))
-
-                c = get_color_for_schema_label(schema, label)
-
-                pre = '<span style="background-color: %s">' % c
-
-                replacement = pre + match.group() + "</span>"
-
-                text = text[:start] + replacement + text[end:]
-
-                # Be sure to count all the junk we just added when searching again
-                search_from += end + (len(replacement) - len(match.group()))
-
-            # slightly harder, but just to get the MVP out
-            elif len(labels) == 2:
-
-                colors = []
-
-                for schema, label in labels:
-                    schema_labels_to_highlight.add((schema, label))
-                    c = get_color_for_schema_label(schema, label)
-                    colors.append(c)
-
-                matched_word = match.group()
-
-                first_half = matched_word[: int(len(matched_word) / 2)]
-                last_half = matched_word[int(len(matched_word) / 2) :]
+def set_keyword_matcher(matcher: KeywordMatcher):
+    """
+    Sets the keywords highlighted by post_process
+    """
+    global _keyword_matcher
+    global _keyword_matcher_version
+    _keyword_matcher = matcher
+    _keyword_matcher_version += 1
 
-                pre = '<span style="background-color: %s;">'
 
-                replacement = (
-                    (pre % colors[0])
-                    + first_half
-                    + "</span>"
-                    + (pre % colors[1])
-                    + last_half
-                    + "</span>"
-                )
+def _get_highlighted_text(text, instance_id):
+    if instance_id is None:
+        return highlight_keywords(_keyword_matcher, text, get_color_for_schema_label)
 
-                text = text[:start] + replacement + text[end:]
+    key = (instance_id, _keyword_matcher_version)
+    with _highlight_cache_lock:
+        highlighted = _highlight_cache.get(key)
+    # the text differs when the user has annotated spans in it
+    if highlighted is None or highlighted.text != text:
+        highlighted = highlight_keywords(_keyword_matcher, text, get_color_for_schema_label)
+        with _highlight_cache_lock:
+            _highlight_cache[key] = highlighted
+    return highlighted
 
-                # Be sure to count all the junk we just added when searching again
-                search_from += end + (len(replacement) - len(matched_word))
 
-            # Gotta make this hard somehow...
-            else:
-                search_from = end
+def post_process(config, text, instance_id=None):
+    """
+    Highlights the keywords of the keyword_highlights_file in text. The
+    highlights of an instance are only computed once, the random highlights
+    are added on every call
+    :return: the html and the (schema, label) pairs highlighted in it
+    """
+    highlighted = _get_highlighted_text(text, instance_id)
+    schema_labels_to_highlight = set(highlighted.schema_labels)
 
     # Pick a few random words to highlight
     #
@@ -239,53 +223,36 @@ def post_process(config, text):
     # and wrongly flag a valid word, this coloring is embedded within the outer
     # (correct) <span> tag, so the word will get labeled correctly
     num_false_labels = _random.randint(0, 1)
+    if num_false_labels == 0 or len(highlighted.words) == 0:
+        return highlighted.html, schema_labels_to_highlight
 
-    for i in range(min(num_false_labels, len(all_words))):
-
-        # Pick a random word
-        to_highlight = all_words[i]
-
-        # Pick a random schema and label
-        schema, label = _random.choice(all_schemas)
-        schema_labels_to_highlight.add((schema, label))
-
-        # Figure out where this word occurs
-        c = get_color_for_schema_label(schema, label)
-
-        search_from = 0
-        regex = r"\b" + to_highlight + r"\b"
-        regex = re.compile(regex, re.I)
-
-        while True:
-            try:
-                match = regex.search(text, search_from)
-            except BaseException as e:
-                print(repr(e))
-                break
-            if match is None:
-                break
-
-            start = match.start()
-            end = match.end()
-
-            pre = '<span style="background-color: %s">' % c
+    # Pick a random word
+    word_index = _random.randrange(len(highlighted.words))
 
-            replacement = pre + match.group() + "</span>"
-            text = text[:start] + replacement + text[end:]
+    # Pick a random schema and label
+    schema, label = _random.choice(_keyword_matcher.get_schema_labels())
+    schema_labels_to_highlight.add((schema, label))
+    c = get_color_for_schema_label(schema, label)
 
-            # Be sure to count all the junk we just added when searching again
-            search_from += end + (len(replacement) - len(match.group()))
+    # where the word occurs was found along with the keywords
+    spans = highlighted.get_word_spans(word_index)
 
-    return text, schema_labels_to_highlight
+    return highlighted.render(spans, c), schema_labels_to_highlight
 
 def get_total_annotations():
     """
     Returns the total number of unique annotations done across all users.
     """
+    return checked(
+        "annotations", get_user_statistics().total_annotations, _count_total_annotations
+    )
+
+
+def _count_total_annotations():
     total = 0
     for username in get_users():
         user_state = lookup_user_state(username)
-        total += user_state.get_real_finished_instance_count()
+        total += user_state.count_real_finished_instances()
 
     return total
 
@@ -295,6 +262,15 @@ def update_annotation_state(username, form, instance_id: int):
     Parses the state of the HTML form (what the user did to the instance) and
     updates the state of the instance's annotations accordingly.
     """
+    # every submission keeps the user's assigned instances leased to them
+    renew_lease(username)
+
+    # two submissions of the same user must not interleave
+    with user_lock(username):
+        return _update_annotation_state(username, form, instance_id)
+
+
+def _update_annotation_state(username, form, instance_id: int):
 
     # Get what the user has already annotated, which might include this instance too
     user_state = lookup_user_state(username)
@@ -361,8 +337,100 @@ def update_annotation_state(username, form, instance_id: int):
         if re.search("prestudy", instance_id):
             _logger.debug(check_prestudy_status(username))
 
+        update_user_statistics(username, user_state)
+
+        if is_agreement_stopping() and _is_core_instance(instance_id):
+            _tally_agreement_label(username, user_state, instance_id)
+            check_agreement(instance_id)
+
     return did_change
 
+
+def is_agreement_stopping():
+    return (
+        "automatic_assignment" in config
+        and config["automatic_assignment"]["on"]
+        and config["automatic_assignment"].get("agreement_stopping", {}).get("on", False)
+    )
+
+
+def _is_core_instance(instance_id):
+    return not (
+        instance_id[-4:] == "html"
+        or re.search("prestudy", instance_id)
+        or re.search("consent", instance_id)
+        or re.search("testing", instance_id)
+    )
+
+
+def _get_agreement_label(labeling):
+    """
+    :return: the comparable labels of one annotation as a hashable value, or
+      None if it has no value for any comparable schema
+    """
+    values = []
+    for schema in AnnotationConfiguration.annotation_schemes:
+        if schema["annotation_type"] not in AGREEMENT_SCHEMA_TYPES:
+            continue
+        if schema["name"] not in labeling:
+            values.append(None)
+            continue
+        value = convert_labels(labeling[schema["name"]], schema["annotation_type"])
+        values.append(tuple(sorted(value)) if type(value) == list else value)
+    # an annotation without comparable labels agrees with nothing
+    if all(value is None for value in values):
+        return None
+    return tuple(values)
+
+
+def _tally_agreement_label(username, user_state, instance_id):
+    labeling = user_state.instance_id_to_labeling.get(instance_id)
+    # a label of None leaves the user out of the tally
+    get_label_tally().set_label(
+        instance_id, username, None if labeling is None else _get_agreement_label(labeling)
+    )
+
+
+def tally_agreement_labels(username, user_state):
+    """
+    Adds the labels of a user whose state was just loaded to the label tally
+    of agreement_stopping
+    """
+    if not is_agreement_stopping():
+        return
+    for instance_id in list(user_state.instance_id_to_labeling):
+        if _is_core_instance(instance_id):
+            _tally_agreement_label(username, user_state, instance_id)
+
+
+def check_agreement(instance_id):
+    """
+    Compares the labels of the annotators of an instance after one of them
+    submitted. Once the first min_agreeing_labels labels agree, the instance
+    needs no more labels. If no label has a majority, the instance gets one
+    more label from those freed by instances which agreed early. The labels
+    are read from the label tally, so no other annotator is looked up
+    """
+    agreement_config = config["automatic_assignment"]["agreement_stopping"]
+    min_agreeing_labels = agreement_config.get("min_agreeing_labels", DEFAULT_MIN_AGREEING_LABELS)
+    labels_per_instance = config["automatic_assignment"].get("labels_per_instance", 3)
+    max_labels = agreement_config.get("max_labels_per_instance", labels_per_instance + 2)
+
+    labels = get_label_tally().count(instance_id, get_assigned_users(instance_id))
+
+    label_count = sum(labels.values())
+    if label_count < 2:
+        return
+
+    top_count = labels.most_common(1)[0][1]
+    if len(labels) == 1 and label_count >= min_agreeing_labels:
+        freed = stop_labeling(instance_id)
+        if freed > 0:
+            _logger.debug("%d annotators agree on %s, freed %d labels" % (label_count, instance_id, freed))
+    elif top_count * 2 <= label_count:
+        if request_extra_label(instance_id, max_labels):
+            _logger.debug("No majority label for %s yet, asking for one more label" % instance_id)
+
 def get_annotations_for_user_on(username, instance_id):
     """
     Returns the label-based annotations made by this user on the instance.
@@ -400,7 +468,7 @@ def save_all_annotations():
     # We write jsonl format regardless
     if fmt in ["json", "jsonl"]:
         with open(annotated_instances_fname, "wt") as outf:
-            for user_id, user_state in user_to_annotation_state.items():
+            for user_id, user_state in list(user_to_annotation_state.items()):
                 for inst_id, data in user_state.get_all_annotations().items():
 
                     bd_dict = user_state.instance_id_to_behavioral_data.get(inst_id, {})
@@ -425,7 +493,7 @@ def save_all_annotations():
         schema_to_labels = defaultdict(set)
         span_labels = set()
 
-        for user_state in user_to_annotation_state.values():
+        for user_state in list(user_to_annotation_state.values()):
             for annotations in user_state.get_all_annotations().values():
                 # Columns for each label-based annotation
                 for schema, label_vals in annotations["labels"].items():
@@ -439,7 +507,7 @@ def save_all_annotations():
                 # TODO: figure out what's in the behavioral dict and how to format it
 
         # Loop 2, report everything that's been annotated
-        for user_id, user_state in user_to_annotation_state.items():
+        for user_id, user_state in list(user_to_annotation_state.items()):
             for inst_id, annotations in user_state.get_all_annotations().items():
 
                 df["user"].append(user_id)
@@ -475,21 +543,6 @@ def save_all_annotations():
         df.to_csv(annotated_instances_fname, index=False, sep=sep)
 
 
-def convert_labels(annotation, schema_type):
-    if schema_type == "likert":
-        return int(list(annotation.keys())[0][6:])
-    if schema_type == "radio":
-        return list(annotation.keys())[0]
-    if schema_type == "multiselect":
-        return list(annotation.keys())
-    if schema_type == 'number':
-        return float(annotation['text_box'])
-    if schema_type == 'textbox':
-        return annotation['text_box']
-    print("Unrecognized schema_type %s" % schema_type)
-    return None
-
-
 def get_agreement_score(user_list, schema_name, return_type="overall_average"):
     """
     Get the final agreement score for selected users and schemas.
@@ -10,7 +10,7 @@ desc: Defines the workings of the data for the prescreener,
 import logging
 from random import Random
 
-from potato.flask_app.modules.annotation.module import convert_labels
+from potato.flask_app.modules.annotation.labels import convert_labels
 from potato.flask_app.modules.project.task import assign_instances_to_user
 from potato.server_utils.config_utils import config
 from potato.server_utils.module_utils import Module, module_getter
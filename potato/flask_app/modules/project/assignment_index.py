@@ -0,0 +1,207 @@
+"""
+module: project
+filename: assignment_index.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module with the compact in-memory form
+  of task_assignment["assigned"]. Instance ids and usernames are interned
+  as integers and the annotators of every instance are kept in flat arrays
+  (compressed sparse rows) instead of a dict of lists of strings. It still
+  reads and serializes like the dict it replaces
+"""
+
+from array import array
+from collections.abc import MutableMapping
+from typing import Hashable, Iterable, List, Optional
+
+# instances changed since the arrays were last rebuilt, as a fraction of all
+REBUILD_FRACTION = 0.25
+MIN_REBUILD_CHANGES = 1024
+
+
+class InstanceIds:
+    """
+    Interns ids as consecutive integers, in the order they are first seen
+    """
+
+    def __init__(self, ids: Iterable[Hashable] = ()):
+        self._ids = []
+        self._index = {}
+        for key in ids:
+            self.intern(key)
+
+    def intern(self, key: Hashable) -> int:
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = len(self._ids)
+            self._ids.append(key)
+        return index
+
+    def lookup(self, key: Hashable) -> int:
+        """
+        :return: the integer of an id or -1 if it was never interned
+        """
+        return self._index.get(key, -1)
+
+    def __getitem__(self, index: int) -> Hashable:
+        return self._ids[index]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+
+class AssignedIndex(MutableMapping):
+    """
+    The users each instance is assigned to. Looking up an instance returns
+    a new list of usernames, use add_user() and remove_user() to change it.
+    Ids mapped to anything but a list (the survey pages are mapped to 0)
+    are kept as they are
+    """
+
+    def __init__(self, ids: Optional[InstanceIds] = None, assigned=()):
+        self._ids = InstanceIds() if ids is None else ids
+        self._users = InstanceIds()
+
+        # annotators of instance i are _annotators[_offsets[i]:_offsets[i + 1]]
+        # unless the instance changed since the last rebuild
+        self._offsets = array("q", [0])
+        self._annotators = array("i")
+        self._changed = {}
+        # whether instance i is in the mapping
+        self._present = bytearray()
+        self._size = 0
+        self._other = {}
+
+        items = assigned.items() if hasattr(assigned, "items") else assigned
+        for key, value in items:
+            self[key] = value
+        self._rebuild()
+
+    def _ensure(self, index: int):
+        if index >= len(self._present):
+            self._present.extend(bytes(index + 1 - len(self._present)))
+
+    def _get_annotators(self, index: int) -> array:
+        annotators = self._changed.get(index)
+        if annotators is not None:
+            return annotators
+        if index + 1 < len(self._offsets):
+            return self._annotators[self._offsets[index] : self._offsets[index + 1]]
+        return array("i")
+
+    def _set_annotators(self, index: int, annotators: array):
+        self._ensure(index)
+        if not self._present[index]:
+            self._present[index] = 1
+            self._size += 1
+        self._changed[index] = annotators
+        if len(self._changed) > max(MIN_REBUILD_CHANGES, self._size * REBUILD_FRACTION):
+            self._rebuild()
+
+    def _rebuild(self):
+        """
+        Writes the changed instances back into the flat arrays
+        """
+        offsets = array("q", [0])
+        annotators = array("i")
+        for index in range(len(self._present)):
+            if self._present[index]:
+                annotators.extend(self._get_annotators(index))
+            offsets.append(len(annotators))
+        self._offsets = offsets
+        self._annotators = annotators
+        self._changed = {}
+
+    def add_user(self, key: Hashable, username: str):
+        index = self._ids.intern(key)
+        user = self._users.intern(username)
+        annotators = self._changed.get(index)
+        # instances changed since the last rebuild are changed in place
+        if annotators is not None and self._present[index]:
+            annotators.append(user)
+            return
+        annotators = array("i", self._get_annotators(index))
+        annotators.append(user)
+        self._set_annotators(index, annotators)
+
+    def remove_user(self, key: Hashable, username: str):
+        index = self._ids.lookup(key)
+        user = self._users.lookup(username)
+        if index < 0 or user < 0 or index >= len(self._present) or not self._present[index]:
+            return
+        annotators = array("i", self._get_annotators(index))
+        if user in annotators:
+            annotators.remove(user)
+            self._set_annotators(index, annotators)
+
+    def get_user_count(self, key: Hashable) -> int:
+        """
+        :return: the number of users an instance is assigned to
+        """
+        index = self._ids.lookup(key)
+        if index < 0 or index >= len(self._present) or not self._present[index]:
+            return 0
+        return len(self._get_annotators(index))
+
+    def __getitem__(self, key: Hashable):
+        if key in self._other:
+            return self._other[key]
+        index = self._ids.lookup(key)
+        if index < 0 or index >= len(self._present) or not self._present[index]:
+            raise KeyError(key)
+        return [self._users[user] for user in self._get_annotators(index)]
+
+    def __setitem__(self, key: Hashable, value):
+        if type(value) != list:
+            if key not in self._other:
+                self._remove(key)
+                self._size += 1
+            self._other[key] = value
+            return
+        if self._other.pop(key, None) is not None:
+            self._size -= 1
+        index = self._ids.intern(key)
+        self._set_annotators(index, array("i", [self._users.intern(username) for username in value]))
+
+    def _remove(self, key: Hashable) -> bool:
+        index = self._ids.lookup(key)
+        if index < 0 or index >= len(self._present) or not self._present[index]:
+            return False
+        self._present[index] = 0
+        self._size -= 1
+        self._changed[index] = array("i")
+        return True
+
+    def __delitem__(self, key: Hashable):
+        if key in self._other:
+            del self._other[key]
+            self._size -= 1
+        elif not self._remove(key):
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        if key in self._other:
+            return True
+        index = self._ids.lookup(key)
+        return 0 <= index < len(self._present) and self._present[index] == 1
+
+    def __iter__(self):
+        yield from list(self._other)
+        for index in range(len(self._present)):
+            if self._present[index]:
+                yield self._ids[index]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __reduce__(self):
+        return (self.__class__, (None, list(self.items())))
+
+    def get_users(self) -> List[str]:
+        """
+        :return: every user any instance was ever assigned to
+        """
+        return list(self._users)
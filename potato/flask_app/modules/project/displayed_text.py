@@ -0,0 +1,142 @@
+"""
+module: project
+filename: displayed_text.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module which turns the text of an
+  instance into the html shown to annotators. The formatting for a
+  `list_as_text` configuration is prepared once and the results are
+  cached per instance
+"""
+
+import ast
+import logging
+from random import Random
+import sys
+from string import ascii_uppercase
+from threading import Lock
+from typing import Any, Callable, Optional
+
+from cachetools import LRUCache
+
+_logger = logging.getLogger("DisplayedText")
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+_HORIZONTAL_ROW = '<div class="row" style="display: table"> %s </div>'
+_HORIZONTAL_COLUMN = (
+    '<div name="instance_text" style="float:left;width:%s;padding:5px;" class="column">'
+    + " <legend> %s </legend> %s </div>"
+)
+_VERTICAL_BLOCK = '<div name="instance_text"> <legend> %s </legend> %s <br/> </div>'
+
+
+def _parse_literal(text: str):
+    """
+    Parses a list or dict written as a python literal, e.g. "['a', 'b']".
+    Anything else is returned as it was
+    """
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return text
+    return value if isinstance(value, (list, dict)) else text
+
+
+def build_formatter(list_as_text: Optional[dict]) -> Callable[[Any, Random], Any]:
+    """
+    Prepares the function formatting the text of an instance for a
+    `list_as_text` configuration. The returned function takes the text
+    and the Random used for any randomization
+    """
+    if not list_as_text:
+        return lambda text, random: text
+
+    prefix_type = list_as_text.get("text_list_prefix_type")
+    if prefix_type == "alphabet":
+        prefix = lambda i: ascii_uppercase[i] + ". "
+    elif prefix_type == "number":
+        prefix = lambda i: str(i) + ". "
+    else:
+        prefix = None
+
+    randomization = list_as_text.get("randomization")
+    if randomization is not None and randomization not in ["value", "key"]:
+        _logger.warning(
+            "%s currently not supported for list_as_text, please check your .yaml file"
+            % randomization
+        )
+        randomization = None
+
+    horizontal = bool(list_as_text.get("horizontal"))
+
+    def format_list(text):
+        if prefix is not None:
+            text = [prefix(i) + item for i, item in enumerate(text)]
+        return "<br>".join(text)
+
+    def format_dict(text, random):
+        # randomize the order of the displayed text
+        if randomization == "value":
+            values = list(text.values())
+            random.shuffle(values)
+            text = dict(zip(text.keys(), values))
+        elif randomization == "key":
+            keys = list(text.keys())
+            random.shuffle(keys)
+            text = {key: text[key] for key in keys}
+
+        if horizontal:
+            width = "%d%%" % int(100 / max(len(text), 1))
+            return _HORIZONTAL_ROW % "".join(
+                _HORIZONTAL_COLUMN % (width, key, value) for key, value in text.items()
+            )
+        return "".join(_VERTICAL_BLOCK % (key, value) for key, value in text.items())
+
+    def format_text(text, random):
+        # automatically unfold the text list when input text is a list (e.g. best-worst-scaling).
+        parsed = _parse_literal(text) if isinstance(text, str) else text
+        if isinstance(parsed, list):
+            return format_list(parsed)
+        # unfolding dict into different sections
+        if isinstance(parsed, dict):
+            return format_dict(parsed, random)
+        return text
+
+    return format_text
+
+
+class DisplayedTextCache:
+    """
+    A cache of the displayed text of each instance, bounded by the
+    approximate number of bytes it holds.
+
+    Randomization is seeded by the instance id so an instance looks the same
+    however often it is formatted. The cache may be shared between threads
+    """
+
+    def __init__(self, formatter: Callable[[Any, Random], Any], salt: str, max_bytes: int):
+        self._formatter = formatter
+        self._salt = salt
+        self._max_bytes = max_bytes
+        self._cache = LRUCache(maxsize=max_bytes, getsizeof=self._getsizeof)
+        self._lock = Lock()
+
+    @staticmethod
+    def _getsizeof(entry) -> int:
+        text, displayed_text = entry
+        return sys.getsizeof(text) + sys.getsizeof(displayed_text)
+
+    def get(self, instance_id, text):
+        with self._lock:
+            entry = self._cache.get(instance_id)
+        if entry is not None and entry[0] == text:
+            return entry[1]
+
+        displayed_text = self._formatter(text, Random("%s:%s" % (self._salt, instance_id)))
+
+        entry = (text, displayed_text)
+        if self._getsizeof(entry) <= self._max_bytes:
+            with self._lock:
+                self._cache[instance_id] = entry
+        return displayed_text
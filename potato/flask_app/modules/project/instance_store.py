@@ -0,0 +1,736 @@
+"""
+module: project
+filename: instance_store.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Defines the store holding every instance of the project. Data
+  files are indexed once by byte offset and memory-mapped so that an
+  instance is only decoded when the server actually touches it
+"""
+
+from array import array
+import bz2
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import csv
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import os.path
+from threading import RLock
+from typing import Any, Callable, Optional
+import zlib
+
+from cachetools import LRUCache
+import pandas as pd
+
+_logger = logging.getLogger("InstanceStore")
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CHUNK_SIZE = 100000
+
+# Marks an instance which is held in memory rather than indexed on disk
+_RESIDENT_ROW = -1
+
+# file extension -> the name pandas uses for the compression
+COMPRESSIONS = {"gz": "gzip", "bz2": "bz2", "zst": "zstd"}
+# the lines of compressed jsonl files are kept in blocks of about this size
+DEFAULT_BLOCK_SIZE = 65536
+
+
+def _open_compressed(filename: str, compression: str):
+    """
+    Opens a compressed file as a buffered binary stream which is
+    decompressed as it is read
+    """
+    if compression == "gz":
+        return gzip.open(filename, "rb")
+    if compression == "bz2":
+        return bz2.open(filename, "rb")
+
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("Reading %s requires zstandard, please `pip install zstandard`" % filename)
+    reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+    return io.BufferedReader(reader)
+
+
+def _read_arrow_schema(filename: str, fmt: str):
+    """
+    Reads the schema of a parquet or arrow/feather file from its footer
+    without reading any of its columns
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == "parquet":
+        return pq.read_schema(filename)
+    try:
+        with pa.memory_map(filename) as source:
+            return pa.ipc.open_file(source).schema
+    except pa.ArrowInvalid:
+        # feather v1 files are not arrow ipc files and have to be mapped whole
+        import pyarrow.feather as feather
+
+        return feather.read_table(filename, memory_map=True).schema
+
+
+def _complete_csv_records(data: bytes, quotechar: bytes = b'"') -> int:
+    """
+    :return: the length of the complete csv records at the start of data. A
+      record ends at a line break outside of quotes, a line break inside a
+      quoted field belongs to the field
+    """
+    end = 0
+    offset = 0
+    # the parts between quote characters alternate between outside and
+    # inside of quotes, escaped quotes ("") leave an empty part inside
+    for i, part in enumerate(data.split(quotechar)):
+        if i % 2 == 0:
+            line_break = part.rfind(b"\n")
+            if line_break != -1:
+                end = offset + line_break + 1
+        offset += len(part) + len(quotechar)
+    return end
+
+
+class _JsonLinesSource:
+    """
+    A memory-mapped jsonl file whose lines are decoded on request
+    """
+
+    def __init__(self, filename: str, id_key: str, appendable: bool = True):
+        self.filename = filename
+        self.id_key = id_key
+        # whether lines appended to the file should be picked up
+        self.appendable = appendable
+        # the end of the last line that has been indexed
+        self.indexed_size = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filename, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self._map = b""
+
+    def __getstate__(self):
+        return {
+            "filename": self.filename,
+            "id_key": self.id_key,
+            "appendable": self.appendable,
+            "indexed_size": self.indexed_size,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def lines(self, offset: int = 0, complete_only: bool = False):
+        """
+        Yields the (offset, length) of every non-blank line in the file
+        :complete_only: skip a last line which has no line break yet, e.g.
+          because it is still being written
+        """
+        size = len(self._map)
+        while offset < size:
+            end = self._map.find(b"\n", offset)
+            if end == -1:
+                if complete_only:
+                    break
+                end = size
+            if self._map[offset:end].strip():
+                yield offset, end - offset
+            offset = end + 1
+            self.indexed_size = min(offset, size)
+
+    def read_appended(self) -> list:
+        """
+        Indexes the complete lines appended to the file since it was last read
+        :return: a list of (instance id, offset, length)
+        """
+        if not self.appendable or os.path.getsize(self.filename) <= self.indexed_size:
+            return []
+
+        # a request still reading from the previous map retries on the new one
+        previous_file, previous_map = self._file, self._map
+        self._open()
+        if isinstance(previous_map, mmap.mmap):
+            previous_map.close()
+        previous_file.close()
+        return [
+            (self.decode(offset, length)[self.id_key], offset, length)
+            for offset, length in self.lines(self.indexed_size, complete_only=True)
+        ]
+
+    def decode(self, offset: int, length: int) -> dict:
+        while True:
+            current = self._map
+            try:
+                data = current[offset : offset + length]
+                break
+            except ValueError:
+                # the map was closed by read_appended after mapping the file again
+                if current is self._map:
+                    raise
+        return json.loads(data)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class _CompressedJsonLinesSource:
+    """
+    The lines of a compressed jsonl file, compressed again in blocks of
+    about DEFAULT_BLOCK_SIZE bytes which are held in memory. Unlike the
+    file itself a block can be decompressed on its own, so a line is
+    decoded without decompressing the file up to it or keeping a
+    decompressed copy. The offset of a line is its block in the upper 32
+    bits and its offset in the block in the lower ones
+    """
+
+    def __init__(self, id_key: str):
+        self.id_key = id_key
+        self.blocks = []
+        # the last block decompressed, as (block, data)
+        self._last = (-1, b"")
+
+    def __getstate__(self):
+        return {"id_key": self.id_key, "blocks": self.blocks}
+
+    def __setstate__(self, state):
+        self.__init__(state["id_key"])
+        self.blocks = state["blocks"]
+
+    def add_block(self, data: bytes) -> int:
+        """
+        :return: the offset of the start of the block
+        """
+        self.blocks.append(zlib.compress(data, 1))
+        return (len(self.blocks) - 1) << 32
+
+    def read_appended(self) -> list:
+        return []
+
+    def decode(self, offset: int, length: int) -> dict:
+        block, start = offset >> 32, offset & 0xFFFFFFFF
+        last_block, data = self._last
+        if last_block != block:
+            data = zlib.decompress(self.blocks[block])
+            self._last = (block, data)
+        return json.loads(data[start : start + length])
+
+    def close(self):
+        pass
+
+
+class _RecordsSource:
+    """
+    Rows of a table (e.g. a csv file) held as tuples which are only turned
+    into dicts on request
+    """
+
+    def __init__(self, columns: tuple, id_key: str, read_kwargs: Optional[dict] = None):
+        self.columns = columns
+        self.id_key = id_key
+        self.rows = []
+
+        # how to read rows appended to an uncompressed csv file, see
+        # `read_appended`
+        self.filename = None
+        self.header = None
+        self.read_kwargs = read_kwargs
+        self.indexed_size = 0
+
+    def append(self, row: tuple) -> int:
+        self.rows.append(row)
+        return len(self.rows) - 1
+
+    def read_appended(self) -> list:
+        """
+        Reads the complete rows appended to the csv file since it was last read
+        :return: a list of (instance id, row, 0)
+        """
+        if self.filename is None or os.path.getsize(self.filename) <= self.indexed_size:
+            return []
+
+        with open(self.filename, "rb") as f:
+            f.seek(self.indexed_size)
+            data = f.read()
+        # a record still being written, or a quoted field with a line break
+        # that was only written in part, is read the next time
+        data = data[: _complete_csv_records(data)]
+        if not data.strip():
+            return []
+
+        try:
+            # pandas takes the extra fields of a row for its index instead of failing
+            for record in csv.reader(io.StringIO(data.decode("utf-8")), delimiter=self.read_kwargs["sep"]):
+                if len(record) > 0 and len(record) != len(self.header):
+                    raise ValueError("a row has %d fields instead of %d" % (len(record), len(self.header)))
+            df = pd.read_csv(io.BytesIO(data), header=None, names=self.header, **self.read_kwargs)
+        except (ValueError, pd.errors.ParserError) as e:
+            # the rows are read again once the file is fixed
+            _logger.warning("Could not read the rows appended to %s: %s" % (self.filename, repr(e)))
+            return []
+        self.indexed_size += len(data)
+
+        id_pos = self.columns.index(self.id_key)
+        return [
+            (row[id_pos], self.append(row), 0)
+            for row in df[list(self.columns)].itertuples(index=False, name=None)
+        ]
+
+    def decode(self, offset: int, length: int) -> dict:
+        return dict(zip(self.columns, self.rows[offset]))
+
+    def close(self):
+        pass
+
+
+class _ArrowSource:
+    """
+    A parquet or arrow/feather file read as a (memory-mapped) Arrow table.
+    Only the requested columns are read and a row is only converted to a
+    dict on request
+    """
+
+    def __init__(self, filename: str, fmt: str, id_key: str, columns: Optional[list] = None):
+        self.filename = filename
+        self.fmt = fmt
+        self.id_key = id_key
+        self.columns = columns
+        self._open()
+
+    def _open(self):
+        try:
+            import pyarrow.feather as feather
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception(
+                "Reading %s requires pyarrow, please `pip install pyarrow`" % self.filename
+            )
+
+        if self.fmt == "parquet":
+            self.table = pq.read_table(self.filename, columns=self.columns, memory_map=True)
+        else:
+            self.table = feather.read_table(self.filename, columns=self.columns, memory_map=True)
+
+    def __getstate__(self):
+        return {"filename": self.filename, "fmt": self.fmt, "id_key": self.id_key, "columns": self.columns}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], state["fmt"], state["id_key"], state["columns"])
+
+    def ids(self) -> list:
+        """
+        :return: the ids of all rows as strings, like the ids read from csv files
+        """
+        return [str(instance_id) for instance_id in self.table.column(self.id_key).to_pylist()]
+
+    def decode(self, offset: int, length: int) -> dict:
+        item = self.table.slice(offset, 1).to_pylist()[0]
+        item[self.id_key] = str(item[self.id_key])
+        return item
+
+    def close(self):
+        self.table = None
+
+
+class InstanceStore(MutableMapping):
+    """
+    An ordered mapping of instance id to instance which behaves like the
+    OrderedDict the project used to keep, including `move_to_end`.
+
+    Instances read from data files are only indexed as
+    id -> (file, byte offset, length) and decoded on access. A bounded LRU
+    keeps the most recently decoded instances around so that repeated page
+    views do not re-parse the same line. Instances set directly (survey
+    pages, test questions, ...) are held in memory.
+
+    NOTE: changes made to a decoded instance are lost once it is evicted
+    from the LRU. Assign the instance back into the store to keep them.
+
+    The store can be read and appended to from several threads, decoding
+    happens outside of its lock.
+    """
+
+    def __init__(
+        self,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        decorate: Optional[Callable[[Any, dict], None]] = None,
+    ):
+        # instance id -> row in the index arrays, kept in the data order
+        self._order = OrderedDict()
+
+        self._sources = []
+        self._row_source = array("I")
+        self._row_offset = array("q")
+        self._row_length = array("q")
+
+        self._resident = {}
+        self._cache = LRUCache(maxsize=cache_size)
+
+        # called on every instance once it is decoded or inserted
+        self._decorate = decorate
+
+        # ids which appeared more than once in the data files
+        self.duplicate_ids = []
+
+        self._lock = RLock()
+
+    def configure(self, cache_size: int, decorate: Optional[Callable[[Any, dict], None]]):
+        """
+        Sets the cache size and decoration hook, e.g. after loading a snapshot
+        """
+        self._cache = LRUCache(maxsize=cache_size)
+        self._decorate = decorate
+
+    def __getstate__(self):
+        # the decoded cache and the hook are runtime only, see `configure`
+        return {
+            "ids": list(self._order.keys()),
+            "rows": array("q", self._order.values()),
+            "sources": self._sources,
+            "row_source": self._row_source,
+            "row_offset": self._row_offset,
+            "row_length": self._row_length,
+            "resident": self._resident,
+            "duplicate_ids": self.duplicate_ids,
+        }
+
+    def __setstate__(self, state):
+        self._order = OrderedDict(zip(state["ids"], state["rows"]))
+        self._sources = state["sources"]
+        self._row_source = state["row_source"]
+        self._row_offset = state["row_offset"]
+        self._row_length = state["row_length"]
+        self._resident = state["resident"]
+        self.duplicate_ids = state["duplicate_ids"]
+        self._lock = RLock()
+        self.configure(DEFAULT_CACHE_SIZE, None)
+
+    def add_data_file(
+        self,
+        filename: str,
+        fmt: str,
+        id_key: str,
+        text_key: str,
+        usecols: Optional[set] = None,
+        chunksize: int = DEFAULT_CHUNK_SIZE,
+        engine: str = "c",
+        compression: Optional[str] = None,
+    ) -> int:
+        """
+        Reads a data file of any supported format into the store
+        :compression: the extension of a compressed file (see COMPRESSIONS)
+        :return: the number of instances read from the file
+        """
+        if fmt in ["json", "jsonl"] and compression is not None:
+            return self.add_compressed_jsonl_file(filename, compression, id_key)
+
+        if fmt in ["json", "jsonl"]:
+            return self.add_jsonl_file(filename, id_key)
+
+        if fmt in ["parquet", "arrow", "feather"]:
+            return self.add_arrow_file(filename, fmt, id_key, usecols=usecols)
+
+        sep = "," if fmt == "csv" else "\t"
+        return self.add_csv_file(
+            filename,
+            sep,
+            id_key,
+            text_key,
+            usecols=usecols,
+            chunksize=chunksize,
+            engine=engine,
+            compression=compression,
+        )
+
+    def merge(self, other: "InstanceStore") -> int:
+        """
+        Appends every instance of another store after the ones in this store,
+        keeping the other store's order
+        :return: the number of instances merged
+        """
+        base_idx = len(self._sources)
+        self._sources.extend(other._sources)
+        self.duplicate_ids.extend(other.duplicate_ids)
+
+        for instance_id, row in other._order.items():
+            if row == _RESIDENT_ROW:
+                self[instance_id] = other._resident[instance_id]
+                continue
+            self._add_row(
+                instance_id,
+                base_idx + other._row_source[row],
+                other._row_offset[row],
+                other._row_length[row],
+            )
+
+        return len(other)
+
+    def add_jsonl_file(self, filename: str, id_key: str) -> int:
+        """
+        Indexes every line of a json/jsonl data file.
+        :return: the number of instances read from the file
+        """
+        source = _JsonLinesSource(filename, id_key)
+        source_idx = len(self._sources)
+        self._sources.append(source)
+
+        count = 0
+        for offset, length in source.lines():
+            item = source.decode(offset, length)
+            self._add_row(item[id_key], source_idx, offset, length)
+            count += 1
+
+        return count
+
+    def add_compressed_jsonl_file(
+        self, filename: str, compression: str, id_key: str, block_size: int = DEFAULT_BLOCK_SIZE
+    ) -> int:
+        """
+        Streams a compressed json/jsonl data file into blocks of lines that
+        can be decompressed one at a time, indexing it in the same pass, so
+        memory stays bounded by the compressed size of the lines and no
+        decompressed copy of the file is written
+        :return: the number of instances read from the file
+        """
+        source = _CompressedJsonLinesSource(id_key)
+        source_idx = len(self._sources)
+        self._sources.append(source)
+
+        # the lines of the block being filled, as (instance id, start, length)
+        rows = []
+        block = bytearray()
+
+        def flush():
+            block_offset = source.add_block(bytes(block))
+            for instance_id, start, length in rows:
+                self._add_row(instance_id, source_idx, block_offset + start, length)
+            block.clear()
+            rows.clear()
+
+        count = 0
+        with _open_compressed(filename, compression) as f:
+            for line in f:
+                content = line.rstrip(b"\r\n")
+                if not content.strip():
+                    continue
+                rows.append((json.loads(content)[id_key], len(block), len(content)))
+                block += content + b"\n"
+                count += 1
+                if len(block) >= block_size:
+                    flush()
+        if len(block) > 0:
+            flush()
+
+        return count
+
+    def add_csv_file(
+        self,
+        filename: str,
+        sep: str,
+        id_key: str,
+        text_key: str,
+        usecols: Optional[set] = None,
+        chunksize: int = DEFAULT_CHUNK_SIZE,
+        engine: str = "c",
+        compression: Optional[str] = None,
+    ) -> int:
+        """
+        Streams the rows of a csv/tsv data file into the store chunk by chunk.
+        Rows are kept as tuples rather than one dict per instance.
+        :usecols: optionally the only columns to read, missing ones are ignored
+        :engine: the pandas parser, "pyarrow" parses the whole file in
+          parallel but cannot be read in chunks
+        :compression: the extension of a compressed file (see COMPRESSIONS),
+          which is decompressed while it is read
+        :return: the number of instances read from the file
+        """
+        compression = COMPRESSIONS[compression] if compression is not None else None
+        size = os.path.getsize(filename)
+
+        header = pd.read_csv(filename, sep=sep, nrows=0, compression=compression).columns
+        if usecols is not None:
+            usecols = [column for column in header if column in usecols]
+
+        # Ensure the key is loaded as a string form (prevents weirdness later)
+        read_kwargs = dict(
+            sep=sep, dtype={id_key: str, text_key: str}, usecols=usecols, compression=compression
+        )
+        if engine == "pyarrow":
+            df = pd.read_csv(filename, engine="pyarrow", **read_kwargs)
+            chunks = (df.iloc[i : i + chunksize] for i in range(0, len(df), chunksize))
+        else:
+            chunks = pd.read_csv(
+                filename,
+                engine=engine,
+                chunksize=chunksize,
+                memory_map=compression is None,
+                **read_kwargs,
+            )
+
+        source = None
+        source_idx = len(self._sources)
+        count = 0
+        for chunk in chunks:
+            if source is None:
+                source = _RecordsSource(tuple(chunk.columns), id_key, read_kwargs)
+                if compression is None:
+                    source.filename = filename
+                    source.header = list(header)
+                    source.indexed_size = size
+                self._sources.append(source)
+                id_pos = source.columns.index(id_key)
+
+            for row in chunk.itertuples(index=False, name=None):
+                self._add_row(row[id_pos], source_idx, source.append(row), 0)
+                count += 1
+
+        return count
+
+    def add_arrow_file(
+        self, filename: str, fmt: str, id_key: str, usecols: Optional[set] = None
+    ) -> int:
+        """
+        Indexes a parquet or arrow/feather data file. Only the id column is
+        turned into python objects up front.
+        :usecols: optionally the only columns to read, missing ones are ignored
+        :return: the number of instances read from the file
+        """
+        columns = None
+        if usecols is not None:
+            columns = [column for column in _read_arrow_schema(filename, fmt).names if column in usecols]
+
+        source = _ArrowSource(filename, fmt, id_key, columns)
+        source_idx = len(self._sources)
+        self._sources.append(source)
+
+        ids = source.ids()
+        for row, instance_id in enumerate(ids):
+            self._add_row(instance_id, source_idx, row, 0)
+
+        return len(ids)
+
+    def append_new_instances(self) -> list:
+        """
+        Indexes the instances appended to the data files since they were read.
+        Rows which were indexed before are not read again
+        :return: the ids of the new instances
+        """
+        new_ids = []
+        with self._lock:
+            for source_idx, source in enumerate(self._sources):
+                if not hasattr(source, "read_appended"):
+                    continue
+
+                for instance_id, offset, length in source.read_appended():
+                    if instance_id in self._order:
+                        _logger.warning("Ignoring appended instance with existing id %s" % instance_id)
+                        continue
+                    self._add_row(instance_id, source_idx, offset, length)
+                    new_ids.append(instance_id)
+
+        return new_ids
+
+    def _add_row(self, instance_id, source_idx: int, offset: int, length: int):
+        if instance_id in self._order:
+            self.duplicate_ids.append(instance_id)
+
+        row = len(self._row_source)
+        self._row_source.append(source_idx)
+        self._row_offset.append(offset)
+        self._row_length.append(length)
+
+        self._resident.pop(instance_id, None)
+        self._cache.pop(instance_id, None)
+        self._order[instance_id] = row
+
+    def _decode(self, row: int) -> dict:
+        source = self._sources[self._row_source[row]]
+        return source.decode(self._row_offset[row], self._row_length[row])
+
+    def __getitem__(self, instance_id):
+        with self._lock:
+            if instance_id in self._resident:
+                return self._resident[instance_id]
+
+            try:
+                return self._cache[instance_id]
+            except KeyError:
+                pass
+
+            row = self._order[instance_id]
+
+        item = self._decode(row)
+        if self._decorate is not None:
+            self._decorate(instance_id, item)
+
+        with self._lock:
+            self._cache[instance_id] = item
+        return item
+
+    def __setitem__(self, instance_id, item: dict):
+        if self._decorate is not None:
+            self._decorate(instance_id, item)
+
+        with self._lock:
+            self._cache.pop(instance_id, None)
+            self._resident[instance_id] = item
+            self._order[instance_id] = _RESIDENT_ROW
+
+    def __delitem__(self, instance_id):
+        with self._lock:
+            del self._order[instance_id]
+            self._resident.pop(instance_id, None)
+            self._cache.pop(instance_id, None)
+
+    def __contains__(self, instance_id) -> bool:
+        with self._lock:
+            return instance_id in self._order
+
+    def __iter__(self):
+        # iterates over a copy of the ids, since instances appended while
+        # iterating would break iterating the OrderedDict itself
+        with self._lock:
+            instance_ids = list(self._order)
+        return iter(instance_ids)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def move_to_end(self, instance_id, last: bool = True):
+        with self._lock:
+            self._order.move_to_end(instance_id, last=last)
+
+    def close(self):
+        for source in self._sources:
+            source.close()
+        self._sources = []
+
+
+def read_data_file(
+    filename: str,
+    fmt: str,
+    compression: Optional[str] = None,
+    **kwargs,
+) -> InstanceStore:
+    """
+    Reads a single data file into a store of its own. This is the unit of
+    work when the data files are read by a pool of processes and the
+    results get merged back in the order of the data files.
+    :kwargs: passed on to `InstanceStore.add_data_file`
+    """
+    store = InstanceStore()
+    store.add_data_file(filename, fmt, compression=compression, **kwargs)
+    return store
@@ -0,0 +1,225 @@
+"""
+module: project
+filename: journal.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module which persists changes to the
+  task assignment as an append-only journal of small records. The
+  journal is periodically compacted into the task assignment json file,
+  which keeps its format, and replayed on top of it at startup
+"""
+
+import json
+import logging
+import os
+import os.path
+from collections.abc import Mapping
+from typing import Callable, Iterable, Optional
+
+from potato.flask_app.modules.project.assignment_index import AssignedIndex
+
+_logger = logging.getLogger("Journal")
+
+DEFAULT_COMPACT_EVERY = 10000
+# the key of the task assignment holding the last journal record compacted into it
+SEQUENCE_KEY = "journal_seq"
+
+# the delta of a record assigning test questions, which do not count
+# against the labels an instance needs
+TEST_QUESTION_DELTA = 0
+# the key of the task assignment holding the labels taken from instances
+# whose annotators agreed early, and not yet given to contested instances
+SPARE_LABELS_KEY = "spare_labels"
+# the key of the task assignment holding the instances whose labels were
+# taken because their annotators agreed, and which were not asked for more
+STOPPED_KEY = "stopped_instances"
+
+
+def apply_assignment(task_assignment: dict, username: Optional[str], instance_ids: Iterable, delta: int):
+    """
+    Changes the task assignment for one record. A negative delta assigns the
+    instances to the user and takes that many labels off what they still
+    need, a positive delta releases them from the user again and a zero
+    delta only assigns them (test questions). Without a user only the labels
+    the instances need change, and the difference goes to or comes from
+    the spare labels. Taking labels off an instance this way marks it as
+    stopped until it is given a label again
+    """
+    assigned = task_assignment["assigned"]
+    unassigned = task_assignment["unassigned"]
+
+    for instance_id in instance_ids:
+        if username is None:
+            task_assignment[SPARE_LABELS_KEY] = task_assignment.get(SPARE_LABELS_KEY, 0) - delta
+            stopped = task_assignment.setdefault(STOPPED_KEY, {})
+            if delta <= 0:
+                stopped[instance_id] = True
+            else:
+                stopped.pop(instance_id, None)
+        elif isinstance(assigned, AssignedIndex):
+            if delta <= 0:
+                assigned.add_user(instance_id, username)
+            else:
+                assigned.remove_user(instance_id, username)
+        elif delta <= 0:
+            if instance_id not in assigned:
+                assigned[instance_id] = []
+            assigned[instance_id].append(username)
+        else:
+            users = assigned.get(instance_id)
+            if users is not None and username in users:
+                users.remove(username)
+
+        if delta == 0:
+            continue
+
+        remaining = unassigned.get(instance_id, 0) + delta
+        if remaining > 0:
+            unassigned[instance_id] = remaining
+        elif instance_id in unassigned:
+            del unassigned[instance_id]
+
+
+def dump_task_assignment(task_assignment: dict, w):
+    """
+    Writes the task assignment as json. The compact mappings it holds are
+    written entry by entry like the dicts they replace, without copying them
+    """
+    w.write("{")
+    for i, (key, value) in enumerate(task_assignment.items()):
+        w.write((", " if i > 0 else "") + json.dumps(key) + ": ")
+        if isinstance(value, Mapping) and not isinstance(value, dict):
+            w.write("{")
+            for j, (item_key, item) in enumerate(value.items()):
+                w.write((", " if j > 0 else "") + json.dumps(str(item_key)) + ": " + json.dumps(item))
+            w.write("}")
+        else:
+            json.dump(value, w)
+    w.write("}")
+
+
+class AssignmentJournal:
+    """
+    The journal of the task assignment saved at path. Every change goes
+    through append(), which applies it, writes one line to the journal and
+    now and then rewrites the whole task assignment so the journal stays short
+    """
+
+    def __init__(self, path: str, compact_every: int = DEFAULT_COMPACT_EVERY, fsync: bool = False):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self._sequence = 0
+        self._records_since_compaction = 0
+        self._file = None
+
+    def load(self, convert: Optional[Callable[[dict], dict]] = None) -> Optional[dict]:
+        """
+        Reads the task assignment and replays the journal on top of it. The
+        saved task assignment is passed through convert first, if given
+        :return: the task assignment or None if none was saved yet
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, "r") as r:
+            task_assignment = json.load(r)
+        if convert is not None:
+            task_assignment = convert(task_assignment)
+        self._sequence = task_assignment.get(SEQUENCE_KEY, 0)
+        self._records_since_compaction = 0
+
+        if os.path.exists(self.journal_path):
+            replayed = 0
+            # the end of the last complete record
+            good_offset = 0
+            with open(self.journal_path, "rb") as r:
+                for line_no, line in enumerate(r):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    if record is None or not line.endswith(b"\n"):
+                        # only the last record can be cut short by a crash
+                        _logger.warning(
+                            "Ignoring incomplete record on line %d of %s" % (line_no + 1, self.journal_path)
+                        )
+                        break
+                    good_offset += len(line)
+                    # records before the last compaction are already in the file
+                    if record["seq"] <= self._sequence:
+                        continue
+                    apply_assignment(task_assignment, record["user"], record["ids"], record["delta"])
+                    self._sequence = record["seq"]
+                    replayed += 1
+            # the next record must not be appended to a cut short one
+            if good_offset < os.path.getsize(self.journal_path):
+                with open(self.journal_path, "r+b") as w:
+                    w.truncate(good_offset)
+            self._records_since_compaction = replayed
+            _logger.info("Replayed %d task assignment records from %s" % (replayed, self.journal_path))
+
+        task_assignment[SEQUENCE_KEY] = self._sequence
+        return task_assignment
+
+    def append(self, task_assignment: dict, username: Optional[str], instance_ids: list, delta: int):
+        """
+        Applies a change to the task assignment and records it
+        """
+        instance_ids = list(instance_ids)
+        if len(instance_ids) == 0:
+            return
+
+        apply_assignment(task_assignment, username, instance_ids, delta)
+
+        self._sequence += 1
+        record = {"seq": self._sequence, "user": username, "ids": instance_ids, "delta": delta}
+        if self._file is None:
+            self._file = open(self.journal_path, "a")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self._records_since_compaction += 1
+        if self._records_since_compaction >= self.compact_every:
+            self.compact(task_assignment)
+
+    def compact(self, task_assignment: dict):
+        """
+        Writes the whole task assignment and empties the journal. The file
+        is replaced atomically and remembers the last record it contains,
+        so a crash at any point replays each record at most once
+        """
+        task_assignment[SEQUENCE_KEY] = self._sequence
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as w:
+            dump_task_assignment(task_assignment, w)
+        os.replace(tmp_path, self.path)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, "w")
+        self._records_since_compaction = 0
+        _logger.debug("Compacted the task assignment journal into %s" % self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_assignment_journal = None
+
+
+def set_assignment_journal(journal: AssignmentJournal):
+    global _assignment_journal
+    if _assignment_journal is not None:
+        _assignment_journal.close()
+    _assignment_journal = journal
+
+
+def get_assignment_journal() -> Optional[AssignmentJournal]:
+    return _assignment_journal
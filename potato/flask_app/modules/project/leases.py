@@ -0,0 +1,112 @@
+"""
+module: project
+filename: leases.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module which keeps a lease on the
+  instances assigned to each user. The lease is renewed whenever the
+  user submits an annotation, users whose lease runs out have their
+  unannotated instances returned to the unassigned pool
+"""
+
+import logging
+from threading import Lock
+import time
+from typing import List, Optional
+
+_logger = logging.getLogger("Leases")
+
+
+class LeaseTable:
+    """
+    The time at which the lease of every user holding instances expires,
+    along with counts of what was reclaimed so far
+    """
+
+    def __init__(self, lease_seconds: float):
+        self.lease_seconds = lease_seconds
+        self._expiry = {}
+        self._lock = Lock()
+
+        # metrics
+        self.expired_leases = 0
+        self.reclaimed_instances = 0
+
+    def renew(self, username: str, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expiry[username] = now + self.lease_seconds
+
+    def extend(self, username: str, now: Optional[float] = None):
+        """
+        Renews the lease of a user only if they hold one
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if username in self._expiry:
+                self._expiry[username] = now + self.lease_seconds
+
+    def release(self, username: str):
+        with self._lock:
+            self._expiry.pop(username, None)
+
+    def is_expired(self, username: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        with self._lock:
+            expiry = self._expiry.get(username)
+        return expiry is not None and expiry <= now
+
+    def get_expired(self, now: Optional[float] = None) -> List[str]:
+        """
+        :return: the users whose lease has run out
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return [username for username, expiry in self._expiry.items() if expiry <= now]
+
+    def record_reclaimed(self, username: str, count: int):
+        with self._lock:
+            self._expiry.pop(username, None)
+            self.expired_leases += 1
+            self.reclaimed_instances += count
+        _logger.info(
+            "Lease of %s expired, returned %d instances to the unassigned pool (%d instances from %d leases so far)"
+            % (username, count, self.reclaimed_instances, self.expired_leases)
+        )
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {
+                "active_leases": len(self._expiry),
+                "expired_leases": self.expired_leases,
+                "reclaimed_instances": self.reclaimed_instances,
+            }
+
+
+_lease_table = None
+
+
+def set_lease_table(lease_table: Optional[LeaseTable]):
+    global _lease_table
+    _lease_table = lease_table
+
+
+def get_lease_table() -> Optional[LeaseTable]:
+    return _lease_table
+
+
+def start_lease(username: str):
+    """
+    Starts or renews the lease of a user who was just assigned instances,
+    if leases are used
+    """
+    if _lease_table is not None:
+        _lease_table.renew(username)
+
+
+def renew_lease(username: str):
+    """
+    Renews the lease of a user who is still working on their instances
+    """
+    if _lease_table is not None:
+        _lease_table.extend(username)
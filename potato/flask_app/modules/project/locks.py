@@ -0,0 +1,35 @@
+"""
+module: project
+filename: locks.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module with the locks that keep the
+  task assignment and the user states consistent when requests are
+  served by several threads. The task assignment is guarded by a single
+  lock held only while instances are drawn and journaled, the state of
+  each user by one of a fixed set of striped locks.
+
+  Locks are always taken in the order user lock -> assignment lock
+"""
+
+from threading import RLock
+
+USER_LOCK_STRIPES = 64
+
+_assignment_lock = RLock()
+_user_locks = [RLock() for _ in range(USER_LOCK_STRIPES)]
+
+
+def assignment_lock() -> RLock:
+    """
+    :return: the lock to hold while reading or changing the task assignment
+    """
+    return _assignment_lock
+
+
+def user_lock(username: str) -> RLock:
+    """
+    :return: the lock to hold while reading or changing the state of a user,
+      users share one of USER_LOCK_STRIPES locks
+    """
+    return _user_locks[hash(username) % USER_LOCK_STRIPES]
@@ -10,14 +10,43 @@ desc: Defines the data orchestration metadata related to projects.
     - sampling -> Handles the randomization of the questions
 """
 
-from collections import defaultdict
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
 import logging
+import os
+import re
+import time
 from random import Random
-from typing import OrderedDict
-from string import ascii_uppercase
-
-from potato.flask_app.modules.annotation.module import convert_labels
+from threading import Thread
+
+from potato.flask_app.modules.annotation.highlight import load_keyword_matcher
+from potato.flask_app.modules.annotation.module import convert_labels, set_keyword_matcher
+from potato.flask_app.modules.project.assignment_index import AssignedIndex, InstanceIds
+from potato.flask_app.modules.project.displayed_text import (
+    DEFAULT_CACHE_BYTES,
+    DisplayedTextCache,
+    build_formatter,
+)
+from potato.flask_app.modules.project.instance_store import (
+    COMPRESSIONS,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CHUNK_SIZE,
+    InstanceStore,
+    read_data_file,
+)
+from potato.flask_app.modules.project.journal import (
+    DEFAULT_COMPACT_EVERY,
+    AssignmentJournal,
+    get_assignment_journal,
+    set_assignment_journal,
+)
+from potato.flask_app.modules.project.leases import LeaseTable, get_lease_table, set_lease_table
+from potato.flask_app.modules.project.statistics import set_check_statistics
+from potato.flask_app.modules.project.locks import assignment_lock
+from potato.flask_app.modules.project.snapshot import load_snapshot, save_snapshot, snapshot_key
+from potato.flask_app.modules.project.task import reclaim_expired_leases
+from potato.flask_app.modules.sampling.pool import StratifiedPool, UnassignedPool
 from potato.server_utils.config_utils import config
 from potato.server_utils.module_utils import Module, module_getter
 
@@ -25,9 +54,14 @@ _logger = logging.getLogger("Project")
 _random = Random()
 _task_assignment = {} #TODO Persist
 _instance_id_to_data = {} #TODO Persist
-_re_to_highlights = {} #TODO Persist
+_project_config = {}
+_format_displayed_text = build_formatter(None)
+_displayed_text_cache = DisplayedTextCache(_format_displayed_text, "", DEFAULT_CACHE_BYTES)
 
 DEFAULT_LABELS_PER_INSTANCE = 3
+SUPPORTED_DATA_FORMATS = ["csv", "tsv", "json", "jsonl", "parquet", "arrow", "feather"]
+# formats which may additionally be compressed, e.g. data.jsonl.gz
+COMPRESSIBLE_DATA_FORMATS = ["csv", "tsv", "json", "jsonl"]
 
 @module_getter
 def _get_module():
@@ -39,6 +73,21 @@ def _get_module():
 @config
 class ProjectConfiguration:
     debug: bool = False
+    instance_cache_size: int = DEFAULT_CACHE_SIZE
+    use_dataset_snapshot: bool = True
+    dataset_snapshot_path: str = ""
+    csv_chunk_size: int = DEFAULT_CHUNK_SIZE
+    csv_engine: str = "c"
+    project_data_columns: bool = False
+    ingestion_workers: int = 1
+    displayed_text_cache_bytes: int = DEFAULT_CACHE_BYTES
+    watch_data_files: bool = False
+    data_files_poll_seconds: float = 5.0
+    assignment_journal_compact_every: int = DEFAULT_COMPACT_EVERY
+    assignment_journal_fsync: bool = False
+    assignment_lease_seconds: float = 0
+    lease_check_seconds: float = 60.0
+    check_statistics: bool = False
 
 def start():
     if ProjectConfiguration.debug:
@@ -122,56 +171,51 @@ def start():
 def load_all_data(config):
     global _task_assignment
     global _instance_id_to_data
-    global _re_to_highlights
+    global _format_displayed_text
+    global _displayed_text_cache
+    global _project_config
 
     # Where to look in the JSON item object for the text to annotate
     text_key = config["item_properties"]["text_key"]
-    id_key = config["item_properties"]["id_key"]
-
-    # Keep the data in the same order we read it in
-    _instance_id_to_data = OrderedDict()
 
     data_files = config["data_files"]
-    _logger.debug("Loading data from %d files" % (len(data_files)))
-
-    for data_fname in data_files:
-
-        fmt = data_fname.split(".")[-1]
-        if fmt not in ["csv", "tsv", "json", "jsonl"]:
-            raise Exception("Unsupported input file format %s for %s" % (fmt, data_fname))
-
-        _logger.debug("Reading data from " + data_fname)
-
-        if fmt in ["json", "jsonl"]:
-            with open(data_fname, "rt") as f:
-                for line_no, line in enumerate(f):
-                    item = json.loads(line)
-
-                    # fix the encoding
-                    # item[text_key] = item[text_key].encode("latin-1").decode("utf-8")
-
-                    instance_id = item[id_key]
-
-                    # TODO: check for duplicate instance_id
-                    _instance_id_to_data[instance_id] = item
-
-        else:
-            sep = "," if fmt == "csv" else "\t"
-            # Ensure the key is loaded as a string form (prevents weirdness
-            # later)
-            df = pd.read_csv(data_fname, sep=sep, dtype={id_key: str, text_key: str})
-            for _, row in df.iterrows():
-
-                item = {}
-                for c in df.columns:
-                    item[c] = row[c]
-                instance_id = row[id_key]
+    # The displayed text is only generated once an instance is first read
+    _format_displayed_text = build_formatter(config.get("list_as_text"))
+    _displayed_text_cache = DisplayedTextCache(
+        _format_displayed_text, str(_random.random()), ProjectConfiguration.displayed_text_cache_bytes
+    )
+    decorate = lambda instance_id, item: _add_displayed_text(instance_id, item, text_key)
+
+    # Restarts reuse the data files parsed by the previous run as long as
+    # neither the files nor the way we read them have changed
+    snapshot_path, key, store = None, None, None
+    if ProjectConfiguration.use_dataset_snapshot:
+        snapshot_path = _get_snapshot_path(config)
+        key = snapshot_key(
+            data_files,
+            config["item_properties"],
+            config.get("list_as_text"),
+            {
+                "project_data_columns": ProjectConfiguration.project_data_columns,
+                "columns": sorted(_get_projected_columns(config)),
+            },
+        )
+        store = load_snapshot(snapshot_path, key)
 
-                # TODO: check for duplicate instance_id
-                _instance_id_to_data[instance_id] = item
-            line_no = len(df)
+    if store is not None:
+        store.configure(ProjectConfiguration.instance_cache_size, decorate)
+        _logger.info("Loaded %d instances from dataset snapshot %s" % (len(store), snapshot_path))
+    else:
+        # Keep the data in the same order we read it in. Instances in json
+        # files are only indexed here and get decoded once something asks
+        # for them
+        store = InstanceStore(cache_size=ProjectConfiguration.instance_cache_size, decorate=decorate)
+        _read_data_files(store, data_files, config)
+        if snapshot_path is not None:
+            save_snapshot(snapshot_path, key, store)
+            _logger.debug("Saved dataset snapshot to %s" % snapshot_path)
 
-        _logger.debug("Loaded %d instances from %s" % (line_no, data_fname))
+    _instance_id_to_data = store
 
     # TODO Setup automatic test questions for each annotation schema,
     # currently we are doing it similar to survey flow to allow multilingual test questions
@@ -210,29 +254,11 @@ def load_all_data(config):
         _instance_id_to_data.update({page['id']: item})
         _instance_id_to_data.move_to_end(page['id'], last=True)
 
-    # Generate the text to display in instance_id_to_data
-    for inst_id in _instance_id_to_data:
-        _instance_id_to_data[inst_id]["displayed_text"] = get_displayed_text(
-            _instance_id_to_data[inst_id][config["item_properties"]["text_key"]]
-        )
-
     # TODO: make this fully configurable somehow...
-    re_to_highlights = defaultdict(list)
     if "keyword_highlights_file" in config:
         kh_file = config["keyword_highlights_file"]
         _logger.debug("Loading keyword highlighting from %s" % (kh_file))
-
-        with open(kh_file, "rt") as f:
-            # TODO: make it flexible based on keyword
-            df = pd.read_csv(kh_file, sep="\t")
-            for i, row in df.iterrows():
-                regex = r"\b" + row["Word"].replace("*", "[a-z]*?") + r"\b"
-                re_to_highlights[regex].append((row["Schema"], row["Label"]))
-
-        _logger.debug(
-            "Loaded %d regexes to map to %d labels for dynamic highlighting"
-            % (len(re_to_highlights), i)
-        )
+        set_keyword_matcher(load_keyword_matcher(kh_file))
 
     # Load the annotation assignment info if automatic task assignment is on.
     # Jiaxin: we are simply saving this as a json file at this moment
@@ -243,15 +269,38 @@ def load_all_data(config):
             config["output_annotation_dir"], config["automatic_assignment"]["output_filename"]
         )
 
-        if os.path.exists(task_assignment_path):
-            # load the task assignment if it has been generated and saved
-            with open(task_assignment_path, "r") as r:
-                task_assignment = json.load(r)
+        # changes to the task assignment are appended to a journal next to it
+        journal = AssignmentJournal(
+            task_assignment_path,
+            ProjectConfiguration.assignment_journal_compact_every,
+            ProjectConfiguration.assignment_journal_fsync,
+        )
+        set_assignment_journal(journal)
+
+        # load the task assignment if it has been generated and saved, it is
+        # kept in its compact form before the journal is replayed on it
+        task_assignment = journal.load(partial(_compact_task_assignment, config))
+        if task_assignment is not None:
+
+            # pick up instances added to the data files since the task
+            # assignment was saved
+            known_ids = set(task_assignment["testing"]["ids"]) | set(task_assignment["prestudy_ids"])
+            new_ids = [
+                _id
+                for _id in _instance_id_to_data
+                if _id not in task_assignment["assigned"]
+                and _id not in task_assignment["unassigned"]
+                and _id not in known_ids
+            ]
+            _add_to_task_assignment(task_assignment, new_ids, config)
+            if len(new_ids) > 0:
+                journal.compact(task_assignment)
         else:
             # Otherwise generate a new task assignment dict
+            ids = InstanceIds()
             task_assignment = {
-                "assigned": {},
-                "unassigned": OrderedDict(), #use ordered dict so that we can keep track of the original order
+                "assigned": AssignedIndex(ids),
+                "unassigned": _new_unassigned_pool(config, ids=ids), #keeps the original order like an ordered dict
                 "testing": {"test_question_per_annotator": 0, "ids": []},
                 "prestudy_ids": [],
                 "prestudy_passed_users": [],
@@ -270,69 +319,276 @@ def load_all_data(config):
                     for p in config[it + "_pages"]:
                         task_assignment["assigned"][p['id']] = 0
 
-            for _id in _instance_id_to_data:
-                if _id in task_assignment["assigned"]:
-                    continue
-                # add test questions to the assignment dict
-                if re.search("testing", _id):
-                    task_assignment["testing"]["ids"].append(_id)
-                    continue
-                if re.search("prestudy", _id):
-                    task_assignment["prestudy_ids"].append(_id)
-                    continue
-                # set the total labels per instance, if not specified, default to 3
-                task_assignment["unassigned"][_id] = (
-                    config["automatic_assignment"]["labels_per_instance"]
-                    if "labels_per_instance" in config["automatic_assignment"]
-                    else DEFAULT_LABELS_PER_INSTANCE
-                )
+            _add_to_task_assignment(task_assignment, _instance_id_to_data.keys(), config)
+            journal.compact(task_assignment)
+
+        _task_assignment = task_assignment
+
+    _project_config = config
+    set_check_statistics(ProjectConfiguration.check_statistics)
+    if ProjectConfiguration.watch_data_files:
+        Thread(target=_watch_data_files, name="DataFileWatcher", daemon=True).start()
+
+    # instances of annotators who stop submitting are given to others
+    if ProjectConfiguration.assignment_lease_seconds > 0 and "unassigned" in _task_assignment:
+        lease_table = LeaseTable(ProjectConfiguration.assignment_lease_seconds)
+        for username in _task_assignment_users(_task_assignment):
+            lease_table.renew(username)
+        set_lease_table(lease_table)
+        Thread(target=_reap_expired_leases, name="LeaseReaper", daemon=True).start()
+
+
+def _compact_task_assignment(config, task_assignment):
+    """
+    Replaces the dicts of assigned and unassigned instances read from the
+    json file with their compact form, sharing one table of interned ids
+    """
+    ids = InstanceIds()
+    task_assignment["unassigned"] = _new_unassigned_pool(config, task_assignment["unassigned"], ids)
+    task_assignment["assigned"] = AssignedIndex(ids, task_assignment["assigned"])
+    return task_assignment
+
+
+def _new_unassigned_pool(config, unassigned=(), ids=None):
+    """
+    Returns the pool of unassigned instances, which also indexes the
+    instances by their stratum when automatic_assignment.stratify_by is set
+    """
+    if "stratify_by" not in config["automatic_assignment"]:
+        return UnassignedPool(unassigned, ids)
+
+    field = config["automatic_assignment"]["stratify_by"]
+    pool = StratifiedPool(partial(_get_stratum, field), unassigned, ids)
+    _logger.info("Unassigned instances per %s: %s" % (field, pool.get_stratum_sizes()))
+    return pool
+
+
+def _get_stratum(field, instance_id):
+    value = _instance_id_to_data[instance_id].get(field)
+    return None if value is None else str(value)
+
+
+def _add_to_task_assignment(task_assignment, instance_ids, config):
+    """
+    Sorts new instances into the test questions, prestudy questions or the
+    instances waiting to be assigned to annotators
+    """
+    for _id in instance_ids:
+        if _id in task_assignment["assigned"]:
+            continue
+        # add test questions to the assignment dict
+        if re.search("testing", _id):
+            task_assignment["testing"]["ids"].append(_id)
+            continue
+        if re.search("prestudy", _id):
+            task_assignment["prestudy_ids"].append(_id)
+            continue
+        # set the total labels per instance, if not specified, default to 3
+        task_assignment["unassigned"][_id] = (
+            config["automatic_assignment"]["labels_per_instance"]
+            if "labels_per_instance" in config["automatic_assignment"]
+            else DEFAULT_LABELS_PER_INSTANCE
+        )
+
+
+def _watch_data_files():
+    while True:
+        time.sleep(ProjectConfiguration.data_files_poll_seconds)
+        try:
+            append_new_data()
+        except Exception as e:
+            _logger.error("Could not read new instances from the data files: %s" % repr(e))
+
+
+def _task_assignment_users(task_assignment):
+    users = set()
+    for inst_id, assigned_users in task_assignment["assigned"].items():
+        if type(assigned_users) == list:
+            users.update(assigned_users)
+    return users
+
+
+def _reap_expired_leases():
+    while True:
+        time.sleep(ProjectConfiguration.lease_check_seconds)
+        try:
+            reclaim_expired_leases()
+        except Exception as e:
+            _logger.error("Could not reclaim expired leases: %s" % repr(e))
+
+
+def get_lease_metrics():
+    """
+    :return: the active, expired leases and reclaimed instances so far
+    """
+    lease_table = get_lease_table()
+    if lease_table is None:
+        return {}
+    return lease_table.get_metrics()
+
+
+def append_new_data():
+    """
+    Adds the instances appended to the data files since they were loaded
+    without re-reading the rest of the data
+    :return: the ids of the new instances
+    """
+    new_ids = _instance_id_to_data.append_new_instances()
+    _register_new_instances(new_ids)
+    return new_ids
+
+
+def append_instances(items):
+    """
+    Adds new instances (e.g. uploaded by an admin) to the project
+    :return: the ids of the new instances
+    """
+    id_key = _project_config["item_properties"]["id_key"]
+
+    new_ids = []
+    for item in items:
+        instance_id = item[id_key]
+        if instance_id in _instance_id_to_data:
+            _logger.warning("Ignoring new instance with existing id %s" % instance_id)
+            continue
+        _instance_id_to_data[instance_id] = item
+        new_ids.append(instance_id)
+
+    _register_new_instances(new_ids)
+    return new_ids
+
+
+def _register_new_instances(new_ids):
+    if len(new_ids) == 0:
+        return
+
+    _logger.info("Added %d new instances to the project" % len(new_ids))
+    if "unassigned" not in _task_assignment:
+        return
+
+    with assignment_lock():
+        _add_to_task_assignment(_task_assignment, new_ids, _project_config)
+
+        # new instances are rare, so save the whole task assignment instead of
+        # journaling them
+        get_assignment_journal().compact(_task_assignment)
+
+
+def _get_snapshot_path(config):
+    if ProjectConfiguration.dataset_snapshot_path != "":
+        return ProjectConfiguration.dataset_snapshot_path
+    return os.path.join(config["output_annotation_dir"], ".snapshot", "dataset.snapshot")
+
+
+def _get_projected_columns(config):
+    """
+    Returns the only columns the rest of the server reads from a data file
+    """
+    item_properties = config["item_properties"]
+    columns = {item_properties["id_key"], item_properties["text_key"], "label_suggestions"}
+    if "context_key" in item_properties:
+        columns.add(item_properties["context_key"])
+    columns.update(item_properties.get("kwargs", []))
+    if "prestudy" in config and "groundtruth_key" in config["prestudy"]:
+        columns.add(config["prestudy"]["groundtruth_key"])
+    if "automatic_assignment" in config and "stratify_by" in config["automatic_assignment"]:
+        columns.add(config["automatic_assignment"]["stratify_by"])
+    return columns
+
+
+def _parse_data_file_format(data_fname):
+    """
+    Splits the extension of a data file into its format and compression,
+    e.g. "data.jsonl.gz" -> ("jsonl", "gz")
+    """
+    parts = data_fname.split(".")
+    compression = None
+    if parts[-1] in COMPRESSIONS and len(parts) > 2:
+        compression = parts[-1]
+        parts = parts[:-1]
+
+    fmt = parts[-1]
+    if fmt not in SUPPORTED_DATA_FORMATS or (compression and fmt not in COMPRESSIBLE_DATA_FORMATS):
+        raise Exception("Unsupported input file format %s for %s" % (fmt, data_fname))
+
+    return fmt, compression
+
+
+def _log_throughput(what, count, num_bytes, seconds):
+    seconds = max(seconds, 1e-6)
+    _logger.info(
+        "Loaded %d instances from %s in %.1fs (%.1f MB/s, %d instances/s)"
+        % (count, what, seconds, num_bytes / seconds / 1e6, count / seconds)
+    )
+
+
+def _read_data_files(store, data_files, config):
+    text_key = config["item_properties"]["text_key"]
+    id_key = config["item_properties"]["id_key"]
+
+    usecols = None
+    if ProjectConfiguration.project_data_columns:
+        usecols = _get_projected_columns(config)
+
+    _logger.debug("Loading data from %d files" % (len(data_files)))
+
+    formats = [_parse_data_file_format(data_fname) for data_fname in data_files]
+    read_kwargs = dict(
+        id_key=id_key,
+        text_key=text_key,
+        usecols=usecols,
+        chunksize=ProjectConfiguration.csv_chunk_size,
+        engine=ProjectConfiguration.csv_engine,
+    )
+
+    start_time = time.perf_counter()
+    workers = min(ProjectConfiguration.ingestion_workers, len(data_files))
+    if workers > 1:
+        # Each shard is parsed by its own process and merged back in the
+        # order of data_files so the instance order stays deterministic
+        _logger.debug("Reading data files with %d processes" % workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shards = executor.map(
+                partial(read_data_file, **read_kwargs),
+                data_files,
+                [fmt for fmt, _ in formats],
+                [compression for _, compression in formats],
+            )
+            for data_fname, shard in zip(data_files, shards):
+                line_no = store.merge(shard)
+                _logger.debug("Loaded %d instances from %s" % (line_no, data_fname))
+    else:
+        for data_fname, (fmt, compression) in zip(data_files, formats):
+            _logger.debug("Reading data from " + data_fname)
+            file_start_time = time.perf_counter()
+            line_no = store.add_data_file(data_fname, fmt, compression=compression, **read_kwargs)
+            _log_throughput(
+                data_fname,
+                line_no,
+                os.path.getsize(data_fname),
+                time.perf_counter() - file_start_time,
+            )
+
+    _log_throughput(
+        "%d data files" % len(data_files),
+        len(store),
+        sum(os.path.getsize(data_fname) for data_fname in data_files),
+        time.perf_counter() - start_time,
+    )
+
+    if len(store.duplicate_ids) > 0:
+        raise Exception(
+            "Found %d duplicate instance ids for %s in the data files, e.g. %s"
+            % (len(store.duplicate_ids), id_key, ", ".join(map(str, store.duplicate_ids[:10])))
+        )
+
+
+def _add_displayed_text(instance_id, item, text_key):
+    """
+    Attach the text to display to an instance as it enters the store
+    """
+    item["displayed_text"] = _displayed_text_cache.get(instance_id, item[text_key])
+
 
 def get_displayed_text(text):
-    # automatically unfold the text list when input text is a list (e.g. best-worst-scaling).
-    if "list_as_text" in config and config["list_as_text"]:
-        if isinstance(text, str):
-            try:
-                text = eval(text)
-            except Exception:
-                text = str(text)
-        if isinstance(text, list):
-            if config["list_as_text"]["text_list_prefix_type"] == "alphabet":
-                prefix_list = list(ascii_uppercase)
-                text = [prefix_list[i] + ". " + text[i] for i in range(len(text))]
-            elif config["list_as_text"]["text_list_prefix_type"] == "number":
-                text = [str(i) + ". " + text[i] for i in range(len(text))]
-            text = "<br>".join(text)
-
-        # unfolding dict into different sections
-        elif isinstance(text, dict):
-            #randomize the order of the displayed text
-            if "randomization" in config["list_as_text"]:
-                if config["list_as_text"].get("randomization") == "value":
-                    values = list(text.values())
-                    _random.shuffle(values)
-                    text = {key: value for key, value in zip(text.keys(), values)}
-                elif config["list_as_text"].get("randomization") == "key":
-                    keys = list(text.keys())
-                    _random.shuffle(keys)
-                    text = {key: text[key] for key in keys}
-                else:
-                    print("WARNING: %s currently not supported for list_as_text, please check your .yaml file"%config["list_as_text"].get("randomization"))
-
-            block = []
-            if config["list_as_text"].get("horizontal"):
-                for key in text:
-                    block.append(
-                        '<div name="instance_text" style="float:left;width:%s;padding:5px;" class="column"> <legend> %s </legend> %s </div>'
-                        % ("%d" % int(100 / len(text)) + "%", key, text[key])
-                    )
-                text = '<div class="row" style="display: table"> %s </div>' % ("".join(block))
-            else:
-                for key in text:
-                    block.append(
-                        '<div name="instance_text"> <legend> %s </legend> %s <br/> </div>'
-                        % (key, text[key])
-                    )
-                text = "".join(block)
-        else:
-            text = text
-    return text
+    return _format_displayed_text(text, _random)
@@ -0,0 +1,101 @@
+"""
+module: project
+filename: snapshot.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Defines a binary snapshot of the loaded data files so that a
+  restart of the server can skip re-reading all of the project data.
+  The snapshot is keyed on the data files and the configuration used
+  to read them so that any change invalidates it
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import pickle
+from typing import Optional
+
+from potato.flask_app.modules.project.instance_store import InstanceStore
+
+_logger = logging.getLogger("Snapshot")
+
+_MAGIC = b"POTATOSS"
+_VERSION = 1
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def _hash_file(filename: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_key(
+    data_files: list, item_properties: dict, list_as_text, read_options: Optional[dict] = None
+) -> bytes:
+    """
+    Builds the key identifying a snapshot from the path, size, mtime and
+    content of every data file along with the config used to parse them
+    """
+    files = []
+    for data_fname in data_files:
+        stat = os.stat(data_fname)
+        files.append(
+            [os.path.abspath(data_fname), stat.st_size, stat.st_mtime_ns, _hash_file(data_fname)]
+        )
+
+    key = {
+        "version": _VERSION,
+        "data_files": files,
+        "item_properties": item_properties,
+        "list_as_text": list_as_text,
+        "read_options": read_options,
+    }
+    encoded = json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=32).digest()
+
+
+def load_snapshot(path: str, key: bytes) -> Optional[InstanceStore]:
+    """
+    Loads the instance store saved at path if it was saved with the same key
+    :return: the store or None if there is no usable snapshot
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        header = f.read(len(_MAGIC) + len(key))
+        if header != _MAGIC + key:
+            _logger.info("Dataset snapshot %s is out of date" % path)
+            return None
+
+        try:
+            store = pickle.load(f)
+        except Exception as e:
+            _logger.warning("Could not read dataset snapshot %s: %s" % (path, repr(e)))
+            return None
+
+    return store
+
+
+def save_snapshot(path: str, key: bytes, store: InstanceStore):
+    """
+    Writes the instance store to path. The file is replaced atomically so
+    that a crash never leaves a partial snapshot behind
+    """
+    snapshot_dir = os.path.dirname(path)
+    if snapshot_dir and not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_MAGIC + key)
+        pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
@@ -0,0 +1,112 @@
+"""
+module: project
+filename: statistics.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the project module which keeps running totals of
+  the finished users and the annotations made so far. The totals are
+  updated whenever the state of a user changes instead of being
+  recomputed from every user, and can be checked against the full
+  recomputation for debugging
+"""
+
+import logging
+from threading import Lock
+from typing import Callable
+
+_logger = logging.getLogger("Statistics")
+
+
+class UserStatistics:
+    """
+    The finished and assigned instance counts last seen for every user and
+    the totals over all users
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = Lock()
+        self.finished_users = 0
+        self.total_annotations = 0
+
+    @staticmethod
+    def _is_finished(finished: int, assigned: int) -> bool:
+        return finished >= assigned
+
+    def update(self, username: str, finished: int, assigned: int):
+        """
+        Replaces the counts of a user, adjusting the totals by the difference
+        """
+        with self._lock:
+            previous = self._counts.get(username)
+            if previous is not None:
+                self.total_annotations -= previous[0]
+                self.finished_users -= self._is_finished(*previous)
+            self._counts[username] = (finished, assigned)
+            self.total_annotations += finished
+            self.finished_users += self._is_finished(finished, assigned)
+
+    def get_counts(self) -> dict:
+        """
+        :return: the finished and assigned counts of every user
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def remove(self, username: str):
+        with self._lock:
+            previous = self._counts.pop(username, None)
+            if previous is not None:
+                self.total_annotations -= previous[0]
+                self.finished_users -= self._is_finished(*previous)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self.finished_users = 0
+            self.total_annotations = 0
+
+
+_user_statistics = UserStatistics()
+_check_statistics = False
+
+
+def get_user_statistics() -> UserStatistics:
+    return _user_statistics
+
+
+def set_check_statistics(check: bool):
+    """
+    Turns on comparing every running total with its full recomputation
+    """
+    global _check_statistics
+    _check_statistics = check
+
+
+def update_user_statistics(username: str, user_state):
+    """
+    Records the current counts of a user, call after every change to what
+    they were assigned or annotated
+    """
+    _user_statistics.update(
+        username,
+        user_state.get_real_finished_instance_count(),
+        user_state.get_real_assigned_instance_count(),
+    )
+
+
+def remove_user_statistics(username: str):
+    _user_statistics.remove(username)
+
+
+def checked(name: str, value: int, recompute: Callable[[], int]) -> int:
+    """
+    Returns a running total, comparing it with the full recomputation first
+    when the statistics are checked
+    :return: the running total
+    """
+    if _check_statistics:
+        expected = recompute()
+        if value != expected:
+            _logger.error("Running total of %s is %d but recomputing gives %d" % (name, value, expected))
+    return value
@@ -7,17 +7,41 @@ desc: Defines the assignment of tasks in a helper file for the
   project module
 """
 
+from collections import defaultdict
 import logging
+import os
+import re
+
+from potato.flask_app.modules.project.journal import SPARE_LABELS_KEY, STOPPED_KEY, get_assignment_journal
+from potato.flask_app.modules.project.leases import get_lease_table
+from potato.flask_app.modules.project.locks import assignment_lock, user_lock
+from potato.flask_app.modules.project.statistics import (
+    checked,
+    remove_user_statistics,
+    update_user_statistics,
+)
+from potato.flask_app.modules.sampling.pool import UnassignedPool
+from potato.flask_app.modules.user.annotation_journal import close_annotation_journal
+from potato.flask_app.modules.user.assigned_ids import save_assigned_ids
 
 _logger = logging.getLogger("Task")
 
+DEFAULT_BATCH_SIZE = 5
+DEFAULT_REFILL_THRESHOLD = 2
+
+
 def assign_instances_to_user(username):
     """
     Assign instances to a user
     :return: UserAnnotationState
     """
+    # concurrent requests of the same user must not both pass the check below
+    with user_lock(username):
+        return _assign_instances_to_user(username)
+
+
+def _assign_instances_to_user(username):
     global user_to_annotation_state
-    global instance_id_to_data
 
     user_state = user_to_annotation_state[username]
 
@@ -45,7 +69,7 @@ def assign_instances_to_user(username):
             or "prestudy" not in config
             or not config["prestudy"]["on"]
         ) or consent_status:
-            sampled_keys = sample_instances(username)
+            sampled_keys = sample_instances(username, _get_first_batch_size())
             user_state.real_instance_assigned_count += len(sampled_keys)
             if "post_annotation_pages" in task_assignment:
                 sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
@@ -59,14 +83,13 @@ def assign_instances_to_user(username):
         sampled_keys = task_assignment["prestudy_failed_pages"]
 
     else:
-        sampled_keys = sample_instances(username)
+        sampled_keys = sample_instances(username, _get_first_batch_size())
         user_state.real_instance_assigned_count += len(sampled_keys)
         sampled_keys = task_assignment["prestudy_passed_pages"] + sampled_keys
         if "post_annotation_pages" in task_assignment:
             sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
 
-    assigned_user_data = {key: instance_id_to_data[key] for key in sampled_keys}
-    user_state.add_new_assigned_data(assigned_user_data)
+    user_state.add_new_assigned_ids(sampled_keys)
 
     print(
         "assinged %d instances to %s, total pages: %s, total users: %s, unassigned labels: %s, finished users: %s"
@@ -80,28 +103,102 @@ def assign_instances_to_user(username):
         )
     )
 
-    # save the assigned user data dict
+    # save the assigned instance ids
     user_dir = os.path.join(config["output_annotation_dir"], username)
-    assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
 
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
         _logger.debug('Created state directory for user "%s"' % (username))
 
-    with open(assigned_user_data_path, "w") as w:
-        json.dump(user_state.get_assigned_data(), w)
+    save_assigned_ids(user_dir, user_state.get_assigned_ids())
 
-    # save task assignment status
-    task_assignment_path = os.path.join(
-        config["output_annotation_dir"], config["automatic_assignment"]["output_filename"]
-    )
-    with open(task_assignment_path, "w") as w:
-        json.dump(task_assignment, w)
+    # the task assignment status was saved to the assignment journal while sampling
 
     user_state.instance_assigned = True
+    update_user_statistics(username, user_state)
+
+    # return the assigned instance ids
+    return sampled_keys
+
+
+def is_incremental_assignment():
+    """
+    Whether instances are assigned in small batches while the user works
+    instead of all at once
+    """
+    return config["automatic_assignment"].get("assignment_mode", "upfront") == "incremental"
+
+
+def _get_first_batch_size():
+    instance_per_annotator = config["automatic_assignment"]["instance_per_annotator"]
+    if not is_incremental_assignment():
+        return instance_per_annotator
+    batch_size = config["automatic_assignment"].get("batch_size", DEFAULT_BATCH_SIZE)
+    return min(batch_size, instance_per_annotator)
+
+
+def assign_next_batch(username):
+    """
+    Assigns the next batch of instances to a user in the incremental
+    assignment mode once few unannotated instances are left ahead of their
+    cursor. The batch goes before the post annotation pages
+    :return: True if new instances were assigned
+    """
+    if not is_incremental_assignment():
+        return False
+
+    with user_lock(username):
+        return _assign_next_batch(username)
+
+
+def _assign_next_batch(username):
+    global user_to_annotation_state
+
+    user_state = user_to_annotation_state[username]
+
+    # the first batch is assigned by assign_instances_to_user
+    if user_state.get_real_assigned_instance_count() == 0:
+        return False
+
+    refill_threshold = config["automatic_assignment"].get("refill_threshold", DEFAULT_REFILL_THRESHOLD)
+    if user_state.get_remaining_real_instance_count() > refill_threshold:
+        return False
+
+    # test questions are only mixed into the first batch
+    sampled_count = len(
+        [it for it in user_state.get_real_assigned_instance_ids() if not re.search("testing", it)]
+    )
+    remaining = config["automatic_assignment"]["instance_per_annotator"] - sampled_count
+    if remaining <= 0:
+        return False
+
+    batch_size = config["automatic_assignment"].get("batch_size", DEFAULT_BATCH_SIZE)
+    # the instances the user already has must not be drawn again
+    sampled_keys = sample_instances(
+        username, min(batch_size, remaining), test_questions=False, exclude=user_state.get_assigned_ids()
+    )
+    added_keys = user_state.add_new_assigned_ids(sampled_keys, before=task_assignment.get("post_annotation_pages", []))
+    if len(added_keys) == 0:
+        return False
 
-    # return the assigned user data dict
-    return assigned_user_data
+    user_state.real_instance_assigned_count += len(added_keys)
+
+    _logger.debug(
+        "assigned %d more instances to %s, %d of %d assigned so far"
+        % (
+            len(added_keys),
+            username,
+            sampled_count + len(added_keys),
+            config["automatic_assignment"]["instance_per_annotator"],
+        )
+    )
+
+    # save the assigned instance ids
+    user_dir = os.path.join(config["output_annotation_dir"], username)
+    save_assigned_ids(user_dir, user_state.get_assigned_ids())
+
+    update_user_statistics(username, user_state)
+    return True
 
 
 def remove_instances_from_users(user_set):
@@ -123,22 +220,21 @@ def remove_instances_from_users(user_set):
         if u in user_to_annotation_state:
             archived_users = user_to_annotation_state[u]
             del user_to_annotation_state[u]
+            remove_user_statistics(u)
+        close_annotation_journal(u)
 
     #remove assigned instances
-    for inst_id in task_assignment['assigned']:
-        new_li = []
-        if type(task_assignment['assigned'][inst_id]) != list:
-            continue
-        for u in task_assignment['assigned'][inst_id]:
-            if u in user_set:
-                if inst_id not in task_assignment['unassigned']:
-                    task_assignment['unassigned'][inst_id] = 0
-                task_assignment['unassigned'][inst_id] += 1
-            else:
-                new_li.append(u)
-        # if len(new_li) != len(task_assignment['assigned'][inst_id]):
-        #    print(task_assignment['assigned'][inst_id], new_li)
-        task_assignment['assigned'][inst_id] = new_li
+    with assignment_lock():
+        released = defaultdict(list)
+        for inst_id in task_assignment['assigned']:
+            if type(task_assignment['assigned'][inst_id]) != list:
+                continue
+            for u in task_assignment['assigned'][inst_id]:
+                if u in user_set:
+                    released[u].append(inst_id)
+
+        for u, inst_ids in released.items():
+            _release_instances(u, inst_ids)
 
     # Figure out where this user's data would be stored on disk
     output_annotation_dir = config["output_annotation_dir"]
@@ -154,6 +250,121 @@ def remove_instances_from_users(user_set):
     print('removed %s users from the current annotation queue' % len(user_set))
 
 
+def _release_instances(username, inst_ids):
+    """
+    Releases instances from a user, appending the change to the assignment
+    journal. The labels of instances which already stopped because their
+    annotators agreed go to the spare labels instead of the unassigned pool.
+    The caller holds the assignment lock
+    """
+    global task_assignment
+
+    journal = get_assignment_journal()
+    journal.append(task_assignment, username, inst_ids, 1)
+    stopped = task_assignment.get(STOPPED_KEY, {})
+    journal.append(task_assignment, None, [inst_id for inst_id in inst_ids if inst_id in stopped], -1)
+
+
+def reclaim_expired_leases():
+    """
+    Returns the unannotated instances of users whose lease expired to the
+    unassigned pool, with the same bookkeeping as remove_instances_from_users.
+    The users keep what they annotated so far
+    :return: the number of instances reclaimed
+    """
+    global user_to_annotation_state
+    global task_assignment
+
+    lease_table = get_lease_table()
+    if lease_table is None:
+        return 0
+
+    reclaimed = 0
+    for username in lease_table.get_expired():
+        with user_lock(username):
+            # the user may have submitted while we were waiting for the lock
+            if not lease_table.is_expired(username):
+                continue
+
+            user_state = user_to_annotation_state.get(username)
+            if user_state is None:
+                lease_table.release(username)
+                continue
+
+            test_ids = set(task_assignment["testing"]["ids"])
+            inst_ids = [
+                inst_id
+                for inst_id in user_state.get_unfinished_real_instance_ids()
+                if inst_id not in test_ids
+            ]
+            # nothing to give back once the user annotated everything
+            if len(inst_ids) == 0:
+                lease_table.release(username)
+                continue
+
+            with assignment_lock():
+                _release_instances(username, inst_ids)
+            user_state.remove_assigned_instances(inst_ids)
+
+            # save the assigned instance ids
+            user_dir = os.path.join(config["output_annotation_dir"], username)
+            if os.path.exists(user_dir):
+                save_assigned_ids(user_dir, user_state.get_assigned_ids())
+
+            update_user_statistics(username, user_state)
+            lease_table.record_reclaimed(username, len(inst_ids))
+            reclaimed += len(inst_ids)
+
+    return reclaimed
+
+
+def get_assigned_users(instance_id):
+    """
+    :return: the users an instance is assigned to
+    """
+    global task_assignment
+
+    with assignment_lock():
+        assigned = task_assignment["assigned"].get(instance_id)
+        return list(assigned) if type(assigned) == list else []
+
+
+def stop_labeling(instance_id):
+    """
+    Takes an instance whose annotators already agree out of the unassigned
+    pool. The labels it still needed become spare labels for contested instances
+    :return: the number of labels freed
+    """
+    global task_assignment
+
+    with assignment_lock():
+        if instance_id in task_assignment.get(STOPPED_KEY, {}):
+            return 0
+        remaining = task_assignment["unassigned"].get(instance_id, 0)
+        # recorded even without labels left, so labels released later are spare
+        get_assignment_journal().append(task_assignment, None, [instance_id], -remaining)
+    return remaining
+
+
+def request_extra_label(instance_id, max_labels):
+    """
+    Asks for one more label on a contested instance if there are spare labels
+    and it was not given max_labels already
+    :return: True if the instance needs one more label now
+    """
+    global task_assignment
+
+    with assignment_lock():
+        if task_assignment.get(SPARE_LABELS_KEY, 0) <= 0:
+            return False
+        assigned = task_assignment["assigned"].get(instance_id)
+        labels = (len(assigned) if type(assigned) == list else 0) + task_assignment["unassigned"].get(instance_id, 0)
+        if labels >= max_labels:
+            return False
+        get_assignment_journal().append(task_assignment, None, [instance_id], 1)
+    return True
+
+
 def instances_all_assigned():
     global task_assignment
 
@@ -167,7 +378,12 @@ def get_unassigned_count():
     return the number of unassigned instances
     """
     global task_assignment
-    if 'unassigned' in task_assignment:
-        return sum(list(task_assignment['unassigned'].values()))
-    else:
+    if 'unassigned' not in task_assignment:
         return 0
+
+    unassigned = task_assignment['unassigned']
+    if not isinstance(unassigned, UnassignedPool):
+        return sum(unassigned.values())
+
+    # the pool keeps a running sum
+    return checked("unassigned labels", unassigned.get_total(), lambda: sum(unassigned.values()))
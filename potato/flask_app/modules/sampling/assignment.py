@@ -0,0 +1,82 @@
+"""
+module: sampling
+filename: assignment.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for sampling which draws instances for a user from the
+  unassigned pool and records them in the task assignment as one step,
+  so that concurrent logins never draw the same remaining label twice
+"""
+
+from random import Random
+from typing import Callable, Dict, Iterable, List
+
+from potato.flask_app.modules.project.journal import TEST_QUESTION_DELTA, get_assignment_journal
+from potato.flask_app.modules.project.leases import start_lease
+from potato.flask_app.modules.project.locks import assignment_lock
+from potato.flask_app.modules.sampling.pool import UnassignedPool
+
+
+def assign_sampled_instances(
+    task_assignment: dict,
+    username: str,
+    sample: Callable[[UnassignedPool], List],
+    random: Random,
+    test_questions: bool = True,
+) -> List:
+    """
+    Draws the instances of a user with sample(unassigned pool), assigns them
+    along with the test questions (unless test_questions is False) and appends
+    the change to the assignment journal while holding the assignment lock.
+    This starts the user's lease
+    :return: the sampled instance ids with the test questions mixed in
+    """
+    return assign_sampled_batch(
+        task_assignment, [username], lambda pool: {username: sample(pool)}, random, test_questions
+    )[username]
+
+
+def assign_sampled_batch(
+    task_assignment: dict,
+    usernames: List[str],
+    sample_many: Callable[[UnassignedPool], Dict[str, List]],
+    random: Random,
+    test_questions: bool = True,
+    exclude: Dict[str, Iterable] = None,
+) -> Dict[str, List]:
+    """
+    assign_sampled_instances for several users, whose instances are all drawn
+    by one call to sample_many(unassigned pool). The ids in exclude[user],
+    i.e. those the user already has, are dropped from what was drawn so that
+    they are neither assigned nor journaled twice
+    :return: the sampled instance ids of every user with the test questions mixed in
+    """
+    with assignment_lock():
+        user_to_keys = sample_many(task_assignment["unassigned"])
+        if exclude is not None:
+            for username, ids in exclude.items():
+                ids = set(ids)
+                user_to_keys[username] = [key for key in dict.fromkeys(user_to_keys[username]) if key not in ids]
+
+        # update task_assignment to keep track of task assignment status globally,
+        # the change is appended to the assignment journal
+        journal = get_assignment_journal()
+        for username in usernames:
+            sampled_keys = user_to_keys[username]
+            journal.append(task_assignment, username, sampled_keys, -1)
+
+            # sample and insert test questions
+            if test_questions and task_assignment["testing"]["test_question_per_annotator"] > 0:
+                sampled_testing_ids = random.sample(
+                    task_assignment["testing"]["ids"],
+                    k=task_assignment["testing"]["test_question_per_annotator"],
+                )
+                # adding test question sampling status to the task assignment
+                journal.append(task_assignment, username, sampled_testing_ids, TEST_QUESTION_DELTA)
+                for key in sampled_testing_ids:
+                    sampled_keys.insert(random.randint(0, len(sampled_keys) - 1), key)
+
+    # the users hold the instances until their lease runs out
+    for username in usernames:
+        start_lease(username)
+    return user_to_keys
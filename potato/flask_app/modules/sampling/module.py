@@ -6,183 +6,188 @@ author: David Jurgens
 desc: Defines Sampling for Annotators to keep questions randomized
 """
 
+from concurrent.futures import Future
 import logging
 import os
 import os.path
-import json
+from random import Random
+from threading import Lock
+
+from potato.flask_app.modules.project.locks import assignment_lock
+from potato.flask_app.modules.sampling.assignment import assign_sampled_batch, assign_sampled_instances
+from potato.flask_app.modules.sampling.strategies import (
+    DEFAULT_SAMPLING_STRATEGY,
+    SAMPLING_STRATEGIES,
+    load_sampling_strategy,
+)
+from potato.flask_app.modules.user.assigned_ids import save_assigned_ids
 from potato.server_utils.config_utils import config
 from potato.server_utils.module_utils import Module, module_getter
 
 _logger = logging.getLogger("SamplingLogger")
+_random = Random()
+_sampling_strategy = None
+
+# the sample_instances calls waiting for the assignment lock, see there
+_pending_samples = []
+_pending_lock = Lock()
 
 @module_getter
 def __get_module():
     return Module(
         configuration=SamplingConfiguration,
+        start=start
     )
 
 @config
 class SamplingConfiguration:
     debug: bool = False
 
-def sample_instances(username):
-    global user_to_annotation_state
-    global instance_id_to_data
-
-    # check if sampling strategy is specified in configuration, if not, set it as random
-    if "sampling_strategy" not in config["automatic_assignment"] \
-           or config["automatic_assignment"]["sampling_strategy"] not in ['random','ordered']:
-        _logger.debug("Undefined sampling strategy, default to random assignment")
-        config["automatic_assignment"]["sampling_strategy"] = "random"
-
-    # Force the sampling strategy to be random at this moment, will change this
-    # when more sampling strategies are created
-    #config["automatic_assignment"]["sampling_strategy"] = "random"
-
-    if config["automatic_assignment"]["sampling_strategy"] == "random":
-        # previously we were doing random sample directly, however, when there
-        # are a large amount of instances and users, it is possible that some
-        # instances are rarely sampled and some are oversampled at the end of
-        # the sampling process
-        # sampled_keys = random.sample(list(task_assignment['unassigned'].keys()),
-        #                             config["automatic_assignment"]["instance_per_annotator"])
-
-        # Currently we will shuffle the unassinged keys first, and then rank
-        # the dict based on the availability of each instance, and they directly
-        # get the first N instances
-        unassigned_dict = task_assignment["unassigned"]
-        unassigned_dict = {
-            k: unassigned_dict[k]
-            for k in random.sample(list(unassigned_dict.keys()), len(unassigned_dict))
-        }
-        sorted_keys = [
-            it[0] for it in sorted(unassigned_dict.items(), key=lambda item: item[1], reverse=True)
-        ]
-        sampled_keys = sorted_keys[
-            : min(config["automatic_assignment"]["instance_per_annotator"], len(sorted_keys))
-        ]
-
-    elif config["automatic_assignment"]["sampling_strategy"] == "ordered":
-        # sampling instances based on the natural order of the data
-
-        sorted_keys = list(task_assignment["unassigned"].keys())
-        sampled_keys = sorted_keys[
-                       : min(config["automatic_assignment"]["instance_per_annotator"], len(sorted_keys))
-        ]
-        #print(sampled_keys)
-
-    # update task_assignment to keep track of task assignment status globally
-    for key in sampled_keys:
-        if key not in task_assignment["assigned"]:
-            task_assignment["assigned"][key] = []
-        task_assignment["assigned"][key].append(username)
-        task_assignment["unassigned"][key] -= 1
-        if task_assignment["unassigned"][key] == 0:
-            del task_assignment["unassigned"][key]
-
-    # sample and insert test questions
-    if task_assignment["testing"]["test_question_per_annotator"] > 0:
-        sampled_testing_ids = random.sample(
-            task_assignment["testing"]["ids"],
-            k=task_assignment["testing"]["test_question_per_annotator"],
+def start():
+    if SamplingConfiguration.debug:
+        _random.seed(0)
+    else:
+        _random.seed()
+
+def get_sampling_strategy():
+    """
+    Loads the configured sampling strategy on first use
+    :return: SamplingStrategy
+    """
+    global _sampling_strategy
+
+    if _sampling_strategy is None:
+        # check if sampling strategy is specified in configuration, if not, set it as random
+        name = config["automatic_assignment"].get("sampling_strategy")
+        if name is None or (name not in SAMPLING_STRATEGIES and "." not in name):
+            _logger.debug("Undefined sampling strategy, default to random assignment")
+            config["automatic_assignment"]["sampling_strategy"] = DEFAULT_SAMPLING_STRATEGY
+
+        kwargs = dict(config["automatic_assignment"].get("sampling_strategy_kwargs", {}))
+        if "strata_proportions" in config["automatic_assignment"]:
+            kwargs["proportions"] = config["automatic_assignment"]["strata_proportions"]
+        _sampling_strategy = load_sampling_strategy(
+            config["automatic_assignment"]["sampling_strategy"], _random, **kwargs
         )
-        # adding test question sampling status to the task assignment
-        for key in sampled_testing_ids:
-            if key not in task_assignment["assigned"]:
-                task_assignment["assigned"][key] = []
-            task_assignment["assigned"][key].append(username)
-            sampled_keys.insert(random.randint(0, len(sampled_keys) - 1), key)
 
-    return sampled_keys
+    return _sampling_strategy
+
+
+class _PendingSample:
+    def __init__(self, username, count, test_questions, exclude):
+        self.username = username
+        self.count = count
+        self.test_questions = test_questions
+        self.exclude = exclude
+        self.future = Future()
+
+
+def sample_instances(username, count=None, test_questions=True, exclude=None):
+    """
+    Draws instances for a user, instance_per_annotator of them unless count is
+    given, and assigns them. Test questions are mixed in when test_questions is
+    set, the ids in exclude (those the user already has) are never drawn.
+
+    Calls made at the same time, e.g. by annotators logging in together, are
+    combined: whoever gets the assignment lock first draws the instances of
+    every user waiting for it with sample_instances_for_users. The caller
+    holds the user's lock, so a user waits for at most one call
+    :return: the sampled instance ids
+    """
+    pending = _PendingSample(username, count, test_questions, None if exclude is None else list(exclude))
+    with _pending_lock:
+        _pending_samples.append(pending)
+
+    with assignment_lock():
+        with _pending_lock:
+            batch = list(_pending_samples)
+            _pending_samples.clear()
+        # empty if the calls were served by whoever held the lock before
+        if len(batch) > 0:
+            _sample_pending(batch)
+
+    return pending.future.result()
+
+
+def _sample_pending(batch):
+    groups = {}
+    for pending in batch:
+        groups.setdefault((pending.count, pending.test_questions), []).append(pending)
+
+    for (count, test_questions), group in groups.items():
+        try:
+            exclude = {pending.username: pending.exclude for pending in group if pending.exclude is not None}
+            user_to_keys = sample_instances_for_users(
+                [pending.username for pending in group], count, test_questions, exclude or None
+            )
+        except Exception as e:
+            for pending in group:
+                pending.future.set_exception(e)
+            continue
+        for pending in group:
+            pending.future.set_result(user_to_keys[pending.username])
+        if len(group) > 1:
+            _logger.debug("Sampled the instances of %d users at once" % len(group))
+
+
+def sample_instances_for_users(usernames, count=None, test_questions=True, exclude=None):
+    """
+    sample_instances for several new users at once, drawing all their
+    instances from the unassigned pool in one pass. exclude maps a user to the
+    ids they must not be drawn
+    :return: the sampled instance ids of every user
+    """
+    global task_assignment
+
+    instance_per_annotator = config["automatic_assignment"]["instance_per_annotator"]
+    if count is not None:
+        instance_per_annotator = count
+
+    strategy = get_sampling_strategy()
+    sample_many = lambda pool: strategy.sample_many(pool, usernames, instance_per_annotator, exclude)
+
+    return assign_sampled_batch(task_assignment, usernames, sample_many, _random, test_questions, exclude)
+
 
 def generate_initial_user_dataflow(username):
     """
     Generate initial dataflow for a new annotator including surveyflows and prestudy.
-    :return: UserAnnotationState
+    :return: the assigned instance ids
     """
     global user_to_annotation_state
-    global instance_id_to_data
 
     sampled_keys = []
     for it in ["pre_annotation_pages", "prestudy_ids"]:
         if it in task_assignment:
             sampled_keys += task_assignment[it]
 
-    assigned_user_data = {key: instance_id_to_data[key] for key in sampled_keys}
+    assigned_ids = list(dict.fromkeys(sampled_keys))
 
-    # save the assigned user data dict
+    # save the assigned instance ids
     user_dir = os.path.join(config["output_annotation_dir"], username)
-    assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
 
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
         _logger.debug('Created state directory for user "%s"' % (username))
 
-    with open(assigned_user_data_path, "w") as w:
-        json.dump(assigned_user_data, w)
+    save_assigned_ids(user_dir, assigned_ids)
 
-    # return the assigned user data dict
-    return assigned_user_data
+    # return the assigned instance ids
+    return assigned_ids
 
 
 def generate_full_user_dataflow(username):
     """
     Directly assign all the instances to a user at the beginning of the study
-    :return: UserAnnotationState
+    :return: the assigned instance ids and the number of them which are real instances
     """
     global user_to_annotation_state
-    global instance_id_to_data
-
-    #check if sampling strategy is specified in configuration, if not, set it as random
-    if "sampling_strategy" not in config["automatic_assignment"] or config["automatic_assignment"]["sampling_strategy"] not in ['random','ordered']:
-        _logger.debug("Undefined sampling strategy, default to random assignment")
-        config["automatic_assignment"]["sampling_strategy"] = "random"
 
-    # Force the sampling strategy to be random at this moment, will change this
-    # when more sampling strategies are created
-    #config["automatic_assignment"]["sampling_strategy"] = "random"
+    instance_per_annotator = config["automatic_assignment"]["instance_per_annotator"]
+    strategy = get_sampling_strategy()
+    sample = lambda pool: strategy.sample(pool, instance_per_annotator)
 
-    if config["automatic_assignment"]["sampling_strategy"] == "random":
-        sampled_keys = random.sample(
-            list(task_assignment["unassigned"].keys()),
-            config["automatic_assignment"]["instance_per_annotator"],
-        )
-    elif config["automatic_assignment"]["sampling_strategy"] == "ordered":
-        # sampling instances based on the natural order of the data
-
-        sorted_keys = list(task_assignment["unassigned"].keys())
-        sampled_keys = sorted_keys[
-                       : min(config["automatic_assignment"]["instance_per_annotator"], len(sorted_keys))
-                       ]
-
-    # update task_assignment to keep track of task assignment status globally
-    for key in sampled_keys:
-        if key not in task_assignment["assigned"]:
-            task_assignment["assigned"][key] = []
-        task_assignment["assigned"][key].append(username)
-        task_assignment["unassigned"][key] -= 1
-        if task_assignment["unassigned"][key] == 0:
-            del task_assignment["unassigned"][key]
-
-    # sample and insert test questions
-    if task_assignment["testing"]["test_question_per_annotator"] > 0:
-        sampled_testing_ids = random.sample(
-            task_assignment["testing"]["ids"],
-            k=task_assignment["testing"]["test_question_per_annotator"],
-        )
-        # adding test question sampling status to the task assignment
-        for key in sampled_testing_ids:
-            if key not in task_assignment["assigned"]:
-                task_assignment["assigned"][key] = []
-            task_assignment["assigned"][key].append(username)
-            sampled_keys.insert(random.randint(0, len(sampled_keys) - 1), key)
-
-    # save task assignment status
-    task_assignment_path = os.path.join(
-        config["output_annotation_dir"], config["automatic_assignment"]["output_filename"]
-    )
-    with open(task_assignment_path, "w") as w:
-        json.dump(task_assignment, w)
+    sampled_keys = assign_sampled_instances(task_assignment, username, sample, _random)
 
     # add the amount of sampled instances
     real_assigned_instance_count = len(sampled_keys)
@@ -193,18 +198,16 @@ def generate_full_user_dataflow(username):
     if "post_annotation_pages" in task_assignment:
         sampled_keys = sampled_keys + task_assignment["post_annotation_pages"]
 
-    assigned_user_data = {key: instance_id_to_data[key] for key in sampled_keys}
+    assigned_ids = list(dict.fromkeys(sampled_keys))
 
-    # save the assigned user data dict
+    # save the assigned instance ids
     user_dir = os.path.join(config["output_annotation_dir"], username)
-    assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
 
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
         _logger.debug('Created state directory for user "%s"' % (username))
 
-    with open(assigned_user_data_path, "w") as w:
-        json.dump(assigned_user_data, w)
+    save_assigned_ids(user_dir, assigned_ids)
 
-    # return the assigned user data dict
-    return assigned_user_data, real_assigned_instance_count
+    # return the assigned instance ids
+    return assigned_ids, real_assigned_instance_count
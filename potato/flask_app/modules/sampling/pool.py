@@ -0,0 +1,342 @@
+"""
+module: sampling
+filename: pool.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for sampling which keeps the unassigned instances
+  bucketed by the number of labels they still need so that the least
+  covered instances can be drawn without sorting the whole pool. Ids are
+  interned as integers and kept in flat arrays
+"""
+
+from array import array
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from random import Random
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+
+from potato.flask_app.modules.project.assignment_index import InstanceIds
+
+
+class UnassignedPool(MutableMapping):
+    """
+    The instance ids waiting to be assigned, mapped to the number of labels
+    each still needs. It is used like the OrderedDict it replaces and keeps
+    the order in which ids were first seen, but every change also updates a
+    bucket of ids per remaining count. The ids can be interned in a table
+    shared with the rest of the task assignment
+    """
+
+    def __init__(self, items=(), ids: Optional[InstanceIds] = None):
+        self._ids = InstanceIds() if ids is None else ids
+        # the remaining count of id i, and its position in the bucket of that
+        # count or -1 if it is not in the pool
+        self._counts = array("i")
+        self._positions = array("i")
+        # remaining count -> ids
+        self._buckets = {}
+        self._size = 0
+        # the sum of all remaining counts
+        self._total = 0
+        # no id before this one is in the pool
+        self._first = 0
+
+        items = items.items() if hasattr(items, "items") else items
+        for key, value in items:
+            self[key] = value
+
+    def _ensure(self, index: int):
+        missing = index + 1 - len(self._positions)
+        if missing > 0:
+            self._counts.extend(array("i", [0]) * missing)
+            self._positions.extend(array("i", [-1]) * missing)
+
+    def _index(self, key: Hashable) -> int:
+        """
+        :return: the integer of an id in the pool or -1
+        """
+        index = self._ids.lookup(key)
+        if 0 <= index < len(self._positions) and self._positions[index] >= 0:
+            return index
+        return -1
+
+    def _bucket_add(self, index: int, count: int):
+        _add_to_bucket(self._buckets, self._positions, index, count)
+        self._total += count
+
+    def _bucket_remove(self, index: int, count: int):
+        _remove_from_bucket(self._buckets, self._positions, index, count)
+        self._total -= count
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._counts[index]
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        return default if index < 0 else self._counts[index]
+
+    def __setitem__(self, key, value):
+        index = self._ids.intern(key)
+        self._ensure(index)
+        if self._positions[index] >= 0:
+            previous = self._counts[index]
+            if previous == value:
+                return
+            self._bucket_remove(index, previous)
+        else:
+            self._size += 1
+            self._first = min(self._first, index)
+        self._counts[index] = value
+        self._bucket_add(index, value)
+
+    def __delitem__(self, key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        self._bucket_remove(index, self._counts[index])
+        self._size -= 1
+
+    def __contains__(self, key) -> bool:
+        return self._index(key) >= 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _advance_first(self):
+        while self._first < len(self._positions) and self._positions[self._first] < 0:
+            self._first += 1
+
+    def __iter__(self):
+        self._advance_first()
+        for index in range(self._first, len(self._positions)):
+            if self._positions[index] >= 0:
+                yield self._ids[index]
+
+    def clear(self):
+        self._counts = array("i")
+        self._positions = array("i")
+        self._buckets.clear()
+        self._size = 0
+        self._total = 0
+        self._first = 0
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
+
+    @contextmanager
+    def without(self, keys: Iterable[Hashable]):
+        """
+        Takes the given ids out of the pool while the block runs, e.g. so that
+        a user is not drawn the instances they already have, and puts them
+        back with their counts afterwards. This costs O(len(keys))
+        """
+        removed = []
+        for key in keys:
+            count = self.get(key)
+            if count is not None:
+                removed.append((key, count))
+                del self[key]
+        try:
+            yield self
+        finally:
+            for key, count in removed:
+                self[key] = count
+
+    def get_total(self) -> int:
+        """
+        :return: the number of labels still needed over all instances
+        """
+        return self._total
+
+    def get_bucket_sizes(self) -> dict:
+        """
+        :return: the number of instances for each remaining count
+        """
+        return {count: len(bucket) for count, bucket in self._buckets.items()}
+
+    def sample_least_covered(self, k: int, random: Random) -> List[Hashable]:
+        """
+        Draws k ids among those needing the most labels, choosing at random
+        between ids needing the same number. This is the same as shuffling
+        the pool and taking the first k after a stable sort by remaining
+        count, but costs O(k) plus the number of distinct counts
+        """
+        return [self._ids[index] for index in _sample_buckets(self._buckets, k, random)]
+
+    def first(self, k: int) -> List[Hashable]:
+        """
+        :return: the first k ids in data order
+        """
+        self._advance_first()
+        sampled = []
+        for index in range(self._first, len(self._positions)):
+            if len(sampled) >= k:
+                break
+            if self._positions[index] >= 0:
+                sampled.append(self._ids[index])
+        return sampled
+
+
+class StratifiedPool(UnassignedPool):
+    """
+    An UnassignedPool which additionally buckets the ids of each stratum,
+    e.g. of each language, so that a batch can be drawn with given
+    proportions of every stratum. stratum_of(id) is only called once per id
+    """
+
+    def __init__(
+        self, stratum_of: Callable[[Hashable], Hashable], items=(), ids: Optional[InstanceIds] = None
+    ):
+        self._stratum_of = stratum_of
+        self._strata = InstanceIds()
+        # the stratum of id i or -1 if it was not looked up yet, and the
+        # position of id i in the bucket of its stratum
+        self._stratum_index = array("i")
+        self._stratum_positions = array("i")
+        # stratum -> remaining count -> ids, and the number of ids per stratum
+        self._stratum_buckets = []
+        self._stratum_sizes = []
+        super().__init__(items, ids)
+
+    def _ensure(self, index: int):
+        super()._ensure(index)
+        missing = index + 1 - len(self._stratum_index)
+        if missing > 0:
+            self._stratum_index.extend(array("i", [-1]) * missing)
+            self._stratum_positions.extend(array("i", [-1]) * missing)
+
+    def _get_stratum_index(self, index: int) -> int:
+        stratum = self._stratum_index[index]
+        if stratum < 0:
+            stratum = self._strata.intern(self._stratum_of(self._ids[index]))
+            self._stratum_index[index] = stratum
+            if stratum == len(self._stratum_buckets):
+                self._stratum_buckets.append({})
+                self._stratum_sizes.append(0)
+        return stratum
+
+    def get_stratum(self, key: Hashable) -> Hashable:
+        index = self._ids.lookup(key)
+        if index < 0 or index >= len(self._stratum_index):
+            return self._stratum_of(key)
+        return self._strata[self._get_stratum_index(index)]
+
+    def _bucket_add(self, index: int, count: int):
+        super()._bucket_add(index, count)
+        stratum = self._get_stratum_index(index)
+        _add_to_bucket(self._stratum_buckets[stratum], self._stratum_positions, index, count)
+        self._stratum_sizes[stratum] += 1
+
+    def _bucket_remove(self, index: int, count: int):
+        super()._bucket_remove(index, count)
+        stratum = self._stratum_index[index]
+        _remove_from_bucket(self._stratum_buckets[stratum], self._stratum_positions, index, count)
+        self._stratum_sizes[stratum] -= 1
+
+    def clear(self):
+        super().clear()
+        self._stratum_index = array("i")
+        self._stratum_positions = array("i")
+        self._stratum_buckets = [{} for _ in self._stratum_buckets]
+        self._stratum_sizes = [0 for _ in self._stratum_sizes]
+
+    def __reduce__(self):
+        return (self.__class__, (self._stratum_of, list(self.items())))
+
+    def get_stratum_sizes(self) -> dict:
+        """
+        :return: the number of instances waiting in each stratum
+        """
+        return {self._strata[stratum]: size for stratum, size in enumerate(self._stratum_sizes) if size > 0}
+
+    def sample_stratified(
+        self, k: int, random: Random, proportions: Optional[Dict[Hashable, float]] = None
+    ) -> List[Hashable]:
+        """
+        Draws k ids split between the strata by the given proportions, or
+        evenly when there are none, taking the least covered ids within each
+        stratum. The share of a stratum that runs out goes to the others.
+        This costs O(k) plus the number of strata times their distinct counts
+        """
+        sampled = []
+        chosen = set()
+        strata = [stratum for stratum, size in enumerate(self._stratum_sizes) if size > 0]
+        weights = None
+        if proportions is not None:
+            weights = {stratum: proportions.get(self._strata[stratum], 0) for stratum in strata}
+            strata = [stratum for stratum in strata if weights[stratum] > 0]
+        # a stratum may be drawn again once others ran out
+        taken = {}
+        while len(sampled) < k and len(strata) > 0:
+            quotas = _split_by_proportions(k - len(sampled), strata, weights, random)
+            exhausted = []
+            for stratum, quota in quotas.items():
+                available = self._stratum_sizes[stratum] - taken.get(stratum, 0)
+                if quota >= available:
+                    quota = available
+                    exhausted.append(stratum)
+                if quota == 0:
+                    continue
+                drawn = _sample_buckets(self._stratum_buckets[stratum], taken.get(stratum, 0) + quota, random)
+                # draws are random, so only keep ids that were not drawn before
+                drawn = [index for index in drawn if index not in chosen][:quota]
+                chosen.update(drawn)
+                sampled += drawn
+                taken[stratum] = taken.get(stratum, 0) + quota
+            if len(exhausted) == 0:
+                break
+            strata = [stratum for stratum in strata if stratum not in exhausted]
+        return [self._ids[index] for index in sampled]
+
+
+def _add_to_bucket(buckets: dict, positions: array, index: int, count: int):
+    bucket = buckets.get(count)
+    if bucket is None:
+        bucket = buckets[count] = array("i")
+    positions[index] = len(bucket)
+    bucket.append(index)
+
+
+def _remove_from_bucket(buckets: dict, positions: array, index: int, count: int):
+    bucket = buckets[count]
+    position = positions[index]
+    positions[index] = -1
+    last = bucket.pop()
+    # move the last id into the hole so removal stays O(1)
+    if position < len(bucket):
+        bucket[position] = last
+        positions[last] = position
+    if len(bucket) == 0:
+        del buckets[count]
+
+
+def _sample_buckets(buckets: dict, k: int, random: Random) -> List[int]:
+    sampled = []
+    for count in sorted(buckets, reverse=True):
+        if len(sampled) >= k:
+            break
+        bucket = buckets[count]
+        sampled += random.sample(bucket, min(k - len(sampled), len(bucket)))
+    return sampled
+
+
+def _split_by_proportions(
+    k: int, strata: List[int], weights: Optional[Dict[int, float]], random: Random
+) -> Dict[int, int]:
+    """
+    Splits k draws between the strata by largest remainder, breaking ties at
+    random so that no stratum is always favoured for the last draws
+    """
+    weights = [1.0 if weights is None else weights[stratum] for stratum in strata]
+    total = sum(weights)
+    shares = [k * weight / total for weight in weights]
+    quotas = {stratum: int(share) for stratum, share in zip(strata, shares)}
+    order = sorted(
+        range(len(strata)), key=lambda i: (shares[i] - int(shares[i]), random.random()), reverse=True
+    )
+    for i in order[: k - sum(quotas.values())]:
+        quotas[strata[i]] += 1
+    return quotas
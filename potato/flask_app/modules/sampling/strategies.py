@@ -0,0 +1,142 @@
+"""
+module: sampling
+filename: strategies.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for sampling which defines the strategies drawing the
+  instances of new annotators. `sampling_strategy` names one of the
+  strategies below or gives the dotted path of a SamplingStrategy subclass
+"""
+
+from random import Random
+from typing import Dict, Hashable, Iterable, List
+
+from potato.flask_app.modules.sampling.pool import StratifiedPool, UnassignedPool
+from potato.server_utils.class_utils import get_class
+
+DEFAULT_SAMPLING_STRATEGY = "random"
+
+
+class SamplingStrategy:
+    """
+    Draws instances from the pool of unassigned instances. Subclasses
+    implement sample(), sample_many() serves several annotators at once
+    """
+
+    def __init__(self, random: Random, **kwargs):
+        self.random = random
+
+    def sample(self, pool: UnassignedPool, k: int) -> List[Hashable]:
+        """
+        :return: the k instance ids to assign to one annotator
+        """
+        raise NotImplementedError()
+
+    def candidates(self, pool: UnassignedPool, k: int) -> List[Hashable]:
+        """
+        :return: the distinct ids that k draws in a row could assign, at most k
+        """
+        return self.sample(pool, k)
+
+    def local_pool(self, pool: UnassignedPool, ids: List[Hashable]) -> UnassignedPool:
+        """
+        :return: a pool of only the given ids with their remaining counts
+        """
+        return UnassignedPool((key, pool[key]) for key in ids)
+
+    def sample_many(
+        self, pool: UnassignedPool, users: List[str], k: int, exclude: Dict[str, Iterable[Hashable]] = None
+    ) -> Dict[str, List[Hashable]]:
+        """
+        Draws k instances for each of the users, as if they were served one
+        after another. The pool is only visited once to draw the candidates
+        for all of them, which are then dealt out from a pool of their own.
+        The ids in exclude[user], e.g. those the user already has, are never
+        drawn for that user
+        :return: the instance ids of every user
+        """
+        exclude = {} if exclude is None else {user: list(ids) for user, ids in exclude.items()}
+        if len(users) == 1:
+            with pool.without(exclude.get(users[0], ())):
+                return {users[0]: self.sample(pool, k)}
+
+        # draw enough candidates that every user gets k of them after exclusion
+        extra = sum(len(ids) for ids in exclude.values())
+        local = self.local_pool(pool, self.candidates(pool, len(users) * k + extra))
+        sampled = {}
+        for username in users:
+            with local.without(exclude.get(username, ())):
+                sampled[username] = keys = self.sample(local, k)
+            for key in keys:
+                local[key] -= 1
+                if local[key] <= 0:
+                    del local[key]
+        return sampled
+
+
+class RandomStrategy(SamplingStrategy):
+    """
+    Draws the instances needing the most labels, at random between those
+    needing the same number
+    """
+
+    def sample(self, pool: UnassignedPool, k: int) -> List[Hashable]:
+        return pool.sample_least_covered(k, self.random)
+
+
+class OrderedStrategy(SamplingStrategy):
+    """
+    Draws instances in the order of the data
+    """
+
+    def sample(self, pool: UnassignedPool, k: int) -> List[Hashable]:
+        return pool.first(k)
+
+
+class StratifiedStrategy(SamplingStrategy):
+    """
+    Draws the least covered instances of each stratum in the given
+    proportions, evenly by default. Needs the pool to be a StratifiedPool
+    """
+
+    def __init__(self, random: Random, proportions: Dict[Hashable, float] = None, **kwargs):
+        super().__init__(random, **kwargs)
+        self.proportions = None
+        if proportions is not None:
+            self.proportions = {str(stratum): share for stratum, share in proportions.items()}
+
+    def sample(self, pool: StratifiedPool, k: int) -> List[Hashable]:
+        if not isinstance(pool, StratifiedPool):
+            raise Exception(
+                "The stratified sampling strategy needs the instance field to stratify by in automatic_assignment.stratify_by"
+            )
+        return pool.sample_stratified(k, self.random, self.proportions)
+
+    def local_pool(self, pool: StratifiedPool, ids: List[Hashable]) -> StratifiedPool:
+        return StratifiedPool(pool.get_stratum, ((key, pool[key]) for key in ids))
+
+
+SAMPLING_STRATEGIES = {
+    "random": RandomStrategy,
+    "ordered": OrderedStrategy,
+    "stratified": StratifiedStrategy,
+}
+
+
+def load_sampling_strategy(name: str, random: Random, **kwargs) -> SamplingStrategy:
+    """
+    :return: the strategy registered under name, or the SamplingStrategy
+      subclass at that dotted path
+    """
+    if name in SAMPLING_STRATEGIES:
+        cls = SAMPLING_STRATEGIES[name]
+    elif "." in name:
+        cls = get_class(name)
+    else:
+        raise Exception(
+            "Unknown sampling strategy %s, use one of %s or the path of a SamplingStrategy class"
+            % (name, ", ".join(SAMPLING_STRATEGIES))
+        )
+    if not (isinstance(cls, type) and issubclass(cls, SamplingStrategy)):
+        raise Exception("Sampling strategy %s is not a SamplingStrategy" % name)
+    return cls(random, **kwargs)
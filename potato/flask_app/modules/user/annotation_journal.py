@@ -0,0 +1,350 @@
+"""
+module: user
+filename: annotation_journal.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the user module which persists the annotations of a
+  user as an append-only journal, annotated_instances.journal.jsonl.
+  Saving only appends a record for each instance that changed, a record
+  without annotations (a tombstone) removes the instance again. The last
+  record of an instance wins when the journal is replayed. The journal is
+  the live copy of the annotations. annotated_instances.jsonl, with one
+  record per annotated instance for the scripts reading it, is only
+  rewritten from it when the journal is compacted, every few seconds by a
+  background thread and at shutdown
+"""
+
+import json
+import logging
+import os
+import time
+from queue import Empty, Queue
+from threading import Lock, RLock, Thread
+from typing import Dict, Iterable, List, Optional
+
+_logger = logging.getLogger("AnnotationJournal")
+
+ANNOTATION_JOURNAL_FILENAME = "annotated_instances.journal.jsonl"
+# the current annotations, one record per instance
+ANNOTATED_INSTANCES_FILENAME = "annotated_instances.jsonl"
+# the key marking a record that removes the annotations of an instance
+DELETED_KEY = "deleted"
+
+# journals are compacted once they hold this many records and more than
+# COMPACT_FACTOR records per annotated instance
+DEFAULT_MIN_RECORDS = 1000
+COMPACT_FACTOR = 2
+# how often annotated_instances.jsonl catches up with the journals
+DEFAULT_MATERIALIZE_SECONDS = 60.0
+
+
+def tombstone(instance_id: str) -> dict:
+    """
+    :return: the record removing the annotations of an instance
+    """
+    return {"id": instance_id, DELETED_KEY: True}
+
+
+def _replay_lines(lines: Iterable[str], path: str, latest: Dict[str, dict]) -> int:
+    """
+    Applies the records to latest, the last record of every instance
+    :return: the number of records read
+    """
+    records = 0
+    for line_no, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a crash can cut a record short, the records after it are fine
+            _logger.warning("Ignoring incomplete record on line %d of %s" % (line_no + 1, path))
+            continue
+        records += 1
+        # the last record of an instance also goes last
+        latest.pop(record["id"], None)
+        if not record.get(DELETED_KEY, False):
+            latest[record["id"]] = record
+    return records
+
+
+def _write_records(path: str, records: Iterable[dict]):
+    """
+    Replaces the file at path with the records, atomically
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wt") as w:
+        for record in records:
+            w.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, path)
+
+
+class AnnotationJournal:
+    """
+    The annotation journal in a user's directory. It counts the records in
+    the file and the instances they annotate to know when to compact
+    """
+
+    def __init__(self, user_dir: str, min_records: int = DEFAULT_MIN_RECORDS):
+        self.path = os.path.join(user_dir, ANNOTATION_JOURNAL_FILENAME)
+        self.annotated_instances_path = os.path.join(user_dir, ANNOTATED_INSTANCES_FILENAME)
+        self.min_records = min_records
+        self._records = 0
+        self._live = 0
+        # whether the last record in the file was cut short
+        self._needs_newline = False
+        # whether annotated_instances.jsonl is behind the journal
+        self._stale = False
+
+    def replay(self) -> List[dict]:
+        """
+        Reads the journal, keeping the last record of every instance and
+        dropping the instances whose last record is a tombstone
+        :return: the annotated instances, the most recently saved last
+        """
+        latest = {}
+        if not os.path.exists(self.path) and os.path.exists(self.annotated_instances_path):
+            # annotations saved before there was a journal become its first records
+            with open(self.annotated_instances_path, "rt") as r:
+                _replay_lines(r, self.annotated_instances_path, latest)
+            _write_records(self.path, latest.values())
+            _write_records(self.annotated_instances_path, latest.values())
+
+        data = b""
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as r:
+                data = r.read()
+        return self.replay_data(data)
+
+    def replay_data(self, data: bytes) -> List[dict]:
+        """
+        replay for the contents of the journal, already read
+        """
+        latest = {}
+        self._records = _replay_lines(data.decode("utf-8").splitlines(), self.path, latest)
+        self._needs_newline = len(data) > 0 and data[-1:] != b"\n"
+        self._live = len(latest)
+        return list(latest.values())
+
+    def append(self, records: List[dict], live: int):
+        """
+        Appends records to the journal. live is (about) the number of
+        instances the user annotated after these changes
+        """
+        self._live = live
+        if len(records) == 0:
+            return
+        with open(self.path, "at") as w:
+            if self._needs_newline:
+                w.write("\n")
+                self._needs_newline = False
+            for record in records:
+                w.write(json.dumps(record) + "\n")
+        self._records += len(records)
+        self._stale = True
+
+    def needs_compaction(self) -> bool:
+        return self._records >= max(self.min_records, COMPACT_FACTOR * self._live)
+
+    def is_stale(self) -> bool:
+        return self._stale
+
+    def mark_stale(self):
+        self._stale = True
+
+    def materialize(self, lock: Lock):
+        """
+        Rewrites annotated_instances.jsonl with the current annotations if
+        records were appended since it was last written. Records appended
+        while this runs leave it stale for the next time
+        """
+        with lock:
+            if not self._stale or not os.path.exists(self.path):
+                return
+            size = os.path.getsize(self.path)
+            self._stale = False
+
+        latest = {}
+        with open(self.path, "rb") as r:
+            _replay_lines(r.read(size).decode("utf-8").splitlines(), self.path, latest)
+        # only the background thread writes the file once the journal exists
+        _write_records(self.annotated_instances_path, latest.values())
+
+    def compact(self, lock: Lock):
+        """
+        Rewrites the journal with only the last record of every instance.
+        The file is read and rewritten without holding lock, which guards
+        the appends, and only the records appended meanwhile are copied
+        over while holding it. The file is replaced atomically, and
+        annotated_instances.jsonl is rewritten along with it
+        """
+        with lock:
+            if not os.path.exists(self.path):
+                return
+            size = os.path.getsize(self.path)
+
+        latest = {}
+        with open(self.path, "rb") as r:
+            _replay_lines(r.read(size).decode("utf-8").splitlines(), self.path, latest)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wt") as w:
+            for record in latest.values():
+                w.write(json.dumps(record) + "\n")
+
+        with lock:
+            with open(self.path, "rb") as r:
+                r.seek(size)
+                tail = r.read().decode("utf-8")
+            tail_records = 0
+            if len(tail) > 0:
+                tail_records = _replay_lines(tail.splitlines(), self.path, latest)
+                with open(tmp_path, "at") as w:
+                    w.write(tail if tail[-1] == "\n" else tail + "\n")
+            os.replace(tmp_path, self.path)
+            self._needs_newline = False
+            self._stale = False
+            self._records = len(latest) + tail_records
+            self._live = len(latest)
+        _write_records(self.annotated_instances_path, latest.values())
+        _logger.debug("Compacted the annotation journal %s" % self.path)
+
+
+class JournalCompactor:
+    """
+    Compacts the journals handed to schedule() one after another on a
+    background thread, so that no request waits for a compaction. Every
+    materialize_seconds the same thread rewrites annotated_instances.jsonl
+    of the journals appended to since. A journal scheduled again before its
+    turn is only compacted once
+    """
+
+    def __init__(self, materialize_seconds: float = DEFAULT_MATERIALIZE_SECONDS):
+        self.materialize_seconds = materialize_seconds
+        self._queue = Queue()
+        self._scheduled = set()
+        # journal path -> (journal, lock) of every journal appended to
+        self._journals = {}
+        self._lock = Lock()
+        # held while writing files, so a flush at shutdown waits for the thread
+        self._write_lock = RLock()
+        self._thread = None
+
+    def schedule(self, journal: AnnotationJournal, lock: Lock):
+        with self._lock:
+            self._journals[journal.path] = (journal, lock)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="AnnotationJournalCompactor", daemon=True)
+                self._thread.start()
+            if not journal.needs_compaction() or journal.path in self._scheduled:
+                return
+            self._scheduled.add(journal.path)
+        self._queue.put((journal, lock))
+
+    def forget(self, path: str):
+        """
+        Brings annotated_instances.jsonl of a journal up to date one last
+        time and stops writing it, e.g. before its directory is moved
+        """
+        with self._lock:
+            entry = self._journals.pop(path, None)
+        if entry is not None:
+            journal, lock = entry
+            with self._write_lock:
+                journal.materialize(lock)
+
+    def materialize_all(self):
+        """
+        Rewrites annotated_instances.jsonl of every journal that is behind
+        """
+        with self._lock:
+            journals = list(self._journals.values())
+        with self._write_lock:
+            for journal, lock in journals:
+                try:
+                    journal.materialize(lock)
+                except Exception as e:
+                    _logger.error("Could not write %s: %s" % (journal.annotated_instances_path, repr(e)))
+
+    def _run(self):
+        next_materialize = time.monotonic() + self.materialize_seconds
+        while True:
+            timeout = None
+            if self.materialize_seconds > 0:
+                timeout = max(0, next_materialize - time.monotonic())
+            try:
+                journal, lock = self._queue.get(timeout=timeout)
+                with self._lock:
+                    self._scheduled.discard(journal.path)
+                with self._write_lock:
+                    journal.compact(lock)
+            except Empty:
+                pass
+            except Exception as e:
+                _logger.error("Could not compact the annotation journal %s: %s" % (journal.path, repr(e)))
+
+            if self.materialize_seconds > 0 and time.monotonic() >= next_materialize:
+                self.materialize_all()
+                next_materialize = time.monotonic() + self.materialize_seconds
+
+
+_annotation_journals = {}
+_compactor = JournalCompactor()
+
+
+def get_annotation_journal(
+    username: str, user_dir: str, min_records: int = DEFAULT_MIN_RECORDS
+) -> AnnotationJournal:
+    """
+    :return: the annotation journal of a user, created on first use
+    """
+    journal = _annotation_journals.get(username)
+    if journal is None:
+        journal = _annotation_journals[username] = AnnotationJournal(user_dir, min_records)
+    return journal
+
+
+def set_annotation_journal(username: str, journal: AnnotationJournal):
+    """
+    Registers the journal of a user that was replayed elsewhere, e.g. by a
+    worker process
+    """
+    previous = _annotation_journals.get(username)
+    # annotated_instances.jsonl may still be behind the replayed journal
+    if previous is not None and previous.is_stale():
+        journal.mark_stale()
+    _annotation_journals[username] = journal
+
+
+def close_annotation_journal(username: str) -> Optional[AnnotationJournal]:
+    """
+    Forgets the annotation journal of a user, e.g. when their directory is
+    moved or their state is loaded again
+    """
+    journal = _annotation_journals.pop(username, None)
+    if journal is not None:
+        _compactor.forget(journal.path)
+    return journal
+
+
+def schedule_compaction(journal: AnnotationJournal, lock: Lock):
+    """
+    Called after appending to a journal. Compacts the journal in the
+    background if it needs it, and has annotated_instances.jsonl rewritten
+    with the next ones. lock must be held by anyone appending to it
+    """
+    _compactor.schedule(journal, lock)
+
+
+def set_materialize_seconds(seconds: float):
+    """
+    Sets how often annotated_instances.jsonl is rewritten from the journals,
+    0 to only rewrite it at compaction and at shutdown
+    """
+    _compactor.materialize_seconds = seconds
+
+
+def flush_annotation_journals():
+    """
+    Rewrites annotated_instances.jsonl of every journal that is behind, at
+    shutdown
+    """
+    _compactor.materialize_all()
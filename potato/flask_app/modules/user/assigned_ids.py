@@ -0,0 +1,114 @@
+"""
+module: user
+filename: assigned_ids.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the user module which reads and writes the
+  assigned_user_data.json file of every user. The file holds the list of
+  instance ids assigned to the user, the instances themselves are looked
+  up in the shared instance store. Files written by older versions map
+  every id to a copy of its instance and are rewritten when first read,
+  keeping the old file as assigned_user_data.json.bak
+"""
+
+import json
+import logging
+import os
+from typing import Iterable, List
+
+_logger = logging.getLogger("AssignedIds")
+
+ASSIGNED_IDS_FILENAME = "assigned_user_data.json"
+# the old file holding copies of the instances, kept when it is rewritten
+BACKUP_SUFFIX = ".bak"
+
+
+def get_assigned_ids_path(user_dir: str) -> str:
+    return os.path.join(user_dir, ASSIGNED_IDS_FILENAME)
+
+
+def save_assigned_ids(user_dir: str, instance_ids: Iterable[str]):
+    """
+    Writes the ids assigned to a user. The file is replaced atomically so a
+    crash never leaves a user without their assignment
+    """
+    path = get_assigned_ids_path(user_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as w:
+        json.dump(list(instance_ids), w)
+    os.replace(tmp_path, path)
+
+
+def load_assigned_ids(user_dir: str, migrate: bool = True) -> List[str]:
+    """
+    Reads the ids assigned to a user. An old file holding copies of the
+    instances is rewritten as a list of ids, unless migrate is False
+    :return: the ids in the order they were assigned
+    """
+    with open(get_assigned_ids_path(user_dir), "rb") as r:
+        return parse_assigned_ids(user_dir, r.read(), migrate)
+
+
+def parse_assigned_ids(user_dir: str, data: bytes, migrate: bool = True) -> List[str]:
+    """
+    load_assigned_ids for the contents of the file, already read
+    """
+    path = get_assigned_ids_path(user_dir)
+    assigned = json.loads(data)
+
+    if isinstance(assigned, list):
+        return assigned
+
+    # the keys keep the order the instances were assigned in
+    instance_ids = list(assigned.keys())
+    if migrate:
+        _migrate(user_dir, data, instance_ids)
+        _logger.info(
+            "Migrated %s to a list of %d instance ids, the old file is kept as %s"
+            % (path, len(instance_ids), path + BACKUP_SUFFIX)
+        )
+    return instance_ids
+
+
+def _migrate(user_dir: str, data: bytes, instance_ids: List[str]):
+    """
+    Rewrites an old file as a list of ids. The copies of the instances it
+    holds may be the only ones left of instances removed from the data
+    files, so the old file is written to a backup first, unless there is one
+    """
+    backup_path = get_assigned_ids_path(user_dir) + BACKUP_SUFFIX
+    if not os.path.exists(backup_path):
+        tmp_path = backup_path + ".tmp"
+        with open(tmp_path, "wb") as w:
+            w.write(data)
+        os.replace(tmp_path, backup_path)
+    save_assigned_ids(user_dir, instance_ids)
+
+
+def migrate_assigned_ids(output_annotation_dir: str) -> int:
+    """
+    Rewrites the old assigned_user_data.json file of every user under the
+    annotation output directory, including archived users, keeping a backup
+    of each
+    :return: the number of files migrated
+    """
+    migrated = 0
+    user_dirs = []
+    for name in os.listdir(output_annotation_dir):
+        user_dir = os.path.join(output_annotation_dir, name)
+        if name == "archived_users" and os.path.isdir(user_dir):
+            user_dirs += [os.path.join(user_dir, archived) for archived in os.listdir(user_dir)]
+        else:
+            user_dirs.append(user_dir)
+
+    for user_dir in user_dirs:
+        path = get_assigned_ids_path(user_dir)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as r:
+            data = r.read()
+        assigned = json.loads(data)
+        if isinstance(assigned, dict):
+            _migrate(user_dir, data, list(assigned.keys()))
+            migrated += 1
+    return migrated
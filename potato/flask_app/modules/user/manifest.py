@@ -0,0 +1,106 @@
+"""
+module: user
+filename: manifest.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the user module which saves the finished and
+  assigned instance counts of every user in one small file. At startup
+  the running statistics are filled from it, so that the states of the
+  users only need to be loaded once they log in. Users whose files
+  changed after the manifest was written are loaded to recount them
+"""
+
+import json
+import logging
+import os
+from threading import Lock
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from potato.flask_app.modules.user.annotation_journal import ANNOTATION_JOURNAL_FILENAME
+
+_logger = logging.getLogger("UserManifest")
+
+MANIFEST_FILENAME = ".user_manifest.json"
+# the files of a user whose counts the manifest holds
+USER_STATE_FILENAMES = ["assigned_user_data.json", ANNOTATION_JOURNAL_FILENAME, "annotation_order.txt"]
+DEFAULT_SAVE_SECONDS = 10.0
+
+
+class UserManifest:
+    """
+    The manifest in the annotation output directory. save_soon() is called
+    after every change and writes the manifest at most every save_seconds
+    """
+
+    def __init__(self, output_annotation_dir: str, save_seconds: float = DEFAULT_SAVE_SECONDS):
+        self.output_annotation_dir = output_annotation_dir
+        self.path = os.path.join(output_annotation_dir, MANIFEST_FILENAME)
+        self.save_seconds = save_seconds
+        self._saved_at = None
+        self._last_save = 0.0
+        self._lock = Lock()
+
+    def load(self) -> Dict[str, Tuple[int, int]]:
+        """
+        :return: the finished and assigned counts of every user in the
+          manifest, or nothing if there is no manifest
+        """
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as r:
+                manifest = json.load(r)
+        except ValueError:
+            _logger.warning("Ignoring unreadable user manifest %s" % self.path)
+            return {}
+        self._saved_at = os.path.getmtime(self.path)
+        return {username: tuple(counts) for username, counts in manifest["users"].items()}
+
+    def is_current(self, username: str) -> bool:
+        """
+        :return: whether none of the files of a user changed after the
+          manifest was written
+        """
+        if self._saved_at is None:
+            return False
+        user_dir = os.path.join(self.output_annotation_dir, username)
+        for filename in USER_STATE_FILENAMES:
+            path = os.path.join(user_dir, filename)
+            if os.path.exists(path) and os.path.getmtime(path) > self._saved_at:
+                return False
+        return True
+
+    def save(self, counts: Dict[str, Tuple[int, int]]):
+        """
+        Writes the counts of every user. The file is replaced atomically
+        """
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as w:
+                json.dump({"users": {username: list(c) for username, c in counts.items()}}, w)
+            os.replace(tmp_path, self.path)
+            self._last_save = time.monotonic()
+
+    def save_soon(self, get_counts: Callable[[], Dict[str, Tuple[int, int]]]):
+        """
+        Writes the manifest unless it was written within save_seconds
+        """
+        if time.monotonic() - self._last_save < self.save_seconds:
+            return
+        try:
+            self.save(get_counts())
+        except OSError as e:
+            _logger.error("Could not save the user manifest %s: %s" % (self.path, repr(e)))
+
+
+_user_manifest: Optional[UserManifest] = None
+
+
+def set_user_manifest(manifest: UserManifest):
+    global _user_manifest
+    _user_manifest = manifest
+
+
+def get_user_manifest() -> Optional[UserManifest]:
+    return _user_manifest
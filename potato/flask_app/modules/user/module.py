@@ -11,11 +11,41 @@ desc: Defines the data associated with users that goes beyon
 import logging
 import os
 import os.path
-import json
 import re
+import time
 from collections import defaultdict
 
-from potato.flask_app.modules.project.task import assign_instances_to_user
+from potato.flask_app.modules.annotation.module import is_agreement_stopping, tally_agreement_labels
+from potato.flask_app.modules.project.locks import user_lock
+from potato.flask_app.modules.project.statistics import (
+    checked,
+    get_user_statistics,
+    update_user_statistics,
+)
+from potato.flask_app.modules.project.task import assign_instances_to_user, assign_next_batch
+from potato.flask_app.modules.user.annotation_journal import (
+    DEFAULT_MATERIALIZE_SECONDS,
+    DEFAULT_MIN_RECORDS,
+    flush_annotation_journals,
+    get_annotation_journal,
+    schedule_compaction,
+    set_annotation_journal,
+    set_materialize_seconds,
+    tombstone,
+)
+from potato.flask_app.modules.user.restore import (
+    parse_user_files,
+    read_raw_user_files,
+    read_user_files,
+    reconcile_user_files,
+)
+from potato.flask_app.modules.user.manifest import (
+    DEFAULT_SAVE_SECONDS,
+    UserManifest,
+    get_user_manifest,
+    set_user_manifest,
+)
+from potato.flask_app.modules.user.state_cache import DEFAULT_IDLE_SECONDS, UserStateCache
 from potato.server_utils.config_utils import config
 from potato.server_utils.module_utils import Module, module_getter
 
@@ -25,11 +55,19 @@ _logger = logging.getLogger("UserLogger")
 def __get_module():
     return Module(
         configuration=UserConfiguration,
+        cleanup=cleanup,
     )
 
 @config
 class UserConfiguration:
     debug: bool = False
+    annotation_journal_min_records: int = DEFAULT_MIN_RECORDS
+    annotated_instances_save_seconds: float = DEFAULT_MATERIALIZE_SECONDS
+    load_users_on_start: bool = False
+    max_resident_users: int = 0
+    max_resident_instances: int = 0
+    user_state_idle_seconds: float = DEFAULT_IDLE_SECONDS
+    user_manifest_save_seconds: float = DEFAULT_SAVE_SECONDS
 
 
 def start():
@@ -41,22 +79,84 @@ def start():
         if 'authorized_users' in user_config_data:
             for user in user_config_data["authorized_users"]:
                 user_config.authorized_users.append(user)
+
+    set_materialize_seconds(UserConfiguration.annotated_instances_save_seconds)
     
-    # load users with annotations to user_to_annotation_state
+    # the states of the users are loaded when they are first looked up and
+    # the least recently used are evicted once there are too many
+    global user_to_annotation_state
+    user_to_annotation_state = UserStateCache(
+        _read_user_state,
+        _flush_user_state,
+        UserConfiguration.max_resident_users,
+        UserConfiguration.max_resident_instances,
+        UserConfiguration.user_state_idle_seconds,
+    )
+
+    # register users with annotations in user_to_annotation_state
     users_with_annotations = [
         f
         for f in os.listdir(config["output_annotation_dir"])
-        if os.path.isdir(os.path.join(config["output_annotation_dir"],f)) and f != 'archived_users'
+        if os.path.isdir(os.path.join(config["output_annotation_dir"],f))
+        and f != 'archived_users' and not f.startswith('.')
     ]
+    user_to_annotation_state.add_known(users_with_annotations)
+
+    # the statistics of users are read from the manifest, only users that
+    # changed since it was written are loaded to count them again
+    manifest = UserManifest(config["output_annotation_dir"], UserConfiguration.user_manifest_save_seconds)
+    set_user_manifest(manifest)
+    manifest_counts = manifest.load()
+    users_to_load = []
+    # the label tally of agreement_stopping needs the labels of every user
+    load_all = UserConfiguration.load_users_on_start or is_agreement_stopping()
     for user in users_with_annotations:
-        load_user_state(user)
+        if load_all or user not in manifest_counts or not manifest.is_current(user):
+            users_to_load.append(user)
+        else:
+            get_user_statistics().update(user, *manifest_counts[user])
+    restore_user_states(users_to_load)
+    manifest.save(get_user_statistics().get_counts())
+    _logger.info(
+        "Found %d users, loaded %d of them and read the rest from %s"
+        % (len(users_with_annotations), len(users_to_load), manifest.path)
+    )
+
+def cleanup():
+    # annotated_instances.jsonl is only rewritten now and then while running
+    flush_annotation_journals()
+
+# the kinds of pages a user is assigned
+SURVEY_PAGE = "survey"
+PRESTUDY_PAGE = "prestudy"
+REAL_INSTANCE = "real"
+
+_instance_kinds = {}
+
+
+def get_instance_kind(instance_id):
+    """
+    Classifies an instance id as a survey page, a prestudy question or a real
+    instance. The kind of every id is only worked out once
+    """
+    kind = _instance_kinds.get(instance_id)
+    if kind is None:
+        if instance_id[-4:] == 'html':
+            kind = SURVEY_PAGE
+        elif instance_id[:8] == 'prestudy':
+            kind = PRESTUDY_PAGE
+        else:
+            kind = REAL_INSTANCE
+        _instance_kinds[instance_id] = kind
+    return kind
+
 
 class UserAnnotationState:
     """
     A class for maintaining state on which annotations users have completed.
     """
 
-    def __init__(self, assigned_user_data):
+    def __init__(self, assigned_ids):
 
         # This data structure keeps the label-based annotations the user has
         # completed so far
@@ -66,23 +166,22 @@ class UserAnnotationState:
         # completed so far
         self.instance_id_to_span_annotations = {}
 
-        # This is a reference to the data
-        #
-        # NB: do we need this as a field?
-        self.instance_id_to_data = assigned_user_data
-
         # TODO: Put behavioral information of each instance with the labels
         # together however, that requires too many changes of the data structure
         # therefore, we contruct a separate dictionary to save all the
         # behavioral information (e.g. time, click, ..)
         self.instance_id_to_behavioral_data = {}
 
+        # The instances whose annotations changed since they were last saved
+        self.changed_instance_ids = set()
+
         # NOTE: this might be dumb but at the moment, we cache the order in
         # which this user will walk the instances. This might not work if we're
         # annotating a ton of things with a lot of people, but hopefully it's
         # not too bad. The underlying motivation is to programmatically change
-        # this ordering later
-        self.instance_id_ordering = list(assigned_user_data.keys())
+        # this ordering later. Only the ids are kept here, the instances
+        # are looked up in the shared instance store
+        self.instance_id_ordering = list(assigned_ids)
 
         # initialize the mapping from instance id to order
         self.instance_id_to_order = self.generate_id_order_mapping(self.instance_id_ordering)
@@ -101,27 +200,56 @@ class UserAnnotationState:
         # Total annotation instances assigned to a user
         self.real_instance_assigned_count = 0
 
+        # The real instances in the queue and the instances (except survey
+        # pages) the user annotated, kept up to date as the state changes
+        self.real_instance_count = self._count_real_instances(self.instance_id_ordering)
+        self.finished_instance_count = 0
+
+    @staticmethod
+    def _count_real_instances(instance_ids):
+        return sum(1 for it in instance_ids if get_instance_kind(it) == REAL_INSTANCE)
+
+    def _is_finished(self, instance_id):
+        return get_instance_kind(instance_id) != SURVEY_PAGE and (
+            instance_id in self.instance_id_to_labeling
+            or len(self.instance_id_to_span_annotations.get(instance_id, [])) != 0
+        )
+
     def generate_id_order_mapping(self, instance_id_ordering):
         id_order_mapping = {}
         for i in range(len(instance_id_ordering)):
             id_order_mapping[instance_id_ordering[i]] = i
         return id_order_mapping
 
-    def add_new_assigned_data(self, new_assigned_data):
+    def add_new_assigned_ids(self, new_ids, before=()):
         """
-        Add new assigned data to the user state
+        Add newly assigned instance ids to the user state. The new instances
+        are inserted in front of the first of the `before` ids found in the
+        queue, otherwise they are appended
+        :return: the ids which were not in the queue yet and got inserted
         """
-        for key in new_assigned_data:
-            self.instance_id_to_data[key] = new_assigned_data[key]
-            self.instance_id_ordering.append(key)
+        position = len(self.instance_id_ordering)
+        for key in before:
+            if key in self.instance_id_to_order:
+                position = min(position, self.instance_id_to_order[key])
+
+        new_keys = [key for key in dict.fromkeys(new_ids) if key not in self.instance_id_to_order]
+        self.instance_id_ordering[position:position] = new_keys
         self.instance_id_to_order = self.generate_id_order_mapping(self.instance_id_ordering)
+        self.real_instance_count += self._count_real_instances(new_keys)
+        return new_keys
 
-    def get_assigned_data(self):
-        return self.instance_id_to_data
+    def get_assigned_ids(self):
+        """
+        Returns the ids of all the pages assigned to the user, in order
+        """
+        return self.instance_id_ordering
 
     def current_instance(self):
+        global instance_id_to_data
+
         inst_id = self.instance_id_ordering[self.instance_cursor]
-        instance = self.instance_id_to_data[inst_id]
+        instance = instance_id_to_data[inst_id]
         return instance
 
     def get_instance_cursor(self):
@@ -142,11 +270,11 @@ class UserAnnotationState:
             self.instance_cursor -= 1
 
     def go_forward(self):
-        if self.instance_cursor < len(self.instance_id_to_data) - 1:
+        if self.instance_cursor < len(self.instance_id_ordering) - 1:
             self.instance_cursor += 1
 
     def go_to_id(self, _id):
-        if _id < len(self.instance_id_to_data) and _id >= 0:
+        if _id < len(self.instance_id_ordering) and _id >= 0:
             self.instance_cursor = _id
 
     def get_all_annotations(self):
@@ -216,16 +344,79 @@ class UserAnnotationState:
         """
         Check the number of assigned instances for a user (only the core annotation parts)
         """
-        return len([it for it in self.instance_id_ordering if it[-4:] != 'html' and it[:8] != 'prestudy'])
+        return self.real_instance_count
+
+    def get_real_assigned_instance_ids(self):
+        """
+        Returns the assigned instances (only the core annotation parts)
+        """
+        return [it for it in self.instance_id_ordering if get_instance_kind(it) == REAL_INSTANCE]
+
+    def get_remaining_real_instance_count(self):
+        """
+        Returns the number of instances (only the core annotation parts) after the cursor the user has not annotated yet
+        """
+        return len([
+            it
+            for it in self.instance_id_ordering[self.instance_cursor + 1:]
+            if get_instance_kind(it) == REAL_INSTANCE
+            and it not in self.instance_id_to_labeling
+            and len(self.instance_id_to_span_annotations.get(it, [])) == 0
+        ])
+
+    def get_unfinished_real_instance_ids(self):
+        """
+        Returns the assigned instances (only the core annotation parts) the user has not annotated yet
+        """
+        return [
+            it
+            for it in self.instance_id_ordering
+            if get_instance_kind(it) == REAL_INSTANCE
+            and it not in self.instance_id_to_labeling
+            and len(self.instance_id_to_span_annotations.get(it, [])) == 0
+        ]
+
+    def remove_assigned_instances(self, instance_ids):
+        """
+        Takes instances out of the user's queue, e.g. when their lease expired
+        """
+        instance_ids = set(instance_ids)
+        if len(instance_ids) == 0:
+            return
+
+        current_id = self.instance_id_ordering[self.instance_cursor]
+        self.instance_id_ordering = [it for it in self.instance_id_ordering if it not in instance_ids]
+        self.instance_id_to_order = self.generate_id_order_mapping(self.instance_id_ordering)
+        self.real_instance_count = self.count_real_assigned_instances()
+        self.real_instance_assigned_count -= len(instance_ids)
+
+        # stay on the same page if it is still there
+        if current_id in self.instance_id_to_order:
+            self.instance_cursor = self.instance_id_to_order[current_id]
+        else:
+            self.instance_cursor = max(min(self.instance_cursor, len(self.instance_id_ordering) - 1), 0)
 
     def get_real_finished_instance_count(self):
         """
         Check the number of finished instances for a user (only the core annotation parts)
         """
-        finished_instances = [it for it in self.instance_id_to_labeling if it[-4:]!='html']
-        finished_span_instances = [it for it in self.instance_id_to_span_annotations if (it[-4:] != 'html' and len(self.instance_id_to_span_annotations[it])!=0)]
+        return self.finished_instance_count
 
-        return len(set(finished_instances + finished_span_instances))
+    def count_real_assigned_instances(self):
+        """
+        Recounts the assigned instances from scratch, for checking the running count
+        """
+        return self._count_real_instances(self.instance_id_ordering)
+
+    def count_real_finished_instances(self):
+        """
+        Recounts the finished instances from scratch, for checking the running count
+        """
+        return sum(
+            1
+            for it in set(self.instance_id_to_labeling) | set(self.instance_id_to_span_annotations)
+            if self._is_finished(it)
+        )
 
     def set_annotation(
         self, instance_id, schema_to_label_to_value, span_annotations, behavioral_data_dict
@@ -250,6 +441,8 @@ class UserAnnotationState:
         if instance_id in self.instance_id_to_span_annotations:
             old_span_annotations = self.instance_id_to_span_annotations[instance_id]
 
+        was_finished = self._is_finished(instance_id)
+
         # Avoid updating with no entries
         if len(schema_to_label_to_value) > 0:
             self.instance_id_to_labeling[instance_id] = schema_to_label_to_value
@@ -273,9 +466,23 @@ class UserAnnotationState:
         #
         # self.instance_id_to_behavioral_data[instance_id] = behavioral_data_dict
 
-        return (
-            old_annotation != schema_to_label_to_value or old_span_annotations != span_annotations
+        self.finished_instance_count += self._is_finished(instance_id) - was_finished
+
+        did_change = old_annotation != schema_to_label_to_value or old_span_annotations != span_annotations
+        if did_change:
+            self.changed_instance_ids.add(instance_id)
+        return did_change
+
+    def pop_changed_instance_ids(self):
+        """
+        Returns the instances whose annotations changed since the last call,
+        in the order of the user's queue
+        """
+        changed = sorted(
+            self.changed_instance_ids, key=lambda it: self.instance_id_to_order.get(it, len(self.instance_id_to_order))
         )
+        self.changed_instance_ids = set()
+        return changed
 
     def update(self, annotation_order, annotated_instances):
         """
@@ -315,6 +522,9 @@ class UserAnnotationState:
 
         self.instance_id_ordering = annotation_order
         self.instance_id_to_order = self.generate_id_order_mapping(self.instance_id_ordering)
+        self.real_instance_count = self.count_real_assigned_instances()
+        self.finished_instance_count = self.count_real_finished_instances()
+        self.changed_instance_ids = set()
 
         # Set the current item to be the one after the last thing that was
         # annotated
@@ -326,7 +536,7 @@ class UserAnnotationState:
             annotated_set = set([it['id'] for it in annotated_instances])
             self.instance_cursor = self.instance_id_to_order[annotated_instances[-1]['id']]
             for in_id in self.instance_id_ordering:
-                if in_id[-4:] == 'html':
+                if get_instance_kind(in_id) == SURVEY_PAGE:
                     continue
                 if in_id in annotated_set:
                     self.instance_cursor = self.instance_id_to_order[in_id]
@@ -407,18 +617,31 @@ class UserAnnotationState:
     
 def move_to_prev_instance(username):
     user_state = lookup_user_state(username)
-    user_state.go_back()
+    with user_lock(username):
+        user_state.go_back()
 
 
 def move_to_next_instance(username):
     user_state = lookup_user_state(username)
-    user_state.go_forward()
+    with user_lock(username):
+        user_state.go_forward()
+        _assign_next_batch(username)
 
 
 def go_to_id(username, _id):
     # go to specific item
     user_state = lookup_user_state(username)
-    user_state.go_to_id(int(_id))
+    with user_lock(username):
+        user_state.go_to_id(int(_id))
+        _assign_next_batch(username)
+
+
+def _assign_next_batch(username):
+    # in the incremental assignment mode, top up the queue once the user gets
+    # close to its end and remember the new order
+    if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
+        if assign_next_batch(username):
+            save_user_state(username, save_order=True)
 
 def get_users():
     """
@@ -436,38 +659,58 @@ def lookup_user_state(username):
     """
     global user_to_annotation_state
 
-    if username not in user_to_annotation_state:
-        _logger.debug('Previously unknown user "%s"; creating new annotation state' % (username))
-
-        if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
-            # when pre_annotation is set up, only assign the instance when consent question is answered
-            if "prestudy" in config and config["prestudy"]["on"]:
-                user_state = UserAnnotationState(generate_initial_user_dataflow(username))
-                user_to_annotation_state[username] = user_state
-
-            # when pre_annotation is set up, only assign the instance when consent question is answered
-            elif "pre_annotation" in config["automatic_assignment"] and "pre_annotation" in config["automatic_assignment"]["order"]:
-                user_state = UserAnnotationState(generate_initial_user_dataflow(username))
-                user_to_annotation_state[username] = user_state
+    # known users are looked up without locking, and loaded if their state
+    # is not in memory
+    user_state = user_to_annotation_state.get(username)
+    if user_state is not None:
+        return user_state
+
+    # two first requests of a new user must only create one state
+    with user_lock(username):
+        user_state = user_to_annotation_state.get(username)
+        if user_state is None:
+            _logger.debug('Previously unknown user "%s"; creating new annotation state' % (username))
+
+            if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
+                # when pre_annotation is set up, only assign the instance when consent question is answered
+                if "prestudy" in config and config["prestudy"]["on"]:
+                    user_state = UserAnnotationState(generate_initial_user_dataflow(username))
+                    user_to_annotation_state[username] = user_state
+
+                # when pre_annotation is set up, only assign the instance when consent question is answered
+                elif "pre_annotation" in config["automatic_assignment"] and "pre_annotation" in config["automatic_assignment"]["order"]:
+                    user_state = UserAnnotationState(generate_initial_user_dataflow(username))
+                    user_to_annotation_state[username] = user_state
+
+                # assign instances to new user when automatic assignment is turned on and there is no pre_annotation or prestudy pages
+                else:
+                    user_state = UserAnnotationState(generate_initial_user_dataflow(username))
+                    user_to_annotation_state[username] = user_state
+                    assign_instances_to_user(username)
 
-            # assign instances to new user when automatic assignment is turned on and there is no pre_annotation or prestudy pages
             else:
-                user_state = UserAnnotationState(generate_initial_user_dataflow(username))
+                # assign all the instance to each user when automatic assignment is turned off
+                user_state = UserAnnotationState(instance_id_to_data.keys())
+                user_state.real_instance_assigned_count = user_state.get_assigned_instance_count()
                 user_to_annotation_state[username] = user_state
-                assign_instances_to_user(username)
 
-        else:
-            # assign all the instance to each user when automatic assignment is turned off
-            user_state = UserAnnotationState(instance_id_to_data)
-            user_state.real_instance_assigned_count = user_state.get_assigned_instance_count()
-            user_to_annotation_state[username] = user_state
-    else:
-        user_state = user_to_annotation_state[username]
+            update_user_statistics(username, user_state)
 
     return user_state
 
 
 def save_user_state(username, save_order=False):
+    # the files of a user are written by one request at a time
+    with user_lock(username):
+        _save_user_state(username, save_order)
+
+
+def _flush_user_state(username, user_state):
+    # called before the state of an idle user is evicted from memory
+    _save_user_state(username, user_state=user_state)
+
+
+def _save_user_state(username, save_order=False, user_state=None):
     global user_to_annotation_state
     global instance_id_to_data
 
@@ -477,7 +720,8 @@ def save_user_state(username, save_order=False):
     # NB: Do some kind of sanitizing on the username to improve security
     user_dir = os.path.join(output_annotation_dir, username)
 
-    user_state = lookup_user_state(username)
+    if user_state is None:
+        user_state = lookup_user_state(username)
 
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
@@ -490,32 +734,54 @@ def save_user_state(username, save_order=False):
                 # JIAXIN: output id has to be str
                 outf.write(str(inst) + "\n")
 
-    annotated_instances_fname = os.path.join(user_dir, "annotated_instances.jsonl")
-
-    with open(annotated_instances_fname, "wt") as outf:
-        for inst_id, data in user_state.get_all_annotations().items():
-            bd_dict = {}
-            if inst_id in user_state.instance_id_to_behavioral_data:
-                bd_dict = user_state.instance_id_to_behavioral_data[inst_id]
-
-            output = {
-                "id": inst_id,
-                "displayed_text": instance_id_to_data[inst_id]["displayed_text"],
-                "label_annotations": data["labels"],
-                "span_annotations": data["spans"],
-                "behavioral_data": bd_dict,
-            }
-            json.dump(output, outf)
-            outf.write("\n")
+    # only the instances that changed since the last save are appended to
+    # the annotation journal, an instance without annotations is removed
+    records = []
+    for inst_id in user_state.pop_changed_instance_ids():
+        labels = user_state.instance_id_to_labeling.get(inst_id)
+        spans = user_state.instance_id_to_span_annotations.get(inst_id)
+        if labels is None and spans is None:
+            records.append(tombstone(inst_id))
+            continue
+
+        bd_dict = {}
+        if inst_id in user_state.instance_id_to_behavioral_data:
+            bd_dict = user_state.instance_id_to_behavioral_data[inst_id]
+
+        records.append({
+            "id": inst_id,
+            "displayed_text": instance_id_to_data[inst_id]["displayed_text"],
+            "label_annotations": labels if labels is not None else {},
+            "span_annotations": spans if spans is not None else {},
+            "behavioral_data": bd_dict,
+        })
+
+    journal = get_annotation_journal(username, user_dir, UserConfiguration.annotation_journal_min_records)
+    journal.append(records, user_state.get_real_finished_instance_count())
+    if len(records) > 0:
+        # the journal is the live copy, annotated_instances.jsonl catches up
+        # with it in the background
+        schedule_compaction(journal, user_lock(username))
+
+    # the counts of the user are saved along with everyone else's now and then
+    manifest = get_user_manifest()
+    if manifest is not None:
+        manifest.save_soon(get_user_statistics().get_counts)
 
 def get_finished_user_count():
     """
         return the number of users who have finished the task
     """
+    return checked(
+        "finished users", get_user_statistics().finished_users, _count_finished_users
+    )
+
+
+def _count_finished_users():
     global user_to_annotation_state
     cnt = 0
-    for user_state in user_to_annotation_state.values():
-        if user_state.get_real_finished_instance_count() >= user_state.get_real_assigned_instance_count():
+    for user_state in list(user_to_annotation_state.values()):
+        if user_state.count_real_finished_instances() >= user_state.count_real_assigned_instances():
             cnt += 1
 
     return cnt
@@ -535,82 +801,16 @@ def load_user_state(username):
     Loads the user's state from disk. The state includes which instances they
     have annotated and the order in which they are expected to see instances.
     """
-    global user_to_annotation_state
-    global instance_id_to_data
-
-    # Figure out where this user's data would be stored on disk
-    user_state_dir = config["output_annotation_dir"]
-
-    # NB: Do some kind of sanitizing on the username to improve securty
-    user_dir = os.path.join(user_state_dir, username)
+    with user_lock(username):
+        return _load_user_state(username)
 
-    # User has annotated before or has assigned_data
-    if os.path.exists(user_dir):
-        _logger.debug('Found known user "%s"; loading annotation state' % (username))
-
-        # if automatic assignment is on, load assigned user data
-        if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
-            assigned_user_data_path = os.path.join(user_dir, "assigned_user_data.json")
-
-            with open(assigned_user_data_path, "r") as r:
-                assigned_user_data = json.load(r)
-        # otherwise, set the assigned user data as all the instances
-        else:
-            assigned_user_data = instance_id_to_data
-
-        annotation_order = []
-        annotation_order_fname = os.path.join(user_dir, "annotation_order.txt")
-        if os.path.exists(annotation_order_fname):
-            with open(annotation_order_fname, "rt") as f:
-                for line in f:
-                    instance_id = line[:-1]
-                    if instance_id not in assigned_user_data:
-                        _logger.warning(
-                            (
-                                "Annotation state for %s does not match "
-                                + "instances in existing dataset at %s"
-                            )
-                            % (user_dir, ",".join(config["data_files"]))
-                        )
-                        continue
-                    annotation_order.append(line[:-1])
-
-        annotated_instances = []
-        annotated_instances_fname = os.path.join(user_dir, "annotated_instances.jsonl")
-        if os.path.exists(annotated_instances_fname):
-
-            with open(annotated_instances_fname, "rt") as f:
-                for line in f:
-                    annotated_instance = json.loads(line)
-                    instance_id = annotated_instance["id"]
-                    if instance_id not in assigned_user_data:
-                        _logger.warning(
-                            (
-                                "Annotation state for %s does not match "
-                                + "instances in existing dataset at %s"
-                            )
-                            % (user_dir, ",".join(config["data_files"]))
-                        )
-                        continue
-                    annotated_instances.append(annotated_instance)
-
-        # Ensure the current data is represented in the annotation order
-        # NOTE: this is a hack to be fixed for when old user data is in the same directory
-        for iid in assigned_user_data.keys():
-            if iid not in annotation_order:
-                annotation_order.append(iid)
-
-        user_state = UserAnnotationState(assigned_user_data)
-        user_state.update(annotation_order, annotated_instances)
-
-        # Make sure we keep track of the user throughout the program
-        user_to_annotation_state[username] = user_state
 
-        _logger.info(
-            'Loaded %d annotations for known user "%s"'
-            % (user_state.get_real_finished_instance_count(), username)
-        )
+def _load_user_state(username):
+    global user_to_annotation_state
 
+    # User has annotated before or has assigned_data. Their state is loaded
+    # unless it is already in memory
+    if user_to_annotation_state.get(username) is not None:
         return "old user loaded"
 
     # New user, so initialize state
@@ -631,7 +831,130 @@ def load_user_state(username):
 
         lookup_user_state(username)
         return "new user initialized"
-    
+
+
+def _read_user_state(username):
+    """
+    Reads the state of a user from their directory
+    :return: the UserAnnotationState or None if the user has no directory
+    """
+    # Figure out where this user's data would be stored on disk
+    user_state_dir = config["output_annotation_dir"]
+
+    # NB: Do some kind of sanitizing on the username to improve securty
+    user_dir = os.path.join(user_state_dir, username)
+
+    if os.path.exists(user_dir):
+        _logger.debug('Found known user "%s"; loading annotation state' % (username))
+        files = read_user_files(user_dir, UserConfiguration.annotation_journal_min_records)
+        user_state = _build_user_state(username, files, _reconcile_user_files(files, _get_all_assigned_ids()))
+
+        _logger.info(
+            'Loaded %d annotations for known user "%s"'
+            % (user_state.get_real_finished_instance_count(), username)
+        )
+
+        return user_state
+
+    return None
+
+
+def _get_all_assigned_ids():
+    """
+    :return: the ids assigned to every user, or None if automatic assignment
+      chooses them for each user
+    """
+    global instance_id_to_data
+
+    if "automatic_assignment" in config and config["automatic_assignment"]["on"]:
+        return None
+    return list(instance_id_to_data.keys())
+
+
+def _reconcile_user_files(files, all_ids):
+    """
+    Drops the instances of a user that are no longer in the dataset
+    :return: the assigned ids, the annotation order and the annotated instances
+    """
+    global instance_id_to_data
+
+    assigned_ids, annotation_order, annotated_instances, dropped = reconcile_user_files(
+        files, instance_id_to_data, all_ids
+    )
+    if dropped > 0:
+        _logger.warning(
+            "Annotation state for %s does not match instances in existing dataset at %s, dropped %d instances"
+            % (files.user_dir, ",".join(config["data_files"]), dropped)
+        )
+    return assigned_ids, annotation_order, annotated_instances
+
+
+def _build_user_state(username, files, reconciled):
+    """
+    Builds the state of a user from their files once they were reconciled
+    with the dataset
+    """
+    assigned_ids, annotation_order, annotated_instances = reconciled
+
+    # the journal was replayed while reading the files
+    set_annotation_journal(username, files.journal)
+
+    user_state = UserAnnotationState(assigned_ids)
+    user_state.update(annotation_order, annotated_instances)
+
+    # the caller keeps track of the user throughout the program
+    update_user_statistics(username, user_state)
+    tally_agreement_labels(username, user_state)
+    return user_state
+
+
+def restore_user_states(usernames):
+    """
+    Loads the states of many users at once, timing each step
+    :return: the seconds spent waiting for the files, parsing them, checking
+      them against the dataset and building the states
+    """
+    global user_to_annotation_state
+
+    timings = {"read": 0.0, "parse": 0.0, "reconcile": 0.0, "build": 0.0}
+    user_dirs = [os.path.join(config["output_annotation_dir"], username) for username in usernames]
+    all_ids = _get_all_assigned_ids()
+
+    start_time = time.perf_counter()
+    phase_time = start_time
+    restored = 0
+    for username, user_dir in zip(usernames, user_dirs):
+        raw = read_raw_user_files(user_dir)
+        now = time.perf_counter()
+        timings["read"] += now - phase_time
+
+        files = parse_user_files(raw, UserConfiguration.annotation_journal_min_records)
+        phase_time = time.perf_counter()
+        timings["parse"] += phase_time - now
+
+        with user_lock(username):
+            reconciled = _reconcile_user_files(files, all_ids)
+            now = time.perf_counter()
+            timings["reconcile"] += now - phase_time
+
+            user_to_annotation_state[username] = _build_user_state(username, files, reconciled)
+        phase_time = time.perf_counter()
+        timings["build"] += phase_time - now
+        restored += 1
+
+    _logger.info(
+        "Restored %d users in %.2fs (read %.2fs, parse %.2fs, reconcile %.2fs, build %.2fs)"
+        % (
+            restored,
+            time.perf_counter() - start_time,
+            timings["read"],
+            timings["parse"],
+            timings["reconcile"],
+            timings["build"],
+        )
+    )
+    return timings
+
 
 def get_cur_instance_for_user(username):
     global user_to_annotation_state
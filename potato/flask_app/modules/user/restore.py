@@ -0,0 +1,150 @@
+"""
+module: user
+filename: restore.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the user module which restores the saved states of
+  many users at once. The files of a user are read and parsed in separate
+  steps so that the time spent on each can be logged. Reading them with a
+  pool of threads was tried, but parsing json holds the GIL and the reads
+  alone gained less than a tenth even with the files out of the page cache,
+  and worker processes spend more unpickling the parsed annotations than
+  parsing them. The instance ids read are checked against the dataset with
+  sets so the cost stays linear in their number
+"""
+
+import os
+from typing import Container, List, Optional, Tuple
+
+from potato.flask_app.modules.user.annotation_journal import (
+    ANNOTATION_JOURNAL_FILENAME,
+    AnnotationJournal,
+    DEFAULT_MIN_RECORDS,
+)
+from potato.flask_app.modules.user.assigned_ids import get_assigned_ids_path, parse_assigned_ids
+
+ANNOTATION_ORDER_FILENAME = "annotation_order.txt"
+
+
+class UserFiles:
+    """
+    What was read from the directory of one user, before it is checked
+    against the dataset
+    """
+
+    def __init__(
+        self,
+        user_dir: str,
+        assigned_ids: Optional[List[str]],
+        annotation_order: List[str],
+        journal: AnnotationJournal,
+        annotated_instances: List[dict],
+    ):
+        self.user_dir = user_dir
+        # None if the user has no assigned_user_data.json
+        self.assigned_ids = assigned_ids
+        self.annotation_order = annotation_order
+        self.journal = journal
+        self.annotated_instances = annotated_instances
+
+
+class RawUserFiles:
+    """
+    The contents of the files of one user, read but not parsed yet. A file
+    the user does not have is None
+    """
+
+    def __init__(
+        self,
+        user_dir: str,
+        assigned_ids: Optional[bytes],
+        annotation_order: Optional[bytes],
+        journal: Optional[bytes],
+    ):
+        self.user_dir = user_dir
+        self.assigned_ids = assigned_ids
+        self.annotation_order = annotation_order
+        self.journal = journal
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as r:
+        return r.read()
+
+
+def read_raw_user_files(user_dir: str) -> RawUserFiles:
+    """
+    Reads the files of a user without parsing them
+    """
+    return RawUserFiles(
+        user_dir,
+        _read_file(get_assigned_ids_path(user_dir)),
+        _read_file(os.path.join(user_dir, ANNOTATION_ORDER_FILENAME)),
+        _read_file(os.path.join(user_dir, ANNOTATION_JOURNAL_FILENAME)),
+    )
+
+
+def parse_user_files(raw: RawUserFiles, min_records: int = DEFAULT_MIN_RECORDS) -> UserFiles:
+    """
+    Parses the assigned ids, the annotation order and replays the annotation
+    journal of a user
+    """
+    assigned_ids = None
+    if raw.assigned_ids is not None:
+        assigned_ids = parse_assigned_ids(raw.user_dir, raw.assigned_ids)
+
+    annotation_order = []
+    if raw.annotation_order is not None:
+        annotation_order = raw.annotation_order.decode("utf-8").splitlines()
+
+    # the last record of every instance in the annotation journal wins, a
+    # user without a journal may still have to get one from older files
+    journal = AnnotationJournal(raw.user_dir, min_records)
+    if raw.journal is None:
+        annotated_instances = journal.replay()
+    else:
+        annotated_instances = journal.replay_data(raw.journal)
+
+    return UserFiles(raw.user_dir, assigned_ids, annotation_order, journal, annotated_instances)
+
+
+def read_user_files(user_dir: str, min_records: int = DEFAULT_MIN_RECORDS) -> UserFiles:
+    """
+    Reads and parses the files of a user
+    """
+    return parse_user_files(read_raw_user_files(user_dir), min_records)
+
+
+def reconcile_user_files(
+    files: UserFiles, dataset_ids: Container[str], all_ids: Optional[List[str]] = None
+) -> Tuple[List[str], List[str], List[dict], int]:
+    """
+    Drops the ids of a user that are no longer in the dataset and makes sure
+    every assigned instance is in the annotation order. all_ids are assigned
+    to users without assigned ids (when automatic assignment is off)
+    :return: the assigned ids, the annotation order, the annotated instances
+      and the number of ids dropped
+    """
+    dropped = 0
+    if files.assigned_ids is None or all_ids is not None:
+        assigned_ids = all_ids if all_ids is not None else []
+    else:
+        assigned_ids = [instance_id for instance_id in files.assigned_ids if instance_id in dataset_ids]
+        dropped += len(files.assigned_ids) - len(assigned_ids)
+    assigned_id_set = dataset_ids if assigned_ids is all_ids else set(assigned_ids)
+
+    annotation_order = [instance_id for instance_id in files.annotation_order if instance_id in assigned_id_set]
+    annotated_instances = [
+        instance for instance in files.annotated_instances if instance["id"] in assigned_id_set
+    ]
+    dropped += len(files.annotation_order) - len(annotation_order)
+    dropped += len(files.annotated_instances) - len(annotated_instances)
+
+    # Ensure the current data is represented in the annotation order
+    ordered = set(annotation_order)
+    annotation_order += [instance_id for instance_id in assigned_ids if instance_id not in ordered]
+
+    return assigned_ids, annotation_order, annotated_instances, dropped
+
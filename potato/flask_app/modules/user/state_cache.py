@@ -0,0 +1,251 @@
+"""
+module: user
+filename: state_cache.py
+date: 10/18/2026
+author: Tristan Hilbert (aka TFlexSoom)
+desc: Helper file for the user module which keeps the states of the users
+  in memory. It knows every user but only loads the state of a user when
+  it is first looked up, and evicts the least recently used idle states,
+  saving them first, once more users or instances are held than allowed
+"""
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+import logging
+from threading import Lock
+import time
+from typing import Callable, Iterable
+
+from potato.flask_app.modules.project.locks import user_lock
+
+_logger = logging.getLogger("UserStateCache")
+
+# states used more recently than this are never evicted
+DEFAULT_IDLE_SECONDS = 60.0
+
+
+def _get_state_size(user_state) -> int:
+    """
+    :return: the instance ids a state holds, which is what its memory grows with
+    """
+    return (
+        len(user_state.instance_id_ordering)
+        + len(user_state.instance_id_to_labeling)
+        + len(user_state.instance_id_to_span_annotations)
+    )
+
+
+class UserStateCache(MutableMapping):
+    """
+    The state of every user, used like the dict it replaces. Looking up a
+    known user whose state is not in memory loads it with load(username).
+    Concurrent lookups of that user wait for the same load instead of taking
+    the user's lock, so a request holding its own user's lock can look up
+    other users without deadlocking. flush(username, state) saves a state
+    before it is evicted. A limit of 0 means no limit
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], object],
+        flush: Callable[[str, object], None],
+        max_users: int = 0,
+        max_instances: int = 0,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+    ):
+        self._load = load
+        self._flush = flush
+        self.max_users = max_users
+        self.max_instances = max_instances
+        self.idle_seconds = idle_seconds
+
+        # username -> (state, last access), least recently used first
+        self._resident = OrderedDict()
+        self._known = set()
+        # username -> the Future of the state being loaded
+        self._loading = {}
+        self._lock = Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def add_known(self, usernames: Iterable[str]):
+        """
+        Registers users whose state is saved but not loaded yet
+        """
+        with self._lock:
+            self._known.update(usernames)
+
+    def _get_resident(self, username: str):
+        with self._lock:
+            entry = self._resident.get(username)
+            if entry is None:
+                return None
+            self._resident[username] = (entry[0], time.monotonic())
+            self._resident.move_to_end(username)
+            return entry[0]
+
+    def _put_resident(self, username: str, user_state):
+        with self._lock:
+            self._known.add(username)
+            self._resident[username] = (user_state, time.monotonic())
+            self._resident.move_to_end(username)
+
+    def __getitem__(self, username: str):
+        user_state = self.get(username)
+        if user_state is None:
+            raise KeyError(username)
+        return user_state
+
+    def get(self, username: str, default=None):
+        user_state = self._get_resident(username)
+        if user_state is not None:
+            return user_state
+
+        with self._lock:
+            if username not in self._known:
+                return default
+            # another request may have loaded the user meanwhile
+            entry = self._resident.get(username)
+            if entry is not None:
+                return entry[0]
+            future = self._loading.get(username)
+            loading = future is None
+            if loading:
+                future = self._loading[username] = Future()
+
+        # only one request loads the user, the others wait for its result
+        if not loading:
+            user_state = future.result()
+            return default if user_state is None else user_state
+
+        try:
+            user_state = self._load(username)
+            if user_state is not None:
+                with self._lock:
+                    # a state set while loading wins over the one read from disk
+                    entry = self._resident.get(username)
+                    if entry is None:
+                        self._resident[username] = (user_state, time.monotonic())
+                        self.loads += 1
+                    else:
+                        user_state = entry[0]
+            future.set_result(user_state)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[username]
+
+        if user_state is None:
+            return default
+        self.evict()
+        return user_state
+
+    def __setitem__(self, username: str, user_state):
+        self._put_resident(username, user_state)
+        self.evict()
+
+    def __delitem__(self, username: str):
+        with self._lock:
+            if username not in self._known:
+                raise KeyError(username)
+            self._known.discard(username)
+            self._resident.pop(username, None)
+
+    def __contains__(self, username) -> bool:
+        return username in self._known
+
+    def __iter__(self):
+        with self._lock:
+            usernames = list(self._known)
+        return iter(usernames)
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def is_resident(self, username: str) -> bool:
+        return username in self._resident
+
+    def get_resident_count(self) -> int:
+        return len(self._resident)
+
+    def _is_over_budget(self, resident: int, instances: int) -> bool:
+        return (self.max_users > 0 and resident > self.max_users) or (
+            self.max_instances > 0 and instances > self.max_instances
+        )
+
+    def evict(self) -> int:
+        """
+        Saves and drops the least recently used states until the limits are
+        met. States of users active within idle_seconds, or whose lock is
+        held by a request, are kept even if that exceeds the limits
+        :return: the number of states evicted
+        """
+        if self.max_users <= 0 and self.max_instances <= 0:
+            return 0
+
+        with self._lock:
+            # nothing can go while even the least recently used state is in use
+            if len(self._resident) == 0:
+                return 0
+            oldest = next(iter(self._resident.values()))
+            if time.monotonic() - oldest[1] < self.idle_seconds:
+                return 0
+            candidates = list(self._resident.items())
+        instances = 0
+        if self.max_instances > 0:
+            instances = sum(_get_state_size(entry[0]) for _, entry in candidates)
+        resident = len(candidates)
+
+        evicted = 0
+        now = time.monotonic()
+        for username, (user_state, last_access) in candidates:
+            if not self._is_over_budget(resident, instances):
+                break
+            # everything after this state was used even more recently
+            if now - last_access < self.idle_seconds:
+                break
+
+            lock = user_lock(username)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                with self._lock:
+                    entry = self._resident.get(username)
+                    # the state was used again since we looked
+                    if entry is None or entry[1] != last_access:
+                        continue
+                # unsaved changes are written before the state goes
+                self._flush(username, user_state)
+                with self._lock:
+                    if self._resident.get(username, (None, None))[1] == last_access:
+                        del self._resident[username]
+                    else:
+                        continue
+            except Exception as e:
+                _logger.error("Could not save the state of %s, keeping it in memory: %s" % (username, repr(e)))
+                continue
+            finally:
+                lock.release()
+
+            resident -= 1
+            if self.max_instances > 0:
+                instances -= _get_state_size(user_state)
+            evicted += 1
+
+        self.evictions += evicted
+        if evicted > 0:
+            _logger.debug("Evicted %d idle user states, %d left in memory" % (evicted, resident))
+        return evicted
+
+    def flush_all(self):
+        """
+        Saves every state in memory
+        """
+        with self._lock:
+            resident = list(self._resident.items())
+        for username, (user_state, _) in resident:
+            with user_lock(username):
+                self._flush(username, user_state)
@@ -8,49 +8,68 @@ desc: Defines a configuration which allows all of the modules
   there is a single source of truth for 'configuration'
 """
 
+import builtins
+import copy
+from functools import partial
 from typing import Any
 from collections.abc import Callable
-from dataclasses import dataclass, fields
+from dataclasses import MISSING, dataclass, field, fields
 
 @dataclass
 class _GlobalConfig:
-    values: dict[str, Any] = {}
-    assertion: dict[str, Callable] = {}
+    values: dict[str, Any] = field(default_factory=dict)
+    assertion: dict[str, Callable] = field(default_factory=dict)
 
 _global_config = _GlobalConfig()
 
 def _create_type_assertion(type: type):
     def _type_assertion(val):
+        # generic aliases (dict[str, Any], Optional[...]) are not checked
+        if not isinstance(type, builtins.type):
+            return
+        # an int is a fine float
+        if type is float and isinstance(val, int):
+            return
         assert isinstance(val, type)
     
     return _type_assertion
 
 class Config:
     def __getattr__(self, name: str) -> Any:
-        return _global_config().values[name]
+        return _global_config.values[name]
     
     def __setattr__(self, name: str, value: Any) -> None:
         raise Exception("Configs are Immutable")
 
 def config(cls, *args, **kwargs):
-    cls = dataclass(args, kwargs)
+    # the configurations declare their mutable defaults plainly, each one
+    # gets a copy of them
+    for name in cls.__dict__.get("__annotations__", {}):
+        default = cls.__dict__.get(name)
+        if isinstance(default, (list, dict, set)):
+            setattr(cls, name, field(default_factory=partial(copy.copy, default)))
+    cls = dataclass(cls, *args, **kwargs)
 
-    for field in fields(cls):
-        if field in _global_config().values:
+    for cls_field in fields(cls):
+        if cls_field.name in _global_config.values:
             # could be worth logging
             continue
 
-        assertion = _create_type_assertion(field.type)
-        assertion(field.default)
-        _global_config().values[field.name] = field.default
-        _global_config().values[field.name] = assertion
+        default = cls_field.default
+        if default is MISSING and cls_field.default_factory is not MISSING:
+            default = cls_field.default_factory()
+
+        assertion = _create_type_assertion(cls_field.type)
+        assertion(default)
+        _global_config.values[cls_field.name] = default
+        _global_config.assertion[cls_field.name] = assertion
     
     return Config()
         
 def configure_from_cli_args(args):
-    for key, value in vars(args):
-        if key not in _global_config().values.keys():
+    for key, value in vars(args).items():
+        if key not in _global_config.values.keys():
             raise KeyError(f"args has {key} which is not supported by any service")
 
-        _global_config().assertion[key](value)
-        _global_config().values = value
\ No newline at end of file
+        _global_config.assertion[key](value)
+        _global_config.values[key] = value
\ No newline at end of file
@@ -9,9 +9,11 @@ desc: Defines a module in the context of the flask server. This allows
 
 from collections.abc import Callable
 from dataclasses import dataclass
+from typing import Any, Optional
 
 @dataclass
 class Module:
+    configuration: Any = None
     persistence: Callable[[], None] = lambda: None
     start: Callable[[], None] = lambda: None
     cleanup: Callable[[], None] = lambda: None
@@ -21,15 +23,26 @@ _modules = {}
 def register_module(name, service: Module):
     _modules[name] = service
 
-def module_getter(func: Callable[[], Module], name=f"SERVICE_{len(_modules.keys())}"):
-    register_module(name, func())
+def module_getter(func: Callable[[], Module], name: Optional[str] = None):
+    # the getter runs once the services are needed, since it refers to the
+    # configuration and functions defined further down its module
+    if name is None:
+        name = f"SERVICE_{len(_modules.keys())}"
+    register_module(name, func)
+    return func
+
+def _get_service(name) -> Module:
+    service = _modules[name]
+    if not isinstance(service, Module):
+        service = _modules[name] = service()
+    return service
 
 def _roll_through(binded_func: Callable[[Module], None], process: str):
     last_service_name = ''
     try:
-      for name, service in _modules.items():
+      for name in list(_modules.keys()):
          last_service_name = name
-         binded_func(service)
+         binded_func(_get_service(name))
     except Exception as e:
       print(f"Exception raised during {process} within service {last_service_name}\n{e}")
       quit(1)
@@ -0,0 +1,618 @@
+'''
+This script benchmarks the parts of the server whose cost grows with the size of a project,
+e.g. reading the data files, and stress tests the state shared between request threads.
+Each benchmark generates its own synthetic data.
+
+    python -m potato.tools.benchmark csv --rows 1000000
+    python -m potato.tools.benchmark highlight --keywords 40000
+    python -m potato.tools.benchmark sampler --instances 1000000 --users 10000
+    python -m potato.tools.benchmark stress --instances 20000 --users 500 --per-user 20
+    python -m potato.tools.benchmark memory --instances 1000000 --users 1000
+    python -m potato.tools.benchmark recovery --instances 1000
+    python -m potato.tools.benchmark restore --users 5000 --per-user 500 --legacy
+'''
+
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+import json
+import os
+from random import Random
+import re
+import sys
+import tempfile
+from threading import Barrier, Event, Thread
+import time
+import tracemalloc
+
+import pandas as pd
+
+from potato.flask_app.modules.annotation.highlight import KeywordMatcher, highlight_keywords
+from potato.flask_app.modules.project.instance_store import InstanceStore
+from potato.flask_app.modules.project.assignment_index import AssignedIndex, InstanceIds
+from potato.flask_app.modules.project.journal import (
+    AssignmentJournal,
+    apply_assignment,
+    dump_task_assignment,
+    get_assignment_journal,
+    set_assignment_journal,
+)
+from potato.flask_app.modules.project.leases import LeaseTable, renew_lease, set_lease_table
+from potato.flask_app.modules.sampling.pool import StratifiedPool, UnassignedPool
+from potato.flask_app.modules.sampling.strategies import RandomStrategy
+from potato.flask_app.modules.user.annotation_journal import AnnotationJournal, tombstone
+from potato.flask_app.modules.user.assigned_ids import save_assigned_ids
+from potato.flask_app.modules.user.restore import (
+    ANNOTATION_ORDER_FILENAME,
+    parse_user_files,
+    read_raw_user_files,
+    reconcile_user_files,
+)
+from potato.flask_app.modules.user.state_cache import UserStateCache
+
+
+def _report(name, count, seconds, unit="rows"):
+    print(
+        "%-30s %10d %s %8.2fs %12.1f %s/s"
+        % (name, count, unit, seconds, count / max(seconds, 1e-9), unit)
+    )
+
+
+def _write_tsv(fname, rows):
+    with open(fname, "wt") as f:
+        f.write("id\ttext\tsource\tscore\n")
+        for i in range(rows):
+            f.write("%d\tthis is the text of instance number %d\tsource_%d\t%d\n" % (i, i, i % 7, i % 5))
+
+
+def benchmark_csv(args):
+    """
+    Rows per second when reading a tsv data file into the instance store
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "data.tsv")
+        _write_tsv(fname, args.rows)
+
+        if args.legacy:
+            # the per-row iterrows() loop load_all_data used before
+            start = time.perf_counter()
+            df = pd.read_csv(fname, sep="\t", dtype={"id": str, "text": str})
+            data = {}
+            for _, row in df.iterrows():
+                item = {}
+                for c in df.columns:
+                    item[c] = row[c]
+                data[row["id"]] = item
+            _report("iterrows", len(data), time.perf_counter() - start)
+
+        engines = ["c"]
+        try:
+            import pyarrow
+            engines.append("pyarrow")
+        except ImportError:
+            pass
+
+        for engine in engines:
+            for projected in [False, True]:
+                usecols = {"id", "text"} if projected else None
+                store = InstanceStore()
+                start = time.perf_counter()
+                count = store.add_csv_file(fname, "\t", "id", "text", usecols=usecols, engine=engine)
+                name = "chunked %s%s" % (engine, " (id, text)" if projected else "")
+                _report(name, count, time.perf_counter() - start)
+
+
+def _random_word(random, length):
+    return "".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length))
+
+
+def benchmark_highlight(args):
+    """
+    Pages per second when finding the keywords of a keyword_highlights_file
+    in the text of an instance
+    """
+    random = Random(0)
+    keywords = set()
+    while len(keywords) < args.keywords:
+        word = _random_word(random, random.randint(4, 9))
+        keywords.add(word + "*" if random.random() < 0.2 else word)
+    keywords = list(keywords)
+    text = " ".join(
+        random.choice(keywords).replace("*", "s") if random.random() < 0.05 else _random_word(random, 6)
+        for _ in range(args.words)
+    )
+
+    matcher = KeywordMatcher()
+    start = time.perf_counter()
+    for word in keywords:
+        matcher.add(word, "schema", "label")
+    print("built a matcher for %d keywords in %.2fs" % (len(keywords), time.perf_counter() - start))
+
+    pages = 20
+    start = time.perf_counter()
+    for _ in range(pages):
+        hits = matcher.find(text)
+    _report("trie (%d hits)" % len(hits), pages, time.perf_counter() - start, "pages")
+
+    # a page view of an instance whose highlights are cached, only the random
+    # highlight is laid over the cached markup
+    highlighted = highlight_keywords(matcher, text, lambda schema, label: "red")
+    spans = [match.span() for match in re.finditer(r"\b" + text[:6] + r"\b", text, re.I)]
+    pages = 1000
+    start = time.perf_counter()
+    for _ in range(pages):
+        highlighted.render(spans, "blue")
+    _report("cached highlights", pages, time.perf_counter() - start, "pages")
+
+    if args.legacy:
+        # one regex compiled and searched per keyword, as post_process did before
+        pages = 1
+        start = time.perf_counter()
+        for _ in range(pages):
+            count = 0
+            for word in keywords:
+                regex = re.compile(r"\b" + word.replace("*", "[a-z]*?") + r"\b", re.I)
+                count += sum(1 for _ in regex.finditer(text))
+        _report("regex per keyword (%d hits)" % count, pages, time.perf_counter() - start, "pages")
+
+
+def _assign(unassigned, sampled_keys):
+    for key in sampled_keys:
+        unassigned[key] -= 1
+        if unassigned[key] == 0:
+            del unassigned[key]
+
+
+def benchmark_sampler(args):
+    """
+    New annotators per second when the random or stratified sampling
+    strategy draws the least covered instances for every new annotator
+    """
+    random = Random(0)
+    ids = ["instance_%d" % i for i in range(args.instances)]
+
+    start = time.perf_counter()
+    unassigned = UnassignedPool((_id, args.labels) for _id in ids)
+    print("built a pool of %d instances in %.2fs" % (len(unassigned), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for _ in range(args.users):
+        _assign(unassigned, unassigned.sample_least_covered(args.per_user, random))
+    _report("bucketed pool", args.users, time.perf_counter() - start, "users")
+
+    # every instance is drawn once before any is drawn a second time
+    sizes = unassigned.get_bucket_sizes()
+    if len(sizes) > 0 and max(sizes) - min(sizes) > 1:
+        raise Exception("Unbalanced assignment, remaining labels per instance: %s" % sizes)
+
+    # bursts of new annotators served by one draw from the pool
+    unassigned = UnassignedPool((_id, args.labels) for _id in ids)
+    strategy = RandomStrategy(random)
+    start = time.perf_counter()
+    for first in range(0, args.users, args.burst):
+        users = ["user_%d" % i for i in range(first, min(first + args.burst, args.users))]
+        for sampled_keys in strategy.sample_many(unassigned, users, args.per_user).values():
+            if len(set(sampled_keys)) != len(sampled_keys):
+                raise Exception("An annotator was given the same instance twice")
+            _assign(unassigned, sampled_keys)
+    _report("bursts of %d" % args.burst, args.users, time.perf_counter() - start, "users")
+
+    sizes = unassigned.get_bucket_sizes()
+    if len(sizes) > 0 and max(sizes) - min(sizes) > 1:
+        raise Exception("Unbalanced assignment, remaining labels per instance: %s" % sizes)
+
+    # the stratified strategy, with every batch split evenly between the strata
+    start = time.perf_counter()
+    unassigned = StratifiedPool(lambda _id: hash(_id) % args.strata, ((_id, args.labels) for _id in ids))
+    print("built a pool of %d instances in %d strata in %.2fs" % (
+        len(unassigned), args.strata, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for _ in range(args.users):
+        sampled_keys = unassigned.sample_stratified(args.per_user, random)
+        per_stratum = Counter(unassigned.get_stratum(key) for key in sampled_keys)
+        if len(unassigned.get_stratum_sizes()) == args.strata and (
+            len(per_stratum) < min(args.strata, args.per_user)
+            or max(per_stratum.values()) - min(per_stratum.values()) > 1
+        ):
+            raise Exception("Unbalanced batch, instances per stratum: %s" % dict(per_stratum))
+        _assign(unassigned, sampled_keys)
+    _report("stratified pool", args.users, time.perf_counter() - start, "users")
+
+    if args.legacy:
+        # shuffle and sort the whole pool for every user, as sample_instances did before
+        unassigned = dict((_id, args.labels) for _id in ids)
+        users = min(args.users, 5)
+        start = time.perf_counter()
+        for _ in range(users):
+            shuffled = {k: unassigned[k] for k in random.sample(list(unassigned.keys()), len(unassigned))}
+            sorted_keys = [it[0] for it in sorted(shuffled.items(), key=lambda item: item[1], reverse=True)]
+            _assign(unassigned, sorted_keys[: args.per_user])
+        _report("shuffle and sort", users, time.perf_counter() - start, "users")
+
+
+def _check_task_assignment(task_assignment, labels, user_to_keys):
+    assigned = task_assignment["assigned"]
+    unassigned = task_assignment["unassigned"]
+
+    for username, keys in user_to_keys.items():
+        if len(keys) != len(set(keys)):
+            raise Exception("%s was given the same instance twice" % username)
+
+    for instance_id, users in assigned.items():
+        if len(users) != len(set(users)):
+            raise Exception("%s is assigned twice to the same user" % instance_id)
+        if len(users) + unassigned.get(instance_id, 0) != labels:
+            raise Exception(
+                "%s has %d users but %d labels remaining"
+                % (instance_id, len(users), unassigned.get(instance_id, 0))
+            )
+
+    counts = Counter(unassigned.values())
+    if unassigned.get_bucket_sizes() != dict(counts):
+        raise Exception("The pool buckets do not match its counts")
+
+
+def _check_user_queues(task_assignment, user_to_annotation_state):
+    # every instance in a user's queue is assigned to them in the task
+    # assignment, and nothing else is
+    assigned_to = {}
+    for instance_id, users in task_assignment["assigned"].items():
+        for username in users:
+            assigned_to.setdefault(username, set()).add(instance_id)
+
+    for username in list(user_to_annotation_state.keys()):
+        queue = user_to_annotation_state[username].get_real_assigned_instance_ids()
+        if len(queue) != len(set(queue)):
+            raise Exception("%s was given the same instance twice" % username)
+        if set(queue) != assigned_to.pop(username, set()):
+            raise Exception("The queue of %s does not match the task assignment" % username)
+    if len(assigned_to) > 0:
+        raise Exception("%d users hold instances but have no state" % len(assigned_to))
+
+
+def _share_globals(modules, **values):
+    # the server modules share these module globals, which the server sets
+    # up when it starts
+    for module in modules:
+        for name, value in values.items():
+            setattr(module, name, value)
+
+
+def benchmark_stress(args):
+    """
+    Logs in many simulated annotators at once, some several times, who
+    walk through their instances in the incremental assignment mode while
+    their leases expire and are reclaimed, while new instances are appended
+    to the data file and read by the file watcher. Checks that the task
+    assignment and the annotators' queues stay consistent
+    """
+    # the server modules need the server configuration, which the other
+    # benchmarks do without
+    from potato.flask_app.modules.project import task
+    from potato.flask_app.modules.sampling import module as sampling
+    from potato.flask_app.modules.user import module as user
+
+    # switch threads as often as possible to provoke races
+    sys.setswitchinterval(1e-6)
+    random = Random(0)
+    ids = ["instance_%d" % i for i in range(args.instances)]
+    instance_ids = InstanceIds()
+    task_assignment = {
+        "assigned": AssignedIndex(instance_ids),
+        "unassigned": UnassignedPool(((_id, args.labels) for _id in ids), instance_ids),
+        "testing": {"test_question_per_annotator": 0, "ids": []},
+    }
+    user_to_annotation_state = UserStateCache(lambda username: None, lambda username, user_state: None)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "data.jsonl")
+        with open(data_path, "w") as w:
+            for _id in ids:
+                w.write(json.dumps({"id": _id, "text": "text of %s" % _id}) + "\n")
+        store = InstanceStore()
+        store.add_jsonl_file(data_path, "id")
+        config = {
+            "output_annotation_dir": tmp_dir,
+            "automatic_assignment": {
+                "on": True,
+                "instance_per_annotator": args.per_user,
+                "labels_per_instance": args.labels,
+                "sampling_strategy": "random",
+                "assignment_mode": "incremental",
+                "batch_size": max(args.per_user // 5, 1),
+                "refill_threshold": 2,
+            },
+        }
+        _share_globals(
+            [task, sampling, user],
+            config=config,
+            task_assignment=task_assignment,
+            user_to_annotation_state=user_to_annotation_state,
+            instance_id_to_data=store,
+            sample_instances=sampling.sample_instances,
+            generate_initial_user_dataflow=sampling.generate_initial_user_dataflow,
+            get_total_user_count=user.get_total_user_count,
+            get_finished_user_count=user.get_finished_user_count,
+        )
+
+        journal = AssignmentJournal(os.path.join(tmp_dir, "task_assignment.json"), compact_every=50)
+        journal.compact(task_assignment)
+        set_assignment_journal(journal)
+        lease_table = LeaseTable(args.lease_seconds)
+        set_lease_table(lease_table)
+
+        usernames = ["user_%d" % (i % args.users) for i in range(args.users * 2)]
+        random.shuffle(usernames)
+        # every fourth annotator leaves halfway and has their instances reclaimed
+        leaving = set("user_%d" % i for i in range(0, args.users, 4))
+        barrier = Barrier(len(usernames))
+        done = Event()
+        errors = []
+
+        def run(username):
+            try:
+                barrier.wait()
+                user.lookup_user_state(username)
+                steps = args.per_user // 2 if username in leaving else args.per_user
+                for step in range(steps):
+                    renew_lease(username)
+                    user.move_to_next_instance(username)
+                    for instance_id in user.lookup_user_state(username).get_real_assigned_instance_ids():
+                        if instance_id not in store:
+                            raise Exception("%s is missing from the instance store" % instance_id)
+                    if step == 0:
+                        # e.g. the admin pages walk every instance
+                        sum(1 for _ in store)
+                if username in leaving:
+                    # as if they had left a lease ago
+                    lease_table.extend(username, time.time() - args.lease_seconds)
+            except Exception as e:
+                errors.append(e)
+
+        def reap():
+            while not done.is_set():
+                task.reclaim_expired_leases()
+                time.sleep(args.lease_seconds / 10)
+
+        appended = []
+
+        def watch():
+            # new instances are appended to the data file while the server runs
+            while not done.is_set():
+                with open(data_path, "a") as w:
+                    _id = "appended_%d" % len(appended)
+                    w.write(json.dumps({"id": _id, "text": "text of %s" % _id}) + "\n")
+                appended.append(_id)
+                store.append_new_instances()
+                time.sleep(0.001)
+
+        threads = [Thread(target=run, args=(username,)) for username in usernames]
+        reaper = Thread(target=reap)
+        watcher = Thread(target=watch)
+        start = time.perf_counter()
+        reaper.start()
+        watcher.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        reaper.join()
+        watcher.join()
+        task.reclaim_expired_leases()
+        if len(errors) > 0:
+            raise errors[0]
+        store.append_new_instances()
+        if list(store) != ids + appended:
+            raise Exception("The instance store does not hold every appended instance in order")
+        _report("concurrent sessions", len(usernames), elapsed, "sessions")
+        print("reclaimed %(reclaimed_instances)d instances from %(expired_leases)d leases" % lease_table.get_metrics())
+
+        if len(user_to_annotation_state) != args.users:
+            raise Exception(
+                "%d users were assigned, expected %d" % (len(user_to_annotation_state), args.users)
+            )
+        user_to_keys = {
+            username: user_to_annotation_state[username].get_real_assigned_instance_ids()
+            for username in list(user_to_annotation_state.keys())
+        }
+        _check_task_assignment(task_assignment, args.labels, user_to_keys)
+        _check_user_queues(task_assignment, user_to_annotation_state)
+
+        # the journal has to restore the same assignment
+        get_assignment_journal().close()
+        restored = AssignmentJournal(journal.path).load()
+        for key in ["assigned", "unassigned"]:
+            if json.dumps(dict(restored[key]), sort_keys=True) != json.dumps(dict(task_assignment[key]), sort_keys=True):
+                raise Exception("Replaying the journal gives a different %s" % key)
+        set_assignment_journal(None)
+        set_lease_table(None)
+
+    print("task assignment is consistent")
+
+
+def benchmark_recovery(args):
+    """
+    Appends to the task assignment journal after a crash cut its last
+    record short, and checks that a restart replays every complete record
+    """
+    ids = ["instance_%d" % i for i in range(args.instances)]
+
+    def new_task_assignment():
+        return {"assigned": {}, "unassigned": OrderedDict((_id, args.labels) for _id in ids)}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "task_assignment.json")
+        expected = new_task_assignment()
+        journal = AssignmentJournal(path)
+        journal.compact(expected)
+        journal.append(expected, "u1", ids[:2], -1)
+        journal.close()
+
+        # the crash cuts the record of u2 short
+        with open(journal.journal_path, "a") as w:
+            w.write(json.dumps({"seq": 2, "user": "u2", "ids": ids[2:4]})[:20])
+
+        for username, start in [("u2", 2), ("u3", 4)]:
+            journal = AssignmentJournal(path)
+            task_assignment = journal.load(lambda saved: dict(saved, unassigned=OrderedDict(saved["unassigned"])))
+            journal.append(task_assignment, username, ids[start : start + 2], -1)
+            apply_assignment(expected, username, ids[start : start + 2], -1)
+            journal.close()
+
+        start = time.perf_counter()
+        restored = AssignmentJournal(path).load()
+        _report("replay after a crash", len(ids), time.perf_counter() - start, "instances")
+        for key in ["assigned", "unassigned"]:
+            if json.dumps(restored[key], sort_keys=True) != json.dumps(dict(expected[key]), sort_keys=True):
+                raise Exception("Records appended after the crash were lost from %s" % key)
+
+    print("records appended after a crash are replayed")
+
+
+def benchmark_memory(args):
+    """
+    Memory held by the task assignment of a large project once every
+    instance was assigned to some annotators, as dicts and in compact form
+    """
+    random = Random(0)
+    ids = ["instance_%d" % i for i in range(args.instances)]
+    usernames = ["user_%d" % i for i in range(args.users)]
+    assignments = [random.sample(usernames, random.randint(0, args.labels)) for _ in ids]
+
+    def build_dicts():
+        return {
+            "assigned": {_id: list(users) for _id, users in zip(ids, assignments)},
+            "unassigned": OrderedDict((_id, args.labels) for _id in ids),
+        }
+
+    def build_compact():
+        instance_ids = InstanceIds()
+        assigned = AssignedIndex(instance_ids)
+        for _id, users in zip(ids, assignments):
+            if len(users) == 0:
+                assigned[_id] = []
+            for username in users:
+                assigned.add_user(_id, username)
+        return {"assigned": assigned, "unassigned": UnassignedPool(((_id, args.labels) for _id in ids), instance_ids)}
+
+    for name, build in [("dicts", build_dicts), ("compact", build_compact)]:
+        start = time.perf_counter()
+        task_assignment = build()
+        seconds = time.perf_counter() - start
+        del task_assignment
+
+        # tracing slows the build down, so it is timed separately
+        tracemalloc.start()
+        task_assignment = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-30s %10d instances %8.2fs %10.1f MB" % (name, args.instances, seconds, size / 2 ** 20))
+
+        # both have to be written out the same way
+        with tempfile.TemporaryFile("w+") as f:
+            dump_task_assignment(task_assignment, f)
+            f.seek(0)
+            saved = json.load(f)
+        if saved["assigned"] != {_id: users for _id, users in zip(ids, assignments)}:
+            raise Exception("The %s task assignment is not saved as it was built" % name)
+        del task_assignment, saved
+
+
+def _write_user_dir(user_dir, random, instances, per_user):
+    os.makedirs(user_dir)
+    assigned_ids = ["instance_%d" % i for i in random.sample(range(instances), per_user)]
+    save_assigned_ids(user_dir, assigned_ids)
+    with open(os.path.join(user_dir, ANNOTATION_ORDER_FILENAME), "wt") as f:
+        for _id in assigned_ids:
+            f.write(_id + "\n")
+    # some instances are annotated again and some cleared later on
+    journal = AnnotationJournal(user_dir)
+    records = []
+    for i, _id in enumerate(assigned_ids[: per_user * 3 // 4]):
+        records.append({"id": _id, "label_annotations": {"sentiment": {"positive": "true"}}, "span_annotations": []})
+        if i % 5 == 0:
+            records.append({"id": _id, "label_annotations": {"sentiment": {"negative": "true"}}, "span_annotations": []})
+        if i % 11 == 0:
+            records.append(tombstone(_id))
+    journal.append(records, len(records))
+
+
+def _legacy_reconcile(files, dataset_ids):
+    # the list based check every user was restored with before
+    assigned_ids = [_id for _id in files.assigned_ids if _id in dataset_ids]
+    annotation_order = [_id for _id in files.annotation_order if _id in assigned_ids]
+    for _id in assigned_ids:
+        if _id not in annotation_order:
+            annotation_order.append(_id)
+    return annotation_order
+
+
+def benchmark_restore(args):
+    """
+    Users restored per second at startup, timing reading their files,
+    parsing them and checking them against the dataset on their own
+    """
+    random = Random(0)
+    dataset_ids = set("instance_%d" % i for i in range(args.instances))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        user_dirs = [os.path.join(tmp_dir, "user_%d" % i) for i in range(args.users)]
+        for user_dir in user_dirs:
+            _write_user_dir(user_dir, random, args.instances, args.per_user)
+
+        start = time.perf_counter()
+        all_raw = [read_raw_user_files(user_dir) for user_dir in user_dirs]
+        _report("read", len(user_dirs), time.perf_counter() - start, "users")
+
+        start = time.perf_counter()
+        all_files = [parse_user_files(raw) for raw in all_raw]
+        _report("parse", len(user_dirs), time.perf_counter() - start, "users")
+
+        start = time.perf_counter()
+        expected = [reconcile_user_files(files, dataset_ids) for files in all_files]
+        _report("reconcile", len(user_dirs), time.perf_counter() - start, "users")
+
+        if args.legacy:
+            start = time.perf_counter()
+            legacy = [_legacy_reconcile(files, dataset_ids) for files in all_files]
+            _report("reconcile (legacy)", len(user_dirs), time.perf_counter() - start, "users")
+            if legacy != [annotation_order for _, annotation_order, _, _ in expected]:
+                raise Exception("The legacy reconciliation gives a different annotation order")
+
+
+BENCHMARKS = {
+    "csv": benchmark_csv,
+    "highlight": benchmark_highlight,
+    "memory": benchmark_memory,
+    "recovery": benchmark_recovery,
+    "restore": benchmark_restore,
+    "sampler": benchmark_sampler,
+    "stress": benchmark_stress,
+}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()))
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--keywords", type=int, default=40000, help="keywords to highlight")
+    parser.add_argument("--words", type=int, default=2000, help="words in the highlighted text")
+    parser.add_argument("--instances", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--per-user", type=int, default=50, help="instance_per_annotator")
+    parser.add_argument("--labels", type=int, default=3, help="labels_per_instance")
+    parser.add_argument("--burst", type=int, default=20, help="annotators served by one draw")
+    parser.add_argument("--strata", type=int, default=5, help="strata of the stratified strategy")
+    parser.add_argument(
+        "--lease-seconds", type=float, default=0.5, help="lease of the annotators in the stress test"
+    )
+    parser.add_argument(
+        "--legacy", action="store_true", help="also time the previous implementation", default=False
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
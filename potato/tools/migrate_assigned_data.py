@@ -0,0 +1,20 @@
+'''
+This script rewrites the assigned_user_data.json files of an annotation output directory written by older
+versions, which hold a copy of every instance assigned to a user, as lists of instance ids. Each old file is
+kept as assigned_user_data.json.bak. The server does the same for every user it loads, running this once up
+front saves the work at startup.
+
+    python -m potato.tools.migrate_assigned_data --annotation_data_dir annotation_output/
+'''
+
+from argparse import ArgumentParser
+
+from potato.flask_app.modules.user.assigned_ids import migrate_assigned_ids
+
+parser = ArgumentParser()
+parser.add_argument("--annotation_data_dir", required=True)
+
+args = parser.parse_args()
+
+migrated = migrate_assigned_ids(args.annotation_data_dir)
+print("migrated the assigned data of %d users in %s" % (migrated, args.annotation_data_dir))
@@ -9,6 +9,8 @@ from argparse import ArgumentParser
 import pandas as pd
 import shutil
 
+from potato.flask_app.modules.project.journal import AssignmentJournal
+
 task_assignment_path = None#os.path.join(config["output_annotation_dir"], config["automatic_assignment"]["output_filename"])
 
 annotation_data_dir = None#config["output_annotation_dir"]
@@ -46,9 +48,9 @@ print('bad users moved to %s'%bad_user_dir)
 
 # remove users from the task assignment
 if os.path.exists(args.task_assignment_path):
-    # load the task assignment if it has been generated and saved
-    with open(args.task_assignment_path, "r") as r:
-        task_assignment = json.load(r)
+    # load the task assignment if it has been generated and saved, along with
+    # the changes in its journal which were not compacted into it yet
+    task_assignment = AssignmentJournal(args.task_assignment_path).load()
 
 for inst_id in task_assignment['assigned']:
     new_li = []
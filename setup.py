@@ -22,6 +22,7 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=[
         'beautifulsoup4>=4.10.0',
+        'cachetools>=5.5.0',
         'click>=8.0.3',
         'Flask>=2.0.2',
         'itsdangerous>=2.0.1',